@@ -0,0 +1,346 @@
+import argparse
+import csv
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import traceback
+from time import time
+
+import numpy as np
+
+from common.flow_graph import make_donor_csr
+from common.kernel import kernel_registry
+from common.layer_dtype import LayerDtypePolicy
+from common.prefetch_pipeline import PrefetchPipeline
+from common.shared_array import SharedArray
+from common.util import load_json
+from common.util import save_json
+from make_catchment_area import CatchmentAreaArrangement
+from make_catchment_area import DAM_GEOJSON_PATH
+from stream_network import StreamNetwork
+
+BATCH_SAVE_DIR = "output/batch-catchment-area"
+SUMMARY_FILE_NAME = "summary.csv"
+PIPELINE_REPORT_FILE_NAME = "pipeline.json"
+# the pipeline threads run next to the pool, a forked worker could inherit a lock held by one of them
+WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+SUMMARY_COLUMNS = [
+    "scene",
+    "dam",
+    "river",
+    "x",
+    "y",
+    "cell_count",
+    "area_km2",
+    "catalog_area_km2",
+    "status",
+    "error",
+    "elapsed_sec",
+]
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    """
+    e.g., python3 src/batch_catchment_area.py base_data/FlowDir_30m_drone_mean.tif --filter W01_004=小丸川
+    """
+    parser = argparse.ArgumentParser(description="delineate catchment areas of many dams on many scenes")
+    parser.add_argument("flow_direction_path", nargs="+", help="flow direction rasters (one scene each)")
+    parser.add_argument("--dam-geojson", default=DAM_GEOJSON_PATH)
+    parser.add_argument("--dam", action="append", default=[], help="dam:river, repeatable")
+    parser.add_argument("--filter", action="append", default=[], help="property=value on the dam geojson")
+    parser.add_argument("--flow-direction-rule", default="D8", choices=["D8", "D16"])
+    parser.add_argument("--save-dir", default=BATCH_SAVE_DIR)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--stream-threshold-km2", type=float, help="also save the stream network of every scene")
+    parser.add_argument("--prefetch", type=int, default=1, help="scenes read ahead, 0 for none")
+    args = parser.parse_args()
+
+    batch = BatchCatchmentArea()
+    batch.set_save_dir(args.save_dir)
+    batch.set_worker_count(args.workers)
+    batch.set_flow_direction_rule(args.flow_direction_rule)
+    batch.set_stream_threshold_km2(args.stream_threshold_km2)
+    batch.set_prefetch_count(args.prefetch)
+    dam_geojson = load_json(args.dam_geojson)
+    dam_feature_list = batch.select_dam_feature(dam_geojson, args.dam, args.filter)
+    batch.run(args.flow_direction_path, dam_feature_list)
+    batch.save_summary()
+
+
+class BatchCatchmentArea:
+    """
+    delineation, boundary extraction and export for every dam on every scene in a process pool.
+    derived layers of a scene (flow direction, receiver and donor index) are shared read-only via shared memory.
+    one pool of fresh processes (forkserver, or spawn) serves every scene, a worker attaches the layers of a scene
+    by descriptor on its first outlet of the scene.
+    scenes go through a PrefetchPipeline, the next scenes are decoded and the stream network of the previous scene
+    is saved in background threads while the outlets of the current scene are delineated.
+    """
+
+    def __init__(self):
+        self.save_dir = BATCH_SAVE_DIR
+        self.worker_count = os.cpu_count()
+        self.flow_direction_rule = "D8"
+        self.stream_threshold_km2 = None
+        self.prefetch_count = 1
+        self.summary_list: list[dict] = []
+        self.pipeline_report: dict[str, float] = {}
+
+    def set_save_dir(self, save_dir: str):
+        self.save_dir = save_dir
+
+    def set_worker_count(self, worker_count: int):
+        self.worker_count = max(1, worker_count)
+
+    def set_flow_direction_rule(self, rule: str):
+        self.flow_direction_rule = rule
+
+    def set_stream_threshold_km2(self, stream_threshold_km2: float):
+        """stream network of every scene is saved when the threshold is set"""
+        self.stream_threshold_km2 = stream_threshold_km2
+
+    def set_prefetch_count(self, prefetch_count: int):
+        """scenes decoded ahead of the delineation, 0 for no overlap of reading, delineation and writing"""
+        self.prefetch_count = max(0, prefetch_count)
+
+    def select_dam_feature(
+        self,
+        geojson: dict[str, any],
+        dam_river_list: list[str] = None,
+        property_filter_list: list[str] = None,
+    ) -> list[dict]:
+        """dams by "dam:river" names and/or "property=value" filters, all dams if neither is given"""
+        dam_river_set = {tuple(dam_river.split(":", 1)) for dam_river in dam_river_list or []}
+        property_filter = dict(property_value.split("=", 1) for property_value in property_filter_list or [])
+        selected_list = []
+        for feature in geojson["features"]:
+            properties = feature["properties"]
+            dam_river = (properties["W01_001"], properties["W01_003"])
+            if dam_river_set and dam_river not in dam_river_set:
+                continue
+            if any(str(properties.get(key)) != value for key, value in property_filter.items()):
+                continue
+            selected_list.append(feature)
+        logging.info(f"{len(selected_list)} dams selected")
+        return selected_list
+
+    def run(self, flow_direction_path_list: list[str], dam_feature_list: list[dict]):
+        with multiprocessing.get_context(WORKER_START_METHOD).Pool(processes=self.worker_count) as pool:
+            pipeline = PrefetchPipeline(
+                self.read_scene,
+                lambda flow_direction_path, layer: self.run_scene(flow_direction_path, layer, dam_feature_list, pool),
+                self.write_scene,
+                prefetch_count=self.prefetch_count,
+            )
+            result_list = pipeline.run(flow_direction_path_list)
+        for result in result_list:
+            if result["error"] is not None:
+                scene_name = self.get_scene_name(result["item"])
+                error = f"{result['stage']}: {result['error']!r}"
+                self.summary_list.append(self.make_summary_row(scene_name, status="failed", error=error))
+        self.pipeline_report = pipeline.get_overlap_report()
+
+    def get_scene_name(self, flow_direction_path: str) -> str:
+        return os.path.splitext(os.path.basename(flow_direction_path))[0]
+
+    def read_scene(self, flow_direction_path: str) -> CatchmentAreaArrangement:
+        """flow direction decoded into an array, in the reader thread of the pipeline"""
+        layer = CatchmentAreaArrangement()
+        layer.set_flow_direction_rule(self.flow_direction_rule)
+        layer.set_flow_direction_rule_matrix()
+        layer.set_flow_direction(flow_direction_path)
+        return layer
+
+    def write_scene(self, flow_direction_path: str, scene_output: tuple[CatchmentAreaArrangement, StreamNetwork]):
+        """outputs of the whole scene, in the writer thread of the pipeline (outlets are saved by the workers)"""
+        layer, stream_network = scene_output
+        if stream_network is not None:
+            stream_network.save()
+        layer.close_used_images()
+
+    def run_scene(
+        self,
+        flow_direction_path: str,
+        layer: CatchmentAreaArrangement,
+        dam_feature_list: list[dict],
+        pool: multiprocessing.pool.Pool,
+    ) -> tuple[CatchmentAreaArrangement, StreamNetwork]:
+        scene_name = self.get_scene_name(flow_direction_path)
+        start = time()
+        flow_direction_array = np.asarray(layer.flow_direction)
+        stream_network = None
+        if self.stream_threshold_km2 is not None:
+            stream_network = self.derive_stream_network(layer, scene_name, flow_direction_array)
+        receiver_index_array = layer.get_receiver_index_array(flow_direction_array)
+        donor_index_pointer, donor_index_array = make_donor_csr(receiver_index_array)
+        task_list = self.make_task_list(layer, scene_name, dam_feature_list, flow_direction_array.shape)
+        logging.info(f"{scene_name}: {len(task_list)} outlets, layers ready in {time() - start:.2f} sec")
+        if len(task_list) == 0:
+            return layer, stream_network
+
+        shared_array_dict = {
+            "flow_direction": SharedArray.create_from_array(flow_direction_array),
+            "donor_index_pointer": SharedArray.create_from_array(donor_index_pointer),
+            "donor_index_array": SharedArray.create_from_array(donor_index_array),
+        }
+        descriptor_dict = {name: shared_array.get_descriptor() for name, shared_array in shared_array_dict.items()}
+        del receiver_index_array, donor_index_pointer, donor_index_array
+        scene_setting = (descriptor_dict, layer.image_tag, self.flow_direction_rule)
+        try:
+            for row in pool.imap_unordered(delineate_outlet, [(scene_setting, task) for task in task_list]):
+                self.summary_list.append(row)
+                logging.info(f"{row['scene']} {row['dam']} {row['status']} {row['elapsed_sec']:.2f} sec")
+        finally:
+            for shared_array in shared_array_dict.values():
+                shared_array.close()
+        elapsed = time() - start
+        logging.info(f"{scene_name}: {len(task_list) / elapsed:.2f} outlets/sec with {self.worker_count} workers")
+        return layer, stream_network
+
+    def derive_stream_network(
+        self, layer: CatchmentAreaArrangement, scene_name: str, flow_direction_array: np.ndarray
+    ) -> StreamNetwork:
+        layer.set_save_dir(os.path.join(self.save_dir, scene_name))
+        flow_accumulation_array = layer.calculate_flow_accumulation(flow_direction_array)
+        stream_network = StreamNetwork(layer, self.stream_threshold_km2)
+        stream_network.derive(flow_direction_array, flow_accumulation_array)
+        return stream_network
+
+    def make_task_list(
+        self,
+        layer: CatchmentAreaArrangement,
+        scene_name: str,
+        dam_feature_list: list[dict],
+        array_shape: tuple[int, int],
+    ) -> list[dict]:
+        task_list = []
+        if len(dam_feature_list) == 0:
+            return task_list
+        geo_transform = layer.get_geo_transform()
+        coordinate_array = np.array([feature["geometry"]["coordinates"][:2] for feature in dam_feature_list])
+        x_array, y_array = geo_transform.get_pixel_xy(coordinate_array[:, 0], coordinate_array[:, 1])
+        is_inside_array = geo_transform.is_inside(x_array, y_array, array_shape)
+        for feature, x, y, is_inside in zip(dam_feature_list, x_array.tolist(), y_array.tolist(), is_inside_array):
+            if not is_inside:
+                continue
+            properties = feature["properties"]
+            outlet_name = f"{properties['W01_001']}_{properties['W01_003']}"
+            task_list.append(
+                {
+                    "scene": scene_name,
+                    "dam": properties["W01_001"],
+                    "river": properties["W01_003"],
+                    "catalog_area_km2": properties.get("W01_007"),
+                    "x": x,
+                    "y": y,
+                    "save_dir": os.path.join(self.save_dir, scene_name, outlet_name),
+                }
+            )
+        return task_list
+
+    def make_summary_row(self, scene_name: str, **kwargs) -> dict:
+        row = {column: None for column in SUMMARY_COLUMNS}
+        row["scene"] = scene_name
+        row["elapsed_sec"] = 0.0
+        row.update(kwargs)
+        return row
+
+    def save_summary(self):
+        os.makedirs(self.save_dir, exist_ok=True)
+        path = os.path.join(self.save_dir, SUMMARY_FILE_NAME)
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=SUMMARY_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.summary_list)
+        failed_cnt = sum(row["status"] != "done" for row in self.summary_list)
+        logging.info(f"summary: {len(self.summary_list)} rows, {failed_cnt} not done, saved to {path}")
+        if self.pipeline_report:
+            # stage seconds and the overlap of reading, delineation and writing across the scenes
+            save_json(self.pipeline_report, os.path.join(self.save_dir, PIPELINE_REPORT_FILE_NAME))
+
+
+class OutletDelineation(CatchmentAreaArrangement):
+    """catchment area of one outlet on layers attached from shared memory, used in the worker process"""
+
+    def __init__(self, descriptor_dict: dict, image_tag, flow_direction_rule: str):
+        super().__init__()
+        self.set_flow_direction_rule(flow_direction_rule)
+        self.set_flow_direction_rule_matrix()
+        self.scene_tag = image_tag
+        self.descriptor_dict = descriptor_dict
+        self.shared_array_dict = {name: SharedArray.attach(descriptor) for name, descriptor in descriptor_dict.items()}
+        self.flow_direction_array = self.shared_array_dict["flow_direction"].array
+        self.donor_index_pointer = self.shared_array_dict["donor_index_pointer"].array
+        self.donor_index_array = self.shared_array_dict["donor_index_array"].array
+
+    def delineate(self, task: dict) -> dict:
+        x_size = self.flow_direction_array.shape[1]
+        outlet_index = task["y"] * x_size + task["x"]
+        trace_upstream = kernel_registry.get("trace_upstream")
+        upstream_index = trace_upstream(self.donor_index_pointer, self.donor_index_array, outlet_index)
+        y, x = np.divmod(upstream_index, x_size)
+        bound_box = (int(x.min()), int(y.min()), int(x.max()) + 1, int(y.max()) + 1)
+        self.set_tag(self._update_tag(self.scene_tag, bound_box))
+        self.set_save_dir(task["save_dir"])
+
+        clipped_shape = (bound_box[3] - bound_box[1], bound_box[2] - bound_box[0])
+        self.catchment_area_array = np.zeros(clipped_shape, dtype=LayerDtypePolicy.mask)
+        self.catchment_area_array[y - bound_box[1], x - bound_box[0]] = 1
+        self.catchment_area = self.open_image_from_array(self.catchment_area_array)
+        self.watershed_boundary = self.open_image_from_array(self.get_watershed_boundary_array())
+        clipped_flow_direction = self.flow_direction_array[bound_box[1] : bound_box[3], bound_box[0] : bound_box[2]]
+        clipped_flow_direction = np.where(self.catchment_area_array == 1, clipped_flow_direction, 0)
+        self.flow_direction = self.open_image_from_array(clipped_flow_direction.astype(self.flow_direction_array.dtype))
+
+        self.save_tiff(self.catchment_area, "catchment_area")
+        self.save_mono_png(self.catchment_area, "catchment_area")
+        self.save_tiff(self.watershed_boundary, "watershed_boundary")
+        self.save_tiff_as_geojson(self.watershed_boundary, "watershed_boundary")
+        self.save_tiff(self.flow_direction, "flow_direction")
+        cell_count = int(upstream_index.size)
+        self.close_used_images()
+        return {"cell_count": cell_count, "area_km2": cell_count * self.get_cell_area_km2()}
+
+    def close(self):
+        """detached from the layers of the scene, the views on them are dropped first"""
+        self.flow_direction_array = self.donor_index_pointer = self.donor_index_array = None
+        for shared_array in self.shared_array_dict.values():
+            shared_array.close()
+
+
+outlet_delineation: OutletDelineation = None
+
+
+def get_outlet_delineation(descriptor_dict: dict, image_tag, flow_direction_rule: str) -> OutletDelineation:
+    """delineation on the layers of the scene, attached once per scene in each worker"""
+    global outlet_delineation
+    if outlet_delineation is None or outlet_delineation.descriptor_dict != descriptor_dict:
+        if outlet_delineation is not None:
+            outlet_delineation.close()
+        outlet_delineation = OutletDelineation(descriptor_dict, image_tag, flow_direction_rule)
+    return outlet_delineation
+
+
+def delineate_outlet(scene_task: tuple[tuple, dict]) -> dict:
+    """
+    scene_task: ((descriptor_dict, image_tag, flow_direction_rule) of the scene, task).
+    one failed outlet is reported in its summary row and does not abort the batch
+    """
+    scene_setting, task = scene_task
+    start = time()
+    row = {column: task.get(column) for column in SUMMARY_COLUMNS}
+    try:
+        row.update(get_outlet_delineation(*scene_setting).delineate(task))
+        row["status"] = "done"
+    except Exception as error:
+        logging.debug(traceback.format_exc())
+        row["status"] = "failed"
+        row["error"] = repr(error)
+    row["elapsed_sec"] = time() - start
+    return row
+
+
+if __name__ == "__main__":
+    main()
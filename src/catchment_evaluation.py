@@ -0,0 +1,273 @@
+import argparse
+import csv
+import logging
+import os
+
+import numpy as np
+
+from common.figure_setting import TiffTag
+from common.logging_decorator import logging_decorator
+from common.rasterizer import get_polygon_cell_index
+from common.util import load_json
+from common.util import save_json
+from make_catchment_area import CatchmentAreaArrangement
+from make_catchment_area import DAM_GEOJSON_PATH
+from sub_basin import SubBasinSegmentation
+
+EVALUATION_COLUMNS = [
+    "rank",
+    "name",
+    "label",
+    "x",
+    "y",
+    "area_km2",
+    "catalog_area_km2",
+    "area_error",
+    "reference_area_km2",
+    "iou",
+    "boundary_distance_km",
+    "hausdorff_distance_km",
+    "outlier_score",
+    "is_outlier",
+]
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    """
+    e.g., python3 src/catchment_evaluation.py base_data/FlowDir_30m_drone_mean.tif
+    --reference-geojson base_data/catchment_area.geojson --filter W01_004=小丸川
+    """
+    parser = argparse.ArgumentParser(description="accuracy of the catchment areas of many dams at once")
+    parser.add_argument("flow_direction_path")
+    parser.add_argument("--dam-geojson", default=DAM_GEOJSON_PATH)
+    parser.add_argument("--filter", action="append", default=[], help="property=value on the dam geojson")
+    parser.add_argument("--reference-geojson", help="reference catchment polygons with W01_001 and W01_003")
+    parser.add_argument("--flow-direction-rule", default="D8", choices=["D8", "D16"])
+    parser.add_argument("--area-tolerance", type=float, default=0.2, help="relative area error of an outlier")
+    parser.add_argument("--iou-threshold", type=float, default=0.8, help="iou below it is an outlier")
+    parser.add_argument("--save-dir", default="output/catchment-evaluation")
+    parser.add_argument("--format", default="csv", choices=["csv", "json"])
+    args = parser.parse_args()
+
+    catchment_area = CatchmentAreaArrangement()
+    catchment_area.set_save_dir(args.save_dir)
+    catchment_area.set_flow_direction_rule(args.flow_direction_rule)
+    catchment_area.set_flow_direction_rule_matrix()
+    catchment_area.set_flow_direction(args.flow_direction_path)
+    catchment_area.derive_flow_accumulation()
+    property_filter = dict(property_value.split("=", 1) for property_value in args.filter)
+    dam_geojson = load_json(args.dam_geojson)
+    dam_geojson["features"] = [
+        feature
+        for feature in dam_geojson["features"]
+        if all(str(feature["properties"].get(key)) == value for key, value in property_filter.items())
+    ]
+    sub_basin = SubBasinSegmentation(catchment_area)
+    sub_basin.add_dam_seed(dam_geojson)
+    sub_basin.derive(np.asarray(catchment_area.flow_direction), np.asarray(catchment_area.flow_accumulation))
+    evaluation = CatchmentEvaluation(sub_basin, args.area_tolerance, args.iou_threshold)
+    evaluation.set_catalog_area(dam_geojson)
+    if args.reference_geojson is not None:
+        evaluation.set_reference_polygon(load_json(args.reference_geojson))
+    evaluation.derive()
+    evaluation.save(file_format=args.format)
+
+
+def get_dam_name(properties: dict) -> str:
+    """name of a dam seed in SubBasinSegmentation.add_dam_seed"""
+    return f"{properties['W01_001']}_{properties['W01_003']}"
+
+
+class CatchmentEvaluation:
+    """
+    delineated catchment areas of many dams against the catalogued area (W01_007 in km2) and reference polygons.
+    the catchments are the seed tree of SubBasinSegmentation: the catchment of a dam is its sub-basin and
+    the sub-basins of all seeds upstream of it. with the seeds in depth first order, they are a range of the order,
+    so every cell is sorted once by the order of its label and the cells of a catchment are one slice of them.
+    reference polygons are rasterized by cell centers; iou, mean boundary distance and Hausdorff distance
+    are measured between the cells of the catchment and of the polygon.
+    rows are ranked by outlier score: the larger of the log area ratio and 1 - iou.
+    """
+
+    def __init__(self, sub_basin: SubBasinSegmentation, area_tolerance: float = 0.2, iou_threshold: float = 0.8):
+        self.sub_basin = sub_basin
+        self.catchment_area = sub_basin.catchment_area
+        self.area_tolerance = area_tolerance
+        self.iou_threshold = iou_threshold
+        self.catalog_area_dict: dict[str, float] = {}
+        self.reference_geometry_dict: dict[str, dict] = {}
+        self.row_list: list[dict] = []
+
+    def set_catalog_area(self, dam_geojson: dict[str, any]):
+        for feature in dam_geojson["features"]:
+            catalog_area_km2 = feature["properties"].get("W01_007")
+            if catalog_area_km2 is not None:
+                self.catalog_area_dict[get_dam_name(feature["properties"])] = float(catalog_area_km2)
+
+    def set_reference_polygon(self, reference_geojson: dict[str, any]):
+        """catchment polygons named by W01_001 and W01_003 as the dams"""
+        for feature in reference_geojson["features"]:
+            self.reference_geometry_dict[get_dam_name(feature["properties"])] = feature["geometry"]
+
+    def get_depth_first_order(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        position of every seed in depth first order of the seed tree and the end (exclusive) of its subtree,
+        both indexed by label (0 for cells without a seed downstream, before every seed)
+        """
+        child_list = self.sub_basin.get_child_list()
+        seed_cnt = len(child_list)
+        order = np.zeros(seed_cnt + 1, dtype=np.int64)
+        subtree_end = np.zeros(seed_cnt + 1, dtype=np.int64)
+        position = 1
+        stack = [(seed, False) for seed in range(seed_cnt) if self.sub_basin.parent_label[seed] == 0]
+        while stack:
+            seed, is_finished = stack.pop()
+            if is_finished:
+                subtree_end[seed + 1] = position
+                continue
+            order[seed + 1] = position
+            position += 1
+            stack.append((seed, True))
+            stack.extend((child, False) for child in child_list[seed])
+        subtree_end[0] = 1
+        return order, subtree_end
+
+    @logging_decorator
+    def derive(self):
+        label_array = self.sub_basin.label_array
+        array_shape = label_array.shape
+        order, subtree_end = self.get_depth_first_order()
+        cell_order = order[label_array.ravel()]
+        sorted_cell = np.argsort(cell_order, kind="stable")
+        sorted_cell_order = cell_order[sorted_cell]
+        geo_transform = self.catchment_area.get_geo_transform()
+        cell_area_km2 = self.catchment_area.get_cell_area_km2()
+        x_resolution_km, y_resolution_km, _ = self.catchment_area.change_resolution_to_km(
+            self.catchment_area.image_tag[TiffTag.ModelPixelScaleTag]
+        )
+        self.row_list = []
+        for seed, seed_index in enumerate(self.sub_basin.seed_index):
+            kind, name = self.sub_basin.seed_dict[int(seed_index)]
+            if kind != "dam":
+                continue
+            start, end = np.searchsorted(sorted_cell_order, [order[seed + 1], subtree_end[seed + 1]])
+            y, x = divmod(int(seed_index), array_shape[1])
+            row = {column: None for column in EVALUATION_COLUMNS}
+            row.update({"name": name, "label": seed + 1, "x": x, "y": y})
+            row["area_km2"] = float((end - start) * cell_area_km2)
+            catalog_area_km2 = self.catalog_area_dict.get(name)
+            if catalog_area_km2:
+                row["catalog_area_km2"] = catalog_area_km2
+                row["area_error"] = row["area_km2"] / catalog_area_km2 - 1
+            geometry = self.reference_geometry_dict.get(name)
+            if geometry is not None:
+                reference_cell = get_polygon_cell_index(geometry, geo_transform, array_shape)
+                reference_order = cell_order[reference_cell]
+                intersection_cnt = np.count_nonzero(
+                    (order[seed + 1] <= reference_order) & (reference_order < subtree_end[seed + 1])
+                )
+                union_cnt = (end - start) + reference_cell.size - intersection_cnt
+                row["reference_area_km2"] = float(reference_cell.size * cell_area_km2)
+                row["iou"] = float(intersection_cnt / union_cnt) if union_cnt > 0 else None
+                if end > start and reference_cell.size > 0:
+                    catchment_cell = np.sort(sorted_cell[start:end])
+                    row["boundary_distance_km"], row["hausdorff_distance_km"] = self.get_boundary_distance(
+                        catchment_cell, reference_cell, array_shape, (x_resolution_km, y_resolution_km)
+                    )
+            self.row_list.append(row)
+        self.rank_outlier()
+        outlier_cnt = sum(row["is_outlier"] for row in self.row_list)
+        logging.info(f"{len(self.row_list)} dams evaluated, {outlier_cnt} outliers")
+
+    def get_boundary_distance(
+        self,
+        cell_a: np.ndarray,
+        cell_b: np.ndarray,
+        array_shape: tuple[int, int],
+        resolution_km: tuple[float, float],
+    ) -> tuple[float, float]:
+        """mean of the distances from every boundary cell to the other boundary, and the largest of them"""
+        boundary_a = self.get_boundary_xy(cell_a, array_shape)
+        boundary_b = self.get_boundary_xy(cell_b, array_shape)
+        distance_a = self.get_nearest_distance(boundary_a, boundary_b, resolution_km)
+        distance_b = self.get_nearest_distance(boundary_b, boundary_a, resolution_km)
+        distance = np.concatenate([distance_a, distance_b])
+        return float(distance.mean()), float(distance.max())
+
+    def get_boundary_xy(self, cell_index: np.ndarray, array_shape: tuple[int, int]) -> np.ndarray:
+        """(x, y) of the cells with a 4-neighbor outside of the cells, cell_index in ascending order"""
+        y, x = np.divmod(cell_index, array_shape[1])
+        left, upper = x.min(), y.min()
+        # padded by one cell so that the cells on the edge of the bound box are boundary
+        is_inside = np.zeros((y.max() - upper + 3, x.max() - left + 3), dtype=np.bool_)
+        local_y, local_x = y - upper + 1, x - left + 1
+        is_inside[local_y, local_x] = True
+        is_boundary = (
+            ~is_inside[local_y - 1, local_x]
+            | ~is_inside[local_y + 1, local_x]
+            | ~is_inside[local_y, local_x - 1]
+            | ~is_inside[local_y, local_x + 1]
+        )
+        return np.stack([x[is_boundary], y[is_boundary]], axis=1)
+
+    def get_nearest_distance(
+        self, point_xy: np.ndarray, target_xy: np.ndarray, resolution_km: tuple[float, float]
+    ) -> np.ndarray:
+        """
+        distance in km from every point to the nearest target, row by row of the targets:
+        the nearest target in a row is found by binary search on its x, so the cost is rows * points * log.
+        """
+        x_resolution_km, y_resolution_km = resolution_km
+        order = np.lexsort((target_xy[:, 0], target_xy[:, 1]))
+        target_x, target_y = target_xy[order, 0], target_xy[order, 1]
+        row_list, row_start = np.unique(target_y, return_index=True)
+        row_end = np.append(row_start[1:], target_y.size)
+        nearest_squared = np.full(point_xy.shape[0], np.inf)
+        for row, start, end in zip(row_list, row_start, row_end):
+            row_x = target_x[start:end]
+            position = np.searchsorted(row_x, point_xy[:, 0]).clip(1, row_x.size) - 1
+            dx = np.minimum(
+                np.abs(point_xy[:, 0] - row_x[position]),
+                np.abs(point_xy[:, 0] - row_x[np.minimum(position + 1, row_x.size - 1)]),
+            )
+            squared = (dx * x_resolution_km) ** 2 + ((point_xy[:, 1] - row) * y_resolution_km) ** 2
+            np.minimum(nearest_squared, squared, out=nearest_squared)
+        return np.sqrt(nearest_squared)
+
+    def rank_outlier(self):
+        for row in self.row_list:
+            score_list = []
+            if row["area_error"] is not None:
+                score_list.append(abs(np.log1p(row["area_error"])) if row["area_error"] > -1 else np.inf)
+            if row["iou"] is not None:
+                score_list.append(1 - row["iou"])
+            row["outlier_score"] = float(max(score_list)) if score_list else None
+            is_area_outlier = row["area_error"] is not None and abs(row["area_error"]) > self.area_tolerance
+            is_shape_outlier = row["iou"] is not None and row["iou"] < self.iou_threshold
+            row["is_outlier"] = is_area_outlier or is_shape_outlier
+        # rows without a reference last
+        self.row_list.sort(
+            key=lambda row: -np.inf if row["outlier_score"] is None else row["outlier_score"], reverse=True
+        )
+        for rank, row in enumerate(self.row_list, 1):
+            row["rank"] = rank
+
+    def save(self, file_name: str = "catchment_evaluation", file_format: str = "csv") -> str:
+        os.makedirs(self.catchment_area.save_dir, exist_ok=True)
+        path = os.path.join(self.catchment_area.save_dir, f"{file_name}.{file_format}")
+        if file_format == "json":
+            save_json(self.row_list, path)
+        elif file_format == "csv":
+            with open(path, "w", encoding="utf-8", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=EVALUATION_COLUMNS)
+                writer.writeheader()
+                writer.writerows(self.row_list)
+        else:
+            raise ValueError("file_format must be 'csv' or 'json'.")
+        logging.info(f"catchment evaluation saved to {path}")
+        return path
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from time import perf_counter
+from time import time
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import numpy as np
+
+from common.flow_graph import make_donor_csr
+from common.kernel import kernel_registry
+from common.polygonizer import LabelPolygonizer
+from common.run_length_mask import RunLengthMask
+from make_catchment_area import CatchmentAreaArrangement
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    """
+    e.g., python3 src/catchment_server.py base_data/FlowDir_30m_drone_mean.tif --port 8765
+    curl 'localhost:8765/query?x=100&y=200&include=geojson'
+    """
+    parser = argparse.ArgumentParser(description="answer catchment queries on layers kept in memory")
+    parser.add_argument("flow_direction_path")
+    parser.add_argument("--flow-accumulation-path", help="derived from the flow direction if not given")
+    parser.add_argument("--flow-direction-rule", default="D8", choices=["D8", "D16"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", help="listen on this Unix socket instead of host and port")
+    parser.add_argument("--cache-size", type=int, default=256, help="basins kept in the LRU cache")
+    args = parser.parse_args()
+
+    catchment_area = CatchmentAreaArrangement()
+    catchment_area.set_flow_direction_rule(args.flow_direction_rule)
+    catchment_area.set_flow_direction_rule_matrix()
+    catchment_area.set_flow_direction(args.flow_direction_path)
+    if args.flow_accumulation_path is None:
+        catchment_area.derive_flow_accumulation()
+    else:
+        catchment_area.set_flow_accumulation(args.flow_accumulation_path)
+    service = CatchmentQueryService(catchment_area, cache_size=args.cache_size)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    logging.info(f"serving on {args.unix_socket or f'{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class QueryMetrics:
+    """latency and throughput of the queries, and how often a basin came from the cache or another request"""
+
+    def __init__(self, latency_window: int = 10000):
+        self.lock = threading.Lock()
+        self.start_time = time()
+        self.latency_window = latency_window
+        self.latency_list: list[float] = []
+        self.count_dict = {"request": 0, "point": 0, "cache_hit": 0, "coalesced": 0, "traced": 0, "error": 0}
+
+    def add_count(self, name: str, count: int = 1):
+        with self.lock:
+            self.count_dict[name] += count
+
+    def add_latency(self, latency_sec: float):
+        with self.lock:
+            self.latency_list.append(latency_sec)
+            if len(self.latency_list) > self.latency_window:
+                del self.latency_list[: len(self.latency_list) - self.latency_window]
+
+    def get_snapshot(self) -> dict:
+        with self.lock:
+            latency_ms = np.array(self.latency_list) * 1000
+            count_dict = dict(self.count_dict)
+        elapsed = time() - self.start_time
+        snapshot = {**count_dict, "uptime_sec": elapsed, "point_per_sec": count_dict["point"] / max(elapsed, 1e-9)}
+        for percentile in [50, 95, 99]:
+            latency = float(np.percentile(latency_ms, percentile)) if latency_ms.size else None
+            snapshot[f"latency_p{percentile}_ms"] = latency
+        return snapshot
+
+
+class CatchmentQueryService:
+    """
+    flow direction, flow accumulation and the donor graph loaded once and kept in memory.
+    a point is snapped to the cell with the largest flow accumulation within snap_radius,
+    the basin of the snapped outlet is traced upstream over the donor graph.
+    concurrent queries of the same outlet share one trace and recent basins are kept in an LRU cache
+    as run-length masks, a few bytes per row of the basin instead of 8 bytes per cell.
+    """
+
+    def __init__(self, catchment_area: CatchmentAreaArrangement, cache_size: int = 256):
+        self.catchment_area = catchment_area
+        self.flow_direction_array = np.asarray(catchment_area.flow_direction)
+        self.flow_accumulation_array = np.asarray(catchment_area.flow_accumulation)
+        self.array_shape = self.flow_direction_array.shape
+        receiver_index_array = catchment_area.get_receiver_index_array(self.flow_direction_array)
+        self.donor_index_pointer, self.donor_index_array = make_donor_csr(receiver_index_array)
+        self.cell_area_km2 = catchment_area.get_cell_area_km2()
+        self.cache_size = cache_size
+        self.basin_cache: OrderedDict[int, RunLengthMask] = OrderedDict()
+        self.in_flight_dict: dict[int, Future] = {}
+        self.lock = threading.Lock()
+        self.metrics = QueryMetrics()
+
+    def get_snapped_outlet(self, x: int, y: int, snap_radius: int) -> tuple[int, int]:
+        """cell with the largest flow accumulation within snap_radius, the nearest one on ties"""
+        y_size, x_size = self.array_shape
+        y_start, y_end = max(y - snap_radius, 0), min(y + snap_radius + 1, y_size)
+        x_start, x_end = max(x - snap_radius, 0), min(x + snap_radius + 1, x_size)
+        window = self.flow_accumulation_array[y_start:y_end, x_start:x_end].astype(np.float64)
+        window_y, window_x = np.mgrid[y_start:y_end, x_start:x_end]
+        distance = (window_x - x) ** 2 + (window_y - y) ** 2
+        best = np.lexsort((distance.ravel(), -window.ravel()))[0]
+        return int(window_x.ravel()[best]), int(window_y.ravel()[best])
+
+    def get_basin_mask(self, outlet_index: int) -> RunLengthMask:
+        """mask of the basin, from the cache, from a running trace of the same outlet or traced"""
+        with self.lock:
+            if outlet_index in self.basin_cache:
+                self.basin_cache.move_to_end(outlet_index)
+                self.metrics.add_count("cache_hit")
+                return self.basin_cache[outlet_index]
+            future = self.in_flight_dict.get(outlet_index)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.in_flight_dict[outlet_index] = future
+        if not is_owner:
+            self.metrics.add_count("coalesced")
+            return future.result()
+        try:
+            trace_upstream = kernel_registry.get("trace_upstream")
+            basin_index = trace_upstream(self.donor_index_pointer, self.donor_index_array, outlet_index)
+            basin_mask = RunLengthMask.from_index(self.array_shape, basin_index)
+            basin_mask.run_array.flags.writeable = False
+            self.metrics.add_count("traced")
+            future.set_result(basin_mask)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight_dict[outlet_index]
+                if future.exception() is None:
+                    self.basin_cache[outlet_index] = future.result()
+                    while len(self.basin_cache) > self.cache_size:
+                        self.basin_cache.popitem(last=False)
+        return basin_mask
+
+    def get_point_xy(self, point: dict) -> tuple[int, int]:
+        """cell of a point given as x and y, or as a coordinate [lon, lat] in the CRS of the layers"""
+        if "coordinate" in point:
+            return self.catchment_area.get_pixel_xy_from_coordinate(self.catchment_area.image_tag, point["coordinate"])
+        return int(point["x"]), int(point["y"])
+
+    def query_point(self, point: dict, include_list: list[str], snap_radius: int) -> dict:
+        x, y = self.get_point_xy(point)
+        if self.catchment_area.is_out_of_array(self.array_shape, x, y):
+            raise ValueError(f"({x}, {y}) is out of the scene")
+        outlet_x, outlet_y = self.get_snapped_outlet(x, y, snap_radius)
+        basin_mask = self.get_basin_mask(outlet_y * self.array_shape[1] + outlet_x)
+        bound_box = basin_mask.get_bound_box()
+        result = {
+            "x": x,
+            "y": y,
+            "outlet_x": outlet_x,
+            "outlet_y": outlet_y,
+            "upstream_cell_count": int(self.flow_accumulation_array[outlet_y, outlet_x]) + 1,
+            "cell_count": basin_mask.get_cell_cnt(),
+            "area_km2": basin_mask.get_area_km2(self.cell_area_km2),
+            "bound_box": bound_box,
+        }
+        if "mask" in include_list or "geojson" in include_list:
+            mask = basin_mask.to_array(bound_box)
+            if "mask" in include_list:
+                # rows of the bound box packed 8 cells per byte
+                result["mask"] = base64.b64encode(np.packbits(mask, axis=None).tobytes()).decode("ascii")
+            if "geojson" in include_list:
+                result["geojson"] = self.get_boundary_geometry(mask, bound_box)
+        return result
+
+    def get_boundary_geometry(self, mask: np.ndarray, bound_box: tuple[int, int, int, int]) -> dict:
+        """polygon of the mask in the bound box, a polygonizer per call as the queries run in threads"""
+        polygonizer = LabelPolygonizer()
+        polygonizer.set_tag(self.catchment_area._update_tag(self.catchment_area.image_tag, bound_box))
+        return next(polygonizer.iterate_feature(mask))["geometry"]
+
+    def get_query_setting(self, request: dict) -> tuple[list[str], int]:
+        """include and snap_radius of a request, TypeError or ValueError for a malformed request"""
+        if not isinstance(request, dict) or not isinstance(request.get("points"), list):
+            raise TypeError("points must be a list")
+        include_list = request.get("include", [])
+        if not isinstance(include_list, list):
+            raise TypeError("include must be a list")
+        snap_radius = int(request.get("snap_radius", 0))
+        if snap_radius < 0:
+            raise ValueError("snap_radius must not be negative")
+        return include_list, snap_radius
+
+    def query(self, request: dict) -> dict:
+        """
+        request: {"points": [{"x": , "y": } or {"coordinate": [lon, lat]}], "include": ["mask", "geojson"],
+        "snap_radius": cells}
+        """
+        start = perf_counter()
+        include_list, snap_radius = self.get_query_setting(request)
+        result_list = []
+        for point in request["points"]:
+            try:
+                result_list.append(self.query_point(point, include_list, snap_radius))
+            except (KeyError, TypeError, ValueError) as error:
+                self.metrics.add_count("error")
+                result_list.append({"error": repr(error)})
+        latency_sec = perf_counter() - start
+        self.metrics.add_count("request")
+        self.metrics.add_count("point", len(request["points"]))
+        self.metrics.add_latency(latency_sec)
+        return {"results": result_list, "elapsed_ms": latency_sec * 1000}
+
+
+class CatchmentRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /query?x=&y=&snap_radius=&include=mask,geojson, POST /query with a JSON body, GET /metrics, GET /health
+    """
+
+    service: CatchmentQueryService = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self.send_json({"status": "ok"})
+        elif url.path == "/metrics":
+            self.send_json(self.service.metrics.get_snapshot())
+        elif url.path == "/query":
+            parameter = {key: value[0] for key, value in parse_qs(url.query).items()}
+            try:
+                point = {"x": parameter["x"], "y": parameter["y"]}
+            except KeyError:
+                self.send_json({"error": "x and y are required"}, status=400)
+                return
+            include_list = [name for name in parameter.get("include", "").split(",") if name]
+            request = {"points": [point], "include": include_list, "snap_radius": parameter.get("snap_radius", 0)}
+            self.send_query(request)
+        else:
+            self.send_json({"error": f"unknown path {url.path}"}, status=404)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/query":
+            self.send_json({"error": f"unknown path {self.path}"}, status=404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as error:
+            self.send_json({"error": f"bad request: {error!r}"}, status=400)
+            return
+        self.send_query(request)
+
+    def send_query(self, request: dict):
+        """errors of single points are in the results, a malformed request as a whole is answered with 400"""
+        try:
+            response = self.service.query(request)
+        except (KeyError, TypeError, ValueError) as error:
+            self.service.metrics.add_count("error")
+            self.send_json({"error": f"bad request: {error!r}"}, status=400)
+            return
+        self.send_json(response)
+
+    def send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args):
+        logging.debug(format % args)
+
+
+class UnixSocketHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # the handler expects a (host, port) client address
+        return request, ("localhost", 0)
+
+
+def make_server(
+    service: CatchmentQueryService, host: str = "127.0.0.1", port: int = 8765, unix_socket_path: str = None
+) -> ThreadingHTTPServer:
+    handler = type("BoundCatchmentRequestHandler", (CatchmentRequestHandler,), {"service": service})
+    if unix_socket_path is not None:
+        return UnixSocketHTTPServer(unix_socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    main()
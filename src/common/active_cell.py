@@ -0,0 +1,76 @@
+import numpy as np
+
+from common.layer_dtype import LayerDtypePolicy
+
+
+class ActiveCellIndex:
+    """
+    valid (not nodata) cells of a scene, built once and shared by the stages.
+    active_index: flattened index of the valid cells in ascending order
+    row_run_array: (y, x_start, x_end) of every horizontal run of valid cells
+    nodata cells are regarded as outside of the scene: flow into them leaves the scene.
+    """
+
+    def __init__(self, array_shape: tuple[int, int], active_index: np.ndarray):
+        self.array_shape = array_shape
+        self.active_index = active_index
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, nodata: float) -> "ActiveCellIndex":
+        array_shape = np.shape(array)
+        index_dtype = LayerDtypePolicy().get_index_dtype(int(np.prod(array_shape)))
+        is_active = get_active_array(array, nodata)
+        return cls(array_shape, np.flatnonzero(is_active).astype(index_dtype))
+
+    def get_active_cnt(self) -> int:
+        return self.active_index.size
+
+    def get_active_ratio(self) -> float:
+        return self.active_index.size / max(int(np.prod(self.array_shape)), 1)
+
+    def is_all_active(self) -> bool:
+        return self.active_index.size == int(np.prod(self.array_shape))
+
+    def get_active_array(self) -> np.ndarray:
+        is_active = np.zeros(self.array_shape, dtype=np.bool_)
+        is_active.ravel()[self.active_index] = True
+        return is_active
+
+    def get_row_run_array(self) -> np.ndarray:
+        """(y, x_start, x_end) of the runs, a run breaks at a gap or at the end of a row"""
+        if self.active_index.size == 0:
+            return np.zeros((0, 3), dtype=np.int64)
+        x_size = self.array_shape[1]
+        is_run_start = np.ones(self.active_index.size, dtype=np.bool_)
+        is_run_start[1:] = (np.diff(self.active_index) != 1) | (self.active_index[1:] % x_size == 0)
+        run_start = self.active_index[is_run_start].astype(np.int64)
+        run_length = np.diff(np.append(np.flatnonzero(is_run_start), self.active_index.size))
+        y, x_start = np.divmod(run_start, x_size)
+        return np.stack([y, x_start, x_start + run_length], axis=1)
+
+    def get_position(self, flat_index: np.ndarray) -> np.ndarray:
+        """position of the cells in active_index, -1 for nodata cells and -1 itself"""
+        flat_index = np.asarray(flat_index)
+        if self.active_index.size == 0:
+            return np.full(flat_index.shape, -1, dtype=self.active_index.dtype)
+        position = np.searchsorted(self.active_index, flat_index).clip(max=self.active_index.size - 1)
+        is_found = (flat_index >= 0) & (self.active_index[position] == flat_index)
+        return np.where(is_found, position, -1).astype(self.active_index.dtype)
+
+    def gather(self, array: np.ndarray) -> np.ndarray:
+        return np.asarray(array).ravel()[self.active_index]
+
+    def scatter(self, active_value: np.ndarray, fill_value, dtype=None) -> np.ndarray:
+        """full array with active_value on the active cells and fill_value on the nodata cells"""
+        full_array = np.full(self.array_shape, fill_value, dtype=dtype or active_value.dtype)
+        full_array.ravel()[self.active_index] = active_value
+        return full_array
+
+
+def get_active_array(array: np.ndarray, nodata: float) -> np.ndarray:
+    """cells that are neither nodata nor nan"""
+    array = np.asarray(array)
+    is_active = array != nodata
+    if array.dtype.kind == "f":
+        is_active &= ~np.isnan(array)
+    return is_active
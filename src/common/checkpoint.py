@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import zipfile
+from time import time
+
+import numpy as np
+
+
+class Checkpoint:
+    """
+    checkpoints of pipeline stages in checkpoint_dir.
+    a finished stage is saved as {stage}.npz and partial progress of a stage as {stage}_progress.npz,
+    both with the hash of the inputs and settings they were derived from.
+    files are written to a temporary file and renamed, so a crash never leaves a broken checkpoint,
+    and a checkpoint is only reused when the hash is the same.
+    """
+
+    hash_chunk_size = 2**24
+
+    def __init__(self, checkpoint_dir: str, progress_interval_sec: float = 60.0):
+        self.checkpoint_dir = checkpoint_dir
+        self.progress_interval_sec = progress_interval_sec
+        self.last_progress_time = time()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def get_input_hash(self, array_list: list[np.ndarray], setting_dict: dict = None) -> str:
+        """sha256 of the shape, dtype and values of the arrays and of the settings"""
+        input_hash = hashlib.sha256()
+        for array in array_list:
+            array = np.asarray(array)
+            input_hash.update(f"{array.shape}{array.dtype.str}".encode())
+            flat_array = array.reshape(-1)
+            for start in range(0, flat_array.size, self.hash_chunk_size):
+                input_hash.update(np.ascontiguousarray(flat_array[start : start + self.hash_chunk_size]).tobytes())
+        input_hash.update(json.dumps(setting_dict or {}, sort_keys=True, default=str).encode())
+        return input_hash.hexdigest()
+
+    def get_path(self, stage: str, is_progress: bool = False) -> str:
+        file_name = f"{stage}_progress.npz" if is_progress else f"{stage}.npz"
+        return os.path.join(self.checkpoint_dir, file_name)
+
+    def save(self, stage: str, input_hash: str, **array_dict):
+        self.save_npz(self.get_path(stage), input_hash, array_dict)
+        self.remove_progress(stage)
+        logging.info(f"checkpoint {stage} saved")
+
+    def load(self, stage: str, input_hash: str) -> dict[str, np.ndarray]:
+        """arrays of the finished stage, None if there is no checkpoint for these inputs"""
+        return self.load_npz(self.get_path(stage), input_hash)
+
+    def save_progress(self, stage: str, input_hash: str, **array_dict):
+        self.save_npz(self.get_path(stage, is_progress=True), input_hash, array_dict)
+        self.last_progress_time = time()
+        logging.info(f"checkpoint {stage} progress saved")
+
+    def load_progress(self, stage: str, input_hash: str) -> dict[str, np.ndarray]:
+        return self.load_npz(self.get_path(stage, is_progress=True), input_hash)
+
+    def remove_progress(self, stage: str):
+        path = self.get_path(stage, is_progress=True)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def is_progress_due(self) -> bool:
+        """whether progress_interval_sec has passed since the last progress was saved"""
+        return time() - self.last_progress_time >= self.progress_interval_sec
+
+    def save_npz(self, path: str, input_hash: str, array_dict: dict[str, np.ndarray]):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.checkpoint_dir, suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                np.savez(file, input_hash=np.array(input_hash), **array_dict)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def load_npz(self, path: str, input_hash: str) -> dict[str, np.ndarray]:
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                if str(npz["input_hash"]) != input_hash:
+                    logging.info(f"checkpoint {path} is for other inputs and not used")
+                    return None
+                return {key: npz[key] for key in npz.files if key != "input_hash"}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+            logging.warning(f"checkpoint {path} is not readable and not used: {error}")
+            return None
@@ -48,7 +48,21 @@ class TiffTag:
     RowsPerStrip = 278
     StripByteCounts = 279
     PlanarConfiguration = 284
+    Predictor = 317
+    TileWidth = 322
+    TileLength = 323
+    TileOffsets = 324
+    TileByteCounts = 325
 
     GeoKeyDirectoryTag = 34735
     GeoDoubleParamsTag = 34736
     GeoAsciiParamsTag = 34737
+
+
+class GeoKey:
+    GTModelTypeGeoKey = 1024
+    ModelTypeProjected = 1
+    ModelTypeGeographic = 2
+    GTRasterTypeGeoKey = 1025
+    RasterPixelIsArea = 1
+    RasterPixelIsPoint = 2
@@ -0,0 +1,184 @@
+import logging
+import numpy as np
+
+from common.kernel import is_same_index_set
+from common.kernel import kernel_registry
+
+
+def make_donor_csr(receiver_index_array: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    donor cells of every cell in compressed sparse row form.
+    donors of cell i are donor_index_array[donor_index_pointer[i] : donor_index_pointer[i + 1]]
+    """
+    size = receiver_index_array.size
+    index_dtype = receiver_index_array.dtype
+    has_receiver = receiver_index_array >= 0
+    donor_index_array = np.flatnonzero(has_receiver).astype(index_dtype)
+    receiver_of_donor = receiver_index_array[donor_index_array]
+    donor_index_array = donor_index_array[np.argsort(receiver_of_donor, kind="stable")]
+    donor_count = np.bincount(receiver_of_donor, minlength=size)
+    donor_index_pointer = np.zeros(size + 1, dtype=index_dtype)
+    np.cumsum(donor_count, out=donor_index_pointer[1:])
+    return donor_index_pointer, donor_index_array
+
+
+def gather_donor(donor_index_pointer: np.ndarray, donor_index_array: np.ndarray, index: np.ndarray) -> np.ndarray:
+    """all donors of the given cells in one vectorized gather"""
+    start = donor_index_pointer[index]
+    length = donor_index_pointer[index + 1] - start
+    total = length.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offset = np.repeat(start - np.cumsum(length) + length, length)
+    return donor_index_array[offset + np.arange(total)]
+
+
+def trace_upstream_index(
+    donor_index_pointer: np.ndarray,
+    donor_index_array: np.ndarray,
+    outlet_index: int,
+) -> np.ndarray:
+    """flattened index of every cell draining to outlet_index (inclusive), breadth first from the outlet"""
+    is_visited = np.zeros(donor_index_pointer.size - 1, dtype=np.bool_)
+    frontier = np.array([outlet_index], dtype=np.int64)
+    is_visited[frontier] = True
+    upstream_list = [frontier]
+    while frontier.size > 0:
+        frontier = gather_donor(donor_index_pointer, donor_index_array, frontier)
+        frontier = frontier[~is_visited[frontier]]
+        is_visited[frontier] = True
+        upstream_list.append(frontier)
+    return np.concatenate(upstream_list)
+
+
+def trace_upstream_index_loop(
+    donor_index_pointer: np.ndarray,
+    donor_index_array: np.ndarray,
+    outlet_index: int,
+) -> np.ndarray:
+    """trace_upstream_index as a depth first loop over a stack (kernel "trace_upstream"), in another order"""
+    size = donor_index_pointer.size - 1
+    is_visited = np.zeros(size, dtype=np.bool_)
+    is_visited[outlet_index] = True
+    upstream_index = np.empty(size, dtype=np.int64)
+    upstream_index[0] = outlet_index
+    upstream_cnt = 1
+    stack = np.empty(size, dtype=np.int64)
+    stack[0] = outlet_index
+    stack_end = 1
+    while stack_end > 0:
+        stack_end -= 1
+        index = stack[stack_end]
+        for position in range(donor_index_pointer[index], donor_index_pointer[index + 1]):
+            donor = donor_index_array[position]
+            # a flow cycle leads back to a visited cell
+            if is_visited[donor]:
+                continue
+            is_visited[donor] = True
+            upstream_index[upstream_cnt] = donor
+            upstream_cnt += 1
+            stack[stack_end] = donor
+            stack_end += 1
+    return upstream_index[:upstream_cnt]
+
+
+kernel_registry.register("trace_upstream", trace_upstream_index, trace_upstream_index_loop, is_same_index_set)
+
+
+def get_topological_wave_list(receiver_index_array: np.ndarray) -> list[np.ndarray]:
+    """
+    cells grouped in waves so that every donor is in an earlier wave than its receiver.
+    cells on a flow cycle are never released and are left out with a warning.
+    """
+    size = receiver_index_array.size
+    has_receiver = receiver_index_array >= 0
+    remaining_donor_count = np.bincount(receiver_index_array[has_receiver], minlength=size)
+    # donors per cell are few (the neighbors), waves are kept in the dtype of the receiver
+    remaining_donor_count = remaining_donor_count.astype(np.min_scalar_type(remaining_donor_count.max(initial=0)))
+    index_dtype = receiver_index_array.dtype
+    frontier = np.flatnonzero(remaining_donor_count == 0).astype(index_dtype)
+    wave_list = []
+    released_cnt = 0
+    while frontier.size > 0:
+        wave_list.append(frontier)
+        released_cnt += frontier.size
+        receiver = receiver_index_array[frontier]
+        receiver = receiver[receiver >= 0]
+        np.subtract.at(remaining_donor_count, receiver, 1)
+        frontier = np.unique(receiver[remaining_donor_count[receiver] == 0])
+    if released_cnt < size:
+        logging.warning(f"{size - released_cnt} cells are on flow cycles and skipped")
+    return wave_list
+
+
+def accumulate_downstream(
+    receiver_index_array: np.ndarray,
+    weight_array: np.ndarray,
+    wave_list: list[np.ndarray] = None,
+    start_wave: int = 0,
+    wave_callback: callable = None,
+) -> np.ndarray:
+    """
+    weight of every cell plus the weights of all its upstream cells, in one topological pass.
+    to resume, weight_array is the flux after the waves before start_wave.
+    wave_callback(next_wave, flux_array) is called after every wave.
+    """
+    if wave_list is None:
+        wave_list = get_topological_wave_list(receiver_index_array)
+    flux_array = np.array(weight_array, copy=True).ravel()
+    for wave_index in range(start_wave, len(wave_list)):
+        wave = wave_list[wave_index]
+        receiver = receiver_index_array[wave]
+        has_receiver = receiver >= 0
+        np.add.at(flux_array, receiver[has_receiver], flux_array[wave[has_receiver]])
+        if wave_callback is not None:
+            wave_callback(wave_index + 1, flux_array)
+    return flux_array
+
+
+def get_terminal_index_array(receiver_index_array: np.ndarray, wave_list: list[np.ndarray] = None) -> np.ndarray:
+    """flattened index of the outlet (cell without receiver) that every cell finally drains to"""
+    if wave_list is None:
+        wave_list = get_topological_wave_list(receiver_index_array)
+    terminal_index_array = np.arange(receiver_index_array.size, dtype=np.int64)
+    for wave in reversed(wave_list):
+        receiver = receiver_index_array[wave]
+        has_receiver = receiver >= 0
+        terminal_index_array[wave[has_receiver]] = terminal_index_array[receiver[has_receiver]]
+    return terminal_index_array
+
+
+def accumulate_proportion_downstream(
+    flow_proportion_array: np.ndarray,
+    weight_array: np.ndarray,
+    neighbor_delta_xy: list[tuple[int, int]],
+    proportion_scale: int,
+) -> np.ndarray:
+    """
+    weight of every cell plus the proportional share of its upstream cells for multiple flow direction routing.
+    flow_proportion_array (neighbor, y, x) only points to neighbors inside the array.
+    cells are released wave by wave once all their donors are done, so every cell is visited once.
+    """
+    _, y_size, x_size = flow_proportion_array.shape
+    size = y_size * x_size
+    flat_proportion = flow_proportion_array.reshape(len(neighbor_delta_xy), size)
+    offset_list = [dy * x_size + dx for dx, dy in neighbor_delta_xy]
+    remaining_donor_count = np.zeros(size, dtype=np.int64)
+    for k, offset in enumerate(offset_list):
+        donor = np.flatnonzero(flat_proportion[k])
+        np.add.at(remaining_donor_count, donor + offset, 1)
+    flux_array = np.array(weight_array, dtype=np.float64).ravel()
+    frontier = np.flatnonzero(remaining_donor_count == 0)
+    while frontier.size > 0:
+        receiver_list = []
+        for k, offset in enumerate(offset_list):
+            proportion = flat_proportion[k, frontier]
+            has_flow = proportion > 0
+            donor = frontier[has_flow]
+            receiver = donor + offset
+            np.add.at(flux_array, receiver, flux_array[donor] * (proportion[has_flow] / proportion_scale))
+            np.subtract.at(remaining_donor_count, receiver, 1)
+            receiver_list.append(receiver)
+        receiver = np.concatenate(receiver_list)
+        frontier = np.unique(receiver[remaining_donor_count[receiver] == 0])
+    return flux_array
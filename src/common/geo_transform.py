@@ -0,0 +1,94 @@
+import numpy as np
+
+from common.figure_setting import GeoKey
+from common.figure_setting import TiffTag
+
+
+class GeoTransform:
+    """
+    affine transform between pixel and map coordinates of a north-up raster, built once from the GeoTIFF tags.
+    pixel x goes right and y down, the integer pixel (x, y) is the upper left corner of a cell and x + 0.5 its center.
+    x_origin, y_origin: map coordinate of the upper left corner of the raster
+    points and vertices are transformed as numpy arrays, scalars work too.
+    """
+
+    def __init__(
+        self,
+        x_origin: float,
+        y_origin: float,
+        x_resolution: float,
+        y_resolution: float,
+        array_shape: tuple[int, int] = None,
+    ):
+        self.x_origin = x_origin
+        self.y_origin = y_origin
+        self.x_resolution = x_resolution
+        self.y_resolution = y_resolution
+        self.array_shape = array_shape
+
+    @classmethod
+    def from_tag(cls, tag) -> "GeoTransform":
+        """
+        ModelTiepointTag (i, j, k, X, Y, Z) maps the raster point (i, j) to (X, Y).
+        with GTRasterTypeGeoKey PixelIsPoint the tiepoint refers to the center of a cell instead of its corner.
+        """
+        if TiffTag.ModelTiepointTag not in tag or TiffTag.ModelPixelScaleTag not in tag:
+            raise ValueError("ModelTiepointTag and ModelPixelScaleTag are required.")
+        i, j, _, x_tiepoint, y_tiepoint, _ = tag[TiffTag.ModelTiepointTag][:6]
+        x_resolution, y_resolution = tag[TiffTag.ModelPixelScaleTag][:2]
+        if get_geo_key_value(tag, GeoKey.GTRasterTypeGeoKey) == GeoKey.RasterPixelIsPoint:
+            i, j = i + 0.5, j + 0.5
+        array_shape = None
+        if TiffTag.ImageLength in tag and TiffTag.ImageWidth in tag:
+            array_shape = (int(tag[TiffTag.ImageLength][0]), int(tag[TiffTag.ImageWidth][0]))
+        x_origin, y_origin = x_tiepoint - i * x_resolution, y_tiepoint + j * y_resolution
+        return cls(x_origin, y_origin, x_resolution, y_resolution, array_shape)
+
+    @classmethod
+    def from_gdal(cls, geo_transform: tuple[float, ...], array_shape: tuple[int, int] = None) -> "GeoTransform":
+        """GDAL GetGeoTransform order (x_origin, x_resolution, 0, y_origin, 0, -y_resolution)"""
+        if geo_transform[2] != 0 or geo_transform[4] != 0:
+            raise ValueError("rotated geotransforms are not supported.")
+        return cls(geo_transform[0], geo_transform[3], geo_transform[1], -geo_transform[5], array_shape)
+
+    def to_gdal(self) -> tuple[float, float, float, float, float, float]:
+        return (self.x_origin, self.x_resolution, 0.0, self.y_origin, 0.0, -self.y_resolution)
+
+    def get_coordinate(self, x, y, is_center: bool = True) -> tuple[np.ndarray, np.ndarray]:
+        """map coordinates of cell centers (is_center) or of pixel corners"""
+        offset = 0.5 if is_center else 0.0
+        coordinate_x = self.x_origin + (np.asarray(x) + offset) * self.x_resolution
+        coordinate_y = self.y_origin - (np.asarray(y) + offset) * self.y_resolution
+        return coordinate_x, coordinate_y
+
+    def get_pixel_xy(self, coordinate_x, coordinate_y) -> tuple[np.ndarray, np.ndarray]:
+        """cell containing the map coordinates, outside the raster too (see is_inside)"""
+        x = np.floor((np.asarray(coordinate_x) - self.x_origin) / self.x_resolution).astype(np.int64)
+        y = np.floor((self.y_origin - np.asarray(coordinate_y)) / self.y_resolution).astype(np.int64)
+        return x, y
+
+    def is_inside(self, x, y, array_shape: tuple[int, int] = None) -> np.ndarray:
+        array_shape = self.array_shape if array_shape is None else array_shape
+        if array_shape is None:
+            raise ValueError("array_shape is unknown.")
+        x, y = np.asarray(x), np.asarray(y)
+        return (0 <= x) & (x < array_shape[1]) & (0 <= y) & (y < array_shape[0])
+
+    def get_window(self, bound_box: tuple[int, int, int, int]) -> "GeoTransform":
+        """transform of the crop (left, upper, right, lower) as PIL.Image.crop"""
+        left, upper, right, lower = bound_box
+        x_origin, y_origin = self.get_coordinate(left, upper, is_center=False)
+        return GeoTransform(
+            float(x_origin), float(y_origin), self.x_resolution, self.y_resolution, (lower - upper, right - left)
+        )
+
+
+def get_geo_key_value(tag, geo_key: int) -> int:
+    """value of a short geo key in GeoKeyDirectoryTag, None if it is not set"""
+    geo_key_directory = tag.get(TiffTag.GeoKeyDirectoryTag)
+    if geo_key_directory is None:
+        return None
+    for i in range(4, len(geo_key_directory), 4):
+        if geo_key_directory[i] == geo_key:
+            return geo_key_directory[i + 3]
+    return None
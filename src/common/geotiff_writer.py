@@ -0,0 +1,308 @@
+import io
+import logging
+import os
+import struct
+import zlib
+from time import time
+
+import numpy as np
+from PIL import features
+from PIL import Image
+
+from common.figure_setting import TiffTag
+
+
+class LZWCompression:
+    """
+    TIFF LZW (MSB-first codes, 9 to 12 bits, early change) for the writer.
+    the libtiff encoder of Pillow is used when Pillow is built with libtiff,
+    the Python loop otherwise (about 1-2 MB/s, prefer deflate for large layers).
+    """
+
+    CLEAR_CODE = 256
+    END_OF_INFORMATION = 257
+    FIRST_CODE = 258
+    MAX_CODE = 4093
+    is_slow_warned = False
+
+    def compress(self, data: bytes) -> bytes:
+        if len(data) > 0 and features.check("libtiff"):
+            return self.compress_with_libtiff(data)
+        if not LZWCompression.is_slow_warned and len(data) > 0:
+            logging.warning("Pillow without libtiff, LZW runs in Python at about 1-2 MB/s, deflate is faster")
+            LZWCompression.is_slow_warned = True
+        return self.compress_in_python(data)
+
+    def compress_with_libtiff(self, data: bytes) -> bytes:
+        """data as the single strip of a one row TIFF, the compressed strip is cut out of the file"""
+        image = Image.frombuffer("L", (len(data), 1), data, "raw", "L", 0, 1)
+        buffer = io.BytesIO()
+        image.save(buffer, format="TIFF", compression="tiff_lzw")
+        with Image.open(buffer) as saved:
+            strip_offset, strip_byte_cnt = saved.tag_v2[273][0], saved.tag_v2[279][0]
+        return buffer.getbuffer()[strip_offset : strip_offset + strip_byte_cnt].tobytes()
+
+    def compress_in_python(self, data: bytes) -> bytes:
+        output = bytearray()
+        bit_buffer = 0
+        bit_cnt = 0
+
+        def emit(code: int, code_width: int):
+            nonlocal bit_buffer, bit_cnt
+            bit_buffer = (bit_buffer << code_width) | code
+            bit_cnt += code_width
+            while bit_cnt >= 8:
+                bit_cnt -= 8
+                output.append((bit_buffer >> bit_cnt) & 0xFF)
+            bit_buffer &= (1 << bit_cnt) - 1
+
+        code_width = 9
+        emit(self.CLEAR_CODE, code_width)
+        if len(data) == 0:
+            emit(self.END_OF_INFORMATION, code_width)
+            return bytes(output)
+        table = {}
+        next_code = self.FIRST_CODE
+        prefix = data[0]
+        for byte in data[1:]:
+            key = (prefix << 8) | byte
+            code = table.get(key)
+            if code is not None:
+                prefix = code
+                continue
+            emit(prefix, code_width)
+            prefix = byte
+            if next_code == self.MAX_CODE:
+                emit(self.CLEAR_CODE, code_width)
+                table = {}
+                next_code = self.FIRST_CODE
+                code_width = 9
+                continue
+            table[key] = next_code
+            next_code += 1
+            if next_code == 1 << code_width:
+                code_width += 1
+        emit(prefix, code_width)
+        # the decoder adds one more entry after the last code
+        next_code += 1
+        if next_code == self.MAX_CODE + 1:
+            emit(self.CLEAR_CODE, code_width)
+            code_width = 9
+        elif next_code == 1 << code_width:
+            code_width += 1
+        emit(self.END_OF_INFORMATION, code_width)
+        if bit_cnt > 0:
+            output.append((bit_buffer << (8 - bit_cnt)) & 0xFF)
+        return bytes(output)
+
+
+class GeoTiffWriter:
+    """
+    single band tiled GeoTIFF with DEFLATE or LZW compression and horizontal or floating point predictor.
+    tiles are compressed and written one by one, so an array (or memmap) is streamed without a full copy.
+    BigTIFF (64 bit offsets) is written when the file could exceed 4 GiB.
+    GeoKey, ModelTiepoint, ModelPixelScale and GDAL tags of the source tag are kept.
+    """
+
+    COMPRESSION_CODE = {"none": 1, "lzw": 5, "deflate": 8}
+    PREDICTOR_CODE = {None: 1, "horizontal": 2, "floating_point": 3}
+    SAMPLE_FORMAT_CODE = {"u": 1, "b": 1, "i": 2, "f": 3}
+    # tag type: 2 ASCII, 3 SHORT, 4 LONG, 12 DOUBLE, 16 LONG8 (BigTIFF)
+    TYPE_FORMAT = {2: "s", 3: "H", 4: "I", 12: "d", 16: "Q"}
+    # LZW codes of up to 12 bits per input byte, deflate stored blocks add 5 bytes per 64 KiB
+    EXPANSION_RATIO = {"none": 1.0, "lzw": 1.5, "deflate": 1.01}
+    # ASCII and DOUBLE tags and the IFD itself, besides the tile offsets and byte counts
+    TAG_BYTE_MARGIN = 2**20
+    GEO_TAG_TYPE = {
+        TiffTag.ModelPixelScaleTag: 12,
+        TiffTag.ModelTiepointTag: 12,
+        TiffTag.GeoKeyDirectoryTag: 3,
+        TiffTag.GeoDoubleParamsTag: 12,
+        TiffTag.GeoAsciiParamsTag: 2,
+        TiffTag.GDAL_METADATA: 2,
+        TiffTag.GDAL_NODATA: 2,
+    }
+
+    def __init__(
+        self,
+        path: str,
+        array_shape: tuple[int, int],
+        dtype: np.dtype,
+        tag=None,
+        tile_size: int = 256,
+        compression: str = "deflate",
+        predictor: str = None,
+        level: int = 6,
+        is_bigtiff: bool = None,
+    ):
+        """is_bigtiff: None for BigTIFF only when the file could exceed 4 GiB"""
+        if compression not in self.COMPRESSION_CODE:
+            raise ValueError("compression must be none, lzw or deflate")
+        if predictor not in self.PREDICTOR_CODE:
+            raise ValueError("predictor must be None, horizontal or floating_point")
+        self.dtype = np.dtype(np.uint8) if np.dtype(dtype) == np.bool_ else np.dtype(dtype).newbyteorder("<")
+        if predictor == "floating_point" and self.dtype.kind != "f":
+            raise ValueError("floating_point predictor is only for float data")
+        if predictor is not None and compression == "none":
+            raise ValueError("predictor is only for lzw or deflate")
+        if tile_size % 16 != 0:
+            raise ValueError("tile_size must be a multiple of 16")
+        self.path = path
+        self.array_shape = array_shape
+        self.tag = tag or {}
+        self.tile_size = tile_size
+        self.compression = compression
+        self.predictor = predictor
+        self.level = level
+        self.tile_y_cnt = -(-array_shape[0] // tile_size)
+        self.tile_x_cnt = -(-array_shape[1] // tile_size)
+        self.tile_offsets = np.zeros(self.tile_y_cnt * self.tile_x_cnt, dtype=np.int64)
+        self.tile_byte_counts = np.zeros(self.tile_y_cnt * self.tile_x_cnt, dtype=np.int64)
+        self.raw_byte_cnt = 0
+        self.is_bigtiff = self.get_max_file_byte_cnt() >= 2**32 if is_bigtiff is None else is_bigtiff
+        self.file = None
+        self.start = None
+
+    def get_max_file_byte_cnt(self) -> int:
+        """upper bound of the file size: every padded tile at its worst compression, with its offset and count"""
+        tile_cnt = self.tile_y_cnt * self.tile_x_cnt
+        tile_byte_cnt = self.tile_size * self.tile_size * self.dtype.itemsize
+        tile_max_byte_cnt = int(tile_byte_cnt * self.EXPANSION_RATIO[self.compression]) + 64
+        return tile_cnt * (tile_max_byte_cnt + 1 + 16) + self.TAG_BYTE_MARGIN
+
+    def __enter__(self) -> "GeoTiffWriter":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.file is not None:
+            self.file.close()
+
+    def open(self):
+        self.start = time()
+        self.file = open(self.path, "wb")
+        if self.is_bigtiff:
+            self.file.write(b"II+\x00" + struct.pack("<HHQ", 8, 0, 0))
+        else:
+            self.file.write(b"II*\x00" + struct.pack("<I", 0))
+
+    def write_array(self, array: np.ndarray):
+        for tile_y in range(self.tile_y_cnt):
+            for tile_x in range(self.tile_x_cnt):
+                y_start, x_start = tile_y * self.tile_size, tile_x * self.tile_size
+                tile = array[y_start : y_start + self.tile_size, x_start : x_start + self.tile_size]
+                self.write_tile(tile_y, tile_x, tile)
+
+    def write_tile(self, tile_y: int, tile_x: int, tile: np.ndarray):
+        """tile of (at most) tile_size x tile_size, edge tiles are padded with zeros"""
+        padded = np.zeros((self.tile_size, self.tile_size), dtype=self.dtype)
+        padded[: tile.shape[0], : tile.shape[1]] = tile
+        data = self.encode_tile(padded)
+        self.raw_byte_cnt += tile.size * self.dtype.itemsize
+        tile_index = tile_y * self.tile_x_cnt + tile_x
+        if self.file.tell() % 2 == 1:
+            self.file.write(b"\x00")
+        self.tile_offsets[tile_index] = self.file.tell()
+        self.tile_byte_counts[tile_index] = len(data)
+        self.file.write(data)
+
+    def encode_tile(self, tile: np.ndarray) -> bytes:
+        if self.predictor == "horizontal":
+            integer_tile = tile.view(f"<u{self.dtype.itemsize}").copy()
+            integer_tile[:, 1:] = integer_tile[:, 1:] - integer_tile[:, :-1]
+            data = integer_tile.tobytes()
+        elif self.predictor == "floating_point":
+            # byte planes of every row from the most significant byte, then byte-wise differencing
+            byte_tile = tile.view(np.uint8).reshape(self.tile_size, self.tile_size, self.dtype.itemsize)
+            byte_tile = byte_tile[:, :, ::-1].transpose(0, 2, 1).reshape(self.tile_size, -1)
+            byte_tile = np.concatenate([byte_tile[:, :1], np.diff(byte_tile, axis=1)], axis=1)
+            data = byte_tile.astype(np.uint8).tobytes()
+        else:
+            data = tile.tobytes()
+        if self.compression == "deflate":
+            return zlib.compress(data, self.level)
+        elif self.compression == "lzw":
+            return LZWCompression().compress(data)
+        return data
+
+    def close(self) -> dict[str, float]:
+        entry_list = self.make_ifd_entry_list()
+        if self.file.tell() % 2 == 1:
+            self.file.write(b"\x00")
+        ifd_offset = self.file.tell()
+        self.write_ifd(entry_list, ifd_offset)
+        if self.is_bigtiff:
+            self.file.seek(8)
+            self.file.write(struct.pack("<Q", ifd_offset))
+        else:
+            self.file.seek(4)
+            self.file.write(struct.pack("<I", ifd_offset))
+        self.file.close()
+        self.file = None
+        return self.report()
+
+    def make_ifd_entry_list(self) -> list[tuple[int, int, tuple]]:
+        sample_format = self.SAMPLE_FORMAT_CODE[self.dtype.kind]
+        offset_type = 16 if self.is_bigtiff else 4
+        entry_list = [
+            (TiffTag.ImageWidth, 4, (self.array_shape[1],)),
+            (TiffTag.ImageLength, 4, (self.array_shape[0],)),
+            (TiffTag.BitsPerSample, 3, (self.dtype.itemsize * 8,)),
+            (TiffTag.Compression, 3, (self.COMPRESSION_CODE[self.compression],)),
+            (TiffTag.PhotometricInterpretation, 3, (1,)),
+            (TiffTag.SamplesPerPixel, 3, (1,)),
+            (TiffTag.PlanarConfiguration, 3, (1,)),
+            (TiffTag.Predictor, 3, (self.PREDICTOR_CODE[self.predictor],)),
+            (TiffTag.TileWidth, 4, (self.tile_size,)),
+            (TiffTag.TileLength, 4, (self.tile_size,)),
+            (TiffTag.TileOffsets, offset_type, tuple(self.tile_offsets.tolist())),
+            (TiffTag.TileByteCounts, offset_type, tuple(self.tile_byte_counts.tolist())),
+            (TiffTag.SampleFormat, 3, (sample_format,)),
+        ]
+        for tag_id, tag_type in self.GEO_TAG_TYPE.items():
+            if tag_id in self.tag:
+                entry_list.append((tag_id, tag_type, tuple(self.tag[tag_id])))
+        return sorted(entry_list)
+
+    def write_ifd(self, entry_list: list[tuple[int, int, tuple]], ifd_offset: int):
+        """IFD followed by the values that do not fit in 4 bytes (8 bytes in BigTIFF)"""
+        # entry count, tag, type, value count, value or offset, next IFD offset
+        count_format, entry_format, offset_format = ("Q", "HHQ", "Q") if self.is_bigtiff else ("H", "HHI", "I")
+        entry_byte_cnt = struct.calcsize(f"<{entry_format}{offset_format}")
+        inline_byte_cnt = struct.calcsize(offset_format)
+        value_offset = ifd_offset + struct.calcsize(count_format) + entry_byte_cnt * len(entry_list) + inline_byte_cnt
+        ifd = bytearray(struct.pack(f"<{count_format}", len(entry_list)))
+        value_area = bytearray()
+        for tag_id, tag_type, value in entry_list:
+            if tag_type == 2:
+                data = ("".join(value) + "\x00").encode("ascii", errors="replace")
+                count = len(data)
+            else:
+                data = struct.pack(f"<{len(value)}{self.TYPE_FORMAT[tag_type]}", *value)
+                count = len(value)
+            if len(data) <= inline_byte_cnt:
+                ifd += struct.pack(f"<{entry_format}", tag_id, tag_type, count) + data.ljust(inline_byte_cnt, b"\x00")
+            else:
+                value_position = value_offset + len(value_area)
+                ifd += struct.pack(f"<{entry_format}{offset_format}", tag_id, tag_type, count, value_position)
+                value_area += data
+                if len(value_area) % 2 == 1:
+                    value_area += b"\x00"
+        ifd += struct.pack(f"<{offset_format}", 0)
+        self.file.write(ifd + value_area)
+
+    def report(self) -> dict[str, float]:
+        elapsed = max(time() - self.start, 1e-9)
+        file_byte_cnt = os.path.getsize(self.path)
+        report = {
+            "compression_ratio": self.raw_byte_cnt / max(file_byte_cnt, 1),
+            "throughput_mb_per_sec": self.raw_byte_cnt / elapsed / 2**20,
+            "file_mb": file_byte_cnt / 2**20,
+        }
+        logging.info(
+            f"{os.path.basename(self.path)}: {self.compression} ratio x{report['compression_ratio']:.2f}, "
+            f"{report['throughput_mb_per_sec']:.1f} MB/s"
+        )
+        return report
@@ -3,8 +3,14 @@ import numpy as np
 from PIL import Image
 from common.figure_setting import FigureSetting
 from common.figure_setting import TiffTag
+from common.figure_setting import GeoKey
+from common.geo_transform import GeoTransform
+from common.geo_transform import get_geo_key_value
+from common.geotiff_writer import GeoTiffWriter
+from common.kernel import kernel_registry
+from common.overview import Overview
+from common.run_length_mask import RunLengthMask
 from common.util import save_json
-from common.util import make_neighbor_xy
 from common.setting import ValueSetting
 from copy import deepcopy
 
@@ -21,6 +27,25 @@ class CommonImageProcessing:
 
     def set_tag(self, tag):
         self.image_tag = tag
+        self.geo_transform = None
+
+    def get_geo_transform(self, tag=None) -> GeoTransform:
+        """transform of the image tag (built once and cached) or of another tag"""
+        if tag is None or tag is self.image_tag:
+            if self.geo_transform is None:
+                self.geo_transform = GeoTransform.from_tag(self.image_tag)
+            return self.geo_transform
+        return GeoTransform.from_tag(tag)
+
+    def get_nodata(self, tag=None) -> float:
+        """GDAL_NODATA tag of the image if it has one, otherwise the configured nodata"""
+        tag = self.image_tag if tag is None else tag
+        if tag is None or TiffTag.GDAL_NODATA not in tag:
+            return self.nodata
+        nodata = tag[TiffTag.GDAL_NODATA]
+        if isinstance(nodata, tuple):
+            nodata = nodata[0]
+        return float(str(nodata).strip("\x00 "))
 
     def get_x_resolution(self, tag):
         return tag[TiffTag.ModelPixelScaleTag][0]
@@ -34,13 +59,43 @@ class CommonImageProcessing:
     def get_y_origin(self, tag):
         return tag[TiffTag.ModelTiepointTag][4]
 
+    def get_model_type(self, tag) -> int:
+        """GTModelTypeGeoKey in GeoKeyDirectoryTag: 1 projected, 2 geographic"""
+        return get_geo_key_value(tag, GeoKey.GTModelTypeGeoKey)
+
+    def is_geographic_crs(self, tag) -> bool:
+        return self.get_model_type(tag) == GeoKey.ModelTypeGeographic
+
+    def get_center_latitude(self, tag) -> float:
+        height = tag[TiffTag.ImageLength][0]
+        return self.get_y_origin(tag) - self.get_y_resolution(tag) * height / 2
+
     def change_resolution_to_km(self, resolution: tuple[float, float, float]) -> tuple[float, float, float]:
-        crs_info = self.image_tag[TiffTag.GeoAsciiParamsTag][0]
-        if "JGD_2011" in crs_info or "JGD2011" in crs_info:
-            pass
+        """
+        pixel scale of the image tag to km.
+        degrees are converted at the center latitude of the image, other units are regarded as meter.
+        """
+        if not self.is_geographic_crs(self.image_tag):
+            return (resolution[0] / 1000, resolution[1] / 1000, resolution[2])
+        latitude = np.deg2rad(self.get_center_latitude(self.image_tag))
+        km_per_degree_x = ValueSetting.km_per_degree * np.cos(latitude)
+        km_per_degree_y = ValueSetting.km_per_degree
+        return (resolution[0] * km_per_degree_x, resolution[1] * km_per_degree_y, resolution[2])
+
+    def get_cell_area_km2(self) -> float:
+        x_resolution_km, y_resolution_km, _ = self.change_resolution_to_km(
+            self.image_tag[TiffTag.ModelPixelScaleTag]
+        )
+        return x_resolution_km * y_resolution_km
+
+    def get_pixel_xy_from_coordinate(self, tag, coordinate: list[float, float]) -> tuple[int, int]:
+        """cell containing the coordinate, negative or beyond the size outside the image"""
+        x, y = self.get_geo_transform(tag).get_pixel_xy(coordinate[0], coordinate[1])
+        return int(x), int(y)
 
     def set_coordinate_info(self, geo_transform: tuple[float, float, float, float, float, float]):
-        self.geo_transform = geo_transform
+        """GDAL geotransform (x_origin, x_resolution, 0, y_origin, 0, -y_resolution) instead of the tag"""
+        self.geo_transform = GeoTransform.from_gdal(geo_transform)
 
     def is_out_of_array(self, array_size: tuple[int, int], x: int, y: int) -> bool:
         if (0 <= y < array_size[0]) and (0 <= x < array_size[1]):
@@ -52,24 +107,99 @@ class CommonImageProcessing:
 class PILProcessing(CommonImageProcessing):
     def __init__(self):
         super().__init__()
+        self.use_memmap = False
+        self.tiff_compression = None
+        self.tiff_predictor = None
+        self.tiff_tile_size = 256
+        self.is_saving_overview = False
+        self.preview_max_size = 1024
+
+    def set_use_memmap(self, use_memmap: bool):
+        self.use_memmap = use_memmap
+
+    def set_tiff_compression(self, compression: str, predictor: str = "auto", tile_size: int = 256):
+        """
+        save_tiff writes tiled GeoTIFF with lzw or deflate (None restores the PIL writer).
+        predictor "auto" is horizontal for integer and floating_point for float layers.
+        """
+        self.tiff_compression = compression
+        self.tiff_predictor = predictor
+        self.tiff_tile_size = tile_size
 
     def open_image(self, file_path: str) -> Image.Image:
         image = Image.open(file_path)
         self.set_tag(image.tag)
         return image
 
+    def open_layer(self, file_path: str) -> Image.Image | np.ndarray:
+        """numpy.memmap if use_memmap is set, otherwise PIL image"""
+        if self.use_memmap:
+            return self.open_image_memmap(file_path)
+        return self.open_image(file_path)
+
+    def open_image_memmap(self, file_path: str) -> np.ndarray:
+        """
+        numpy.memmap straight onto the pixel data of an uncompressed single band strip TIFF.
+        PIL only parses the header here; compressed, tiled or multi band files are decoded by PIL instead.
+        """
+        with Image.open(file_path) as image:
+            tag = image.tag
+            self.set_tag(tag)
+            dtype = self.get_memmap_dtype(file_path, tag)
+            offset = self.get_contiguous_strip_offset(tag, dtype)
+            if dtype is None or offset is None:
+                print("decode", file_path, "with PIL")
+                return np.array(image)
+        array_shape = (tag[TiffTag.ImageLength][0], tag[TiffTag.ImageWidth][0])
+        return np.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=array_shape)
+
+    def get_memmap_dtype(self, file_path: str, tag) -> np.dtype:
+        """dtype from BitsPerSample and SampleFormat, None if the file can not be mapped as is"""
+        if tag.get(TiffTag.Compression, (1,))[0] != 1:
+            return None
+        if tag.get(TiffTag.SamplesPerPixel, (1,))[0] != 1 or TiffTag.TileOffsets in tag:
+            return None
+        bits_per_sample = tag.get(TiffTag.BitsPerSample, (1,))[0]
+        sample_format = tag.get(TiffTag.SampleFormat, (1,))[0]
+        kind = {1: "u", 2: "i", 3: "f"}.get(sample_format)
+        if kind is None or bits_per_sample not in [8, 16, 32, 64]:
+            return None
+        with open(file_path, "rb") as file:
+            byte_order = "<" if file.read(2) == b"II" else ">"
+        return np.dtype(f"{byte_order}{kind}{bits_per_sample // 8}")
+
+    def get_contiguous_strip_offset(self, tag, dtype: np.dtype) -> int:
+        """offset of the first strip if all strips follow each other without gaps, otherwise None"""
+        if dtype is None:
+            return None
+        strip_offsets = np.array(tag[TiffTag.StripOffsets], dtype=np.int64)
+        strip_byte_counts = np.array(tag[TiffTag.StripByteCounts], dtype=np.int64)
+        if np.any(strip_offsets[1:] != strip_offsets[:-1] + strip_byte_counts[:-1]):
+            return None
+        image_bytes = tag[TiffTag.ImageLength][0] * tag[TiffTag.ImageWidth][0] * dtype.itemsize
+        if strip_byte_counts.sum() != image_bytes:
+            return None
+        return int(strip_offsets[0])
+
     def open_image_from_array(self, array: list[list[int]]) -> Image.Image:
         image = Image.fromarray(array)
         image.tag = self.image_tag
         return image
 
     def get_array_shape_from_image(self, image: Image) -> tuple[int, int]:
+        if isinstance(image, np.ndarray):
+            return image.shape
         return image.height, image.width
 
     def save_tiff(self, image: Image.Image, file_name: str, **kwargs):
         os.makedirs(self.save_dir, exist_ok=True)
         if image is None:
             return
+        if self.tiff_compression is not None:
+            self.save_compressed_tiff(image, file_name)
+            return
+        if isinstance(image, np.ndarray):
+            image = self.open_image_from_array(np.asarray(image))
         if image.mode in ["1", "L", "P", "I"]:
             setting = FigureSetting.integer_tiff
         else:
@@ -78,7 +208,81 @@ class PILProcessing(CommonImageProcessing):
         path = os.path.join(self.save_dir, file_name + ".tif")
         image.save(path, **kwargs, **setting, tiffinfo=image.tag)
 
+    def save_compressed_tiff(self, image: Image.Image | np.ndarray, file_name: str) -> dict[str, float]:
+        """tiled GeoTIFF through GeoTiffWriter, memmap layers are streamed tile by tile"""
+        array = image if isinstance(image, np.ndarray) else np.asarray(image)
+        tag = self.get_image_tag(image)
+        predictor = self.tiff_predictor
+        if predictor == "auto":
+            predictor = "floating_point" if array.dtype.kind == "f" else "horizontal"
+        if self.tiff_compression == "none" or array.dtype == np.bool_:
+            predictor = None
+        print("save", file_name, self.tiff_compression, predictor)
+        path = os.path.join(self.save_dir, file_name + ".tif")
+        writer = GeoTiffWriter(
+            path,
+            array.shape,
+            array.dtype,
+            tag,
+            tile_size=self.tiff_tile_size,
+            compression=self.tiff_compression,
+            predictor=predictor,
+        )
+        writer.open()
+        writer.write_array(array)
+        return writer.close()
+
+    def get_image_tag(self, image: Image.Image | np.ndarray):
+        """tag of the image itself (e.g., of a crop), the scene tag for a bare array"""
+        if isinstance(image, np.ndarray):
+            return self.image_tag
+        return getattr(image, "tag", self.image_tag)
+
+    def set_overview_setting(self, is_saving_overview: bool, preview_max_size: int = 1024):
+        self.is_saving_overview = is_saving_overview
+        self.preview_max_size = preview_max_size
+
+    def save_overview(self, image: Image.Image | np.ndarray, file_name: str, reduction: str) -> list[np.ndarray]:
+        """
+        reduced levels as {file_name}_ovr{factor}.tif if is_saving_overview is set, the levels are returned
+        for save_preview. None without building any level if the image is None or overviews are not saved.
+        """
+        if image is None or not self.is_saving_overview:
+            return None
+        array = image if isinstance(image, np.ndarray) else np.asarray(image)
+        overview = Overview(reduction, min_size=self.preview_max_size // 2)
+        level_list = overview.build_level_list(array)
+        os.makedirs(self.save_dir, exist_ok=True)
+        print("save", file_name, "overviews", [level.shape for level in level_list[1:]])
+        path_base = os.path.join(self.save_dir, file_name)
+        compression = self.tiff_compression or "deflate"
+        overview.save_level_list(level_list, self.get_image_tag(image), path_base, compression=compression)
+        return level_list
+
+    def save_preview(
+        self,
+        image: Image.Image | np.ndarray,
+        file_name: str,
+        reduction: str,
+        is_log_scale: bool = False,
+        level_list: list[np.ndarray] = None,
+    ):
+        """
+        quick look PNG from the smallest fitting overview level instead of the full resolution image,
+        the levels are built here unless given by save_overview
+        """
+        os.makedirs(self.save_dir, exist_ok=True)
+        if image is None:
+            return
+        overview = Overview(reduction, min_size=self.preview_max_size // 2)
+        if level_list is None:
+            level_list = overview.build_level_list(image if isinstance(image, np.ndarray) else np.asarray(image))
+        preview = overview.render_preview(level_list, max_size=self.preview_max_size, is_log_scale=is_log_scale)
+        preview.save(os.path.join(self.save_dir, file_name + ".png"), format="png")
+
     def save_mono_tiff(self, image: Image.Image, file_name: str, **kwargs):
+        if isinstance(image, np.ndarray):
+            image = self.open_image_from_array(np.asarray(image))
         image = self.convert_image_mono(image)
         self.save_tiff(image, file_name, **kwargs)
 
@@ -86,6 +290,8 @@ class PILProcessing(CommonImageProcessing):
         os.makedirs(self.save_dir, exist_ok=True)
         if image is None:
             return
+        if isinstance(image, np.ndarray):
+            image = self.open_image_from_array(np.asarray(image))
         if image.mode in ["1", "L", "P", "I"]:
             setting = FigureSetting.integer_png
         else:
@@ -94,11 +300,13 @@ class PILProcessing(CommonImageProcessing):
         image.save(path, **kwargs, **setting, tiffinfo=image.tag)
 
     def save_mono_png(self, image: Image.Image, file_name: str, **kwargs):
+        if isinstance(image, np.ndarray):
+            image = self.open_image_from_array(np.asarray(image))
         image = self.convert_image_mono(image)
         self.save_png(image, file_name, **kwargs)
 
     def close_image(self, image: Image.Image):
-        if image is not None:
+        if isinstance(image, Image.Image):
             image.close()
 
     def convert_image_mono(self, image: Image.Image) -> Image.Image:
@@ -112,10 +320,12 @@ class PILProcessing(CommonImageProcessing):
                     new_image.putpixel((x, y), 1)
         return new_image
 
-    def crop_image(self, image: Image.Image, bound_box: tuple[int, int, int, int]) -> Image.Image:
+    def crop_image(self, image: Image.Image, bound_box: tuple[int, int, int, int] | RunLengthMask) -> Image.Image:
         """
-        bound_box: (left, upper, right, lower)
+        bound_box: (left, upper, right, lower), or a RunLengthMask for its bound box
         """
+        if isinstance(bound_box, RunLengthMask):
+            bound_box = bound_box.get_bound_box()
         new_image = image.crop(bound_box)
         new_image.tag = self._update_tag(image.tag, bound_box)
         return new_image
@@ -171,6 +381,7 @@ class GeoJsonProcessing(CommonImageProcessing):
     def __init__(self):
         super().__init__()
         self.saved_tiff = None
+        self.saved_geo_transform = None
 
     def save_tiff_as_geojson(self, tiff: bytes, file_name: str):
         self.set_saved_tiff(tiff)
@@ -182,6 +393,7 @@ class GeoJsonProcessing(CommonImageProcessing):
 
     def set_saved_tiff(self, tiff: bytes):
         self.saved_tiff = tiff
+        self.saved_geo_transform = GeoTransform.from_tag(tiff.tag)
 
     def get_geojson_template(self):
         return {
@@ -202,7 +414,10 @@ class GeoJsonProcessing(CommonImageProcessing):
         }
 
     def get_crs_from_tiff(self) -> str:
-        crs_info = self.saved_tiff.tag[TiffTag.GeoAsciiParamsTag][0]
+        return self.get_crs_from_tag(self.saved_tiff.tag)
+
+    def get_crs_from_tag(self, tag) -> str:
+        crs_info = tag[TiffTag.GeoAsciiParamsTag][0] if TiffTag.GeoAsciiParamsTag in tag else None
         if crs_info is None:
             return None
         elif "JGD_2011" in crs_info or "JGD2011" in crs_info:
@@ -219,11 +434,12 @@ class GeoJsonProcessing(CommonImageProcessing):
     def get_coordinates_geometry_from_tiff(self) -> dict[str, any]:
         array = np.array(self.saved_tiff)
         geometry = {"type": "Polygon", "coordinates": [[None]]}
-        coordinates = []
         sx, sy = self.search_start_point(array)
-        coordinates.append(self.get_coordinates(sx, sy))
-        coordinates += self.get_continuous_coordinates(sx, sy)
-        geometry["coordinates"] = [coordinates]
+        xy_array = np.concatenate([[(sx, sy)], self.get_continuous_xy_list(sx, sy)])
+        coordinate_x, coordinate_y = self.saved_geo_transform.get_coordinate(
+            xy_array[:, 0], xy_array[:, 1], is_center=False
+        )
+        geometry["coordinates"] = [np.stack([coordinate_x, coordinate_y], axis=1).tolist()]
         return geometry
 
     def search_start_point(self, array: np.array) -> tuple[int, int]:
@@ -232,60 +448,92 @@ class GeoJsonProcessing(CommonImageProcessing):
                 continue
             return (x, y)
 
-    def get_continuous_coordinates(self, sx: int, sy: int) -> list[tuple[int, int]]:
-        coordinates = []
-        x = sx + 0
-        y = sy + 0
+    def get_continuous_coordinates(self, sx: int, sy: int) -> list[list[float, float]]:
+        return [self.get_coordinates(x, y) for x, y in self.get_continuous_xy_list(sx, sy)]
+
+    def get_continuous_xy_list(self, sx: int, sy: int) -> np.ndarray:
+        """(x, y) of the cells following (sx, sy), by the kernel "trace_contour" of the selected backend"""
         array = np.array(self.saved_tiff)
-        searched_array = np.zeros(array.shape)
-        while True:
-            nx, ny = self.get_neighbor_xy_pixel(array, searched_array, x, y)
-            if nx is None or ny is None:
-                break
-            coordinates.append(self.get_coordinates(nx, ny))
-            searched_array[ny][nx] = 1
-            x, y = nx, ny
-        return coordinates
-
-    def get_neighbor_xy_pixel(self, array: np.array, searched_array: np.array, x: int, y: int) -> tuple[int, int]:
-        """Closest distance and few neighboring pixels"""
-        neighbor_pixel_cnt_min = 9
-        dist_min = 2
-        candidate = (None, None)
-        for nx, ny in make_neighbor_xy(x, y):
-            if self.is_out_of_array(array.shape, nx, ny):
-                continue
-            if array[ny][nx] == self.nodata:
-                continue
-            if searched_array[ny][nx] == 1:
-                continue
-            dist = (x - nx) ** 2 + (y - ny) ** 2
-            if dist_min >= dist:
-                dist_min = dist
-            else:
-                continue
-            neighbor_pixel_cnt = self.get_neighbor_pixel_cnt(array, nx, ny)
-            if neighbor_pixel_cnt_min >= neighbor_pixel_cnt:
-                neighbor_pixel_cnt_min = neighbor_pixel_cnt
-                candidate = (nx, ny)
-        return candidate
-
-    def get_neighbor_pixel_cnt(self, array: np.array, x: int, y: int) -> int:
-        cnt = 0
-        for nx, ny in make_neighbor_xy(x, y):
-            if self.is_out_of_array(array.shape, nx, ny):
-                continue
-            if array[ny][nx] == self.nodata:
-                continue
-            cnt += 1
-        return cnt
+        return kernel_registry.get("trace_contour")(array != self.nodata, sx, sy)
 
     def get_coordinates(self, x: int, y: int) -> list[float, float]:
-        originX = self.saved_tiff.tag[TiffTag.ModelTiepointTag][3]
-        originY = self.saved_tiff.tag[TiffTag.ModelTiepointTag][4]
-        dx = x * self.saved_tiff.tag[TiffTag.ModelPixelScaleTag][0]
-        dy = y * self.saved_tiff.tag[TiffTag.ModelPixelScaleTag][1]
-        return [originX + dx, originY - dy]
+        coordinate_x, coordinate_y = self.saved_geo_transform.get_coordinate(x, y, is_center=False)
+        return [float(coordinate_x), float(coordinate_y)]
+
+
+def trace_contour_reference(is_valid: np.ndarray, sx: int, sy: int) -> np.ndarray:
+    """
+    cells of a mask followed from (sx, sy): the next cell is the nearest unvisited neighbor
+    with the fewest valid neighbors (the outermost), the later one of a tie in row order.
+    the neighbor counts are counted for all cells at once.
+    """
+    y_size, x_size = is_valid.shape
+    padded = np.pad(is_valid, 1).astype(np.int8)
+    neighbor_cnt = sum(padded[dy : dy + y_size, dx : dx + x_size] for dy in range(3) for dx in range(3)) - is_valid
+    is_unvisited = np.array(is_valid)
+    xy_list = []
+    x, y = sx, sy
+    while True:
+        candidate = None
+        distance_min, neighbor_cnt_min = 2, 9
+        for ny in range(y - 1, y + 2):
+            for nx in range(x - 1, x + 2):
+                if not (0 <= ny < y_size and 0 <= nx < x_size) or not is_unvisited[ny, nx] or (nx, ny) == (x, y):
+                    continue
+                distance = (x - nx) ** 2 + (y - ny) ** 2
+                if distance > distance_min:
+                    continue
+                distance_min = distance
+                if neighbor_cnt[ny, nx] <= neighbor_cnt_min:
+                    neighbor_cnt_min = neighbor_cnt[ny, nx]
+                    candidate = (nx, ny)
+        if candidate is None:
+            break
+        x, y = candidate
+        xy_list.append(candidate)
+        is_unvisited[y, x] = False
+    return np.array(xy_list, dtype=np.int64).reshape(-1, 2)
+
+
+def trace_contour_loop(is_valid: np.ndarray, sx: int, sy: int) -> np.ndarray:
+    """trace_contour_reference counting the neighbors on the way (kernel "trace_contour")"""
+    y_size, x_size = is_valid.shape
+    is_unvisited = is_valid.copy()
+    xy_array = np.empty((is_valid.size, 2), dtype=np.int64)
+    xy_cnt = 0
+    x, y = sx, sy
+    while True:
+        candidate_x, candidate_y = -1, -1
+        distance_min, neighbor_cnt_min = 2, 9
+        for ny in range(y - 1, y + 2):
+            for nx in range(x - 1, x + 2):
+                if ny < 0 or ny >= y_size or nx < 0 or nx >= x_size or not is_unvisited[ny, nx]:
+                    continue
+                if nx == x and ny == y:
+                    continue
+                distance = (x - nx) ** 2 + (y - ny) ** 2
+                if distance > distance_min:
+                    continue
+                distance_min = distance
+                neighbor_cnt = 0
+                for my in range(max(ny - 1, 0), min(ny + 2, y_size)):
+                    for mx in range(max(nx - 1, 0), min(nx + 2, x_size)):
+                        if is_valid[my, mx] and not (mx == nx and my == ny):
+                            neighbor_cnt += 1
+                if neighbor_cnt <= neighbor_cnt_min:
+                    neighbor_cnt_min = neighbor_cnt
+                    candidate_x, candidate_y = nx, ny
+        if candidate_x < 0:
+            break
+        x, y = candidate_x, candidate_y
+        xy_array[xy_cnt, 0] = x
+        xy_array[xy_cnt, 1] = y
+        xy_cnt += 1
+        is_unvisited[y, x] = False
+    return xy_array[:xy_cnt]
+
+
+kernel_registry.register("trace_contour", trace_contour_reference, trace_contour_loop)
 
 
 class ImageProcessing(PILProcessing, GeoJsonProcessing):
@@ -0,0 +1,91 @@
+import logging
+import os
+from time import time
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+KERNEL_BACKEND_ENV = "CATCHMENT_KERNEL_BACKEND"
+KERNEL_BACKEND_LIST = ["auto", "numpy", "jit"]
+
+
+class KernelRegistry:
+    """
+    sequential compute kernels by name, each with a numpy reference and a loop version of the same signature.
+    the loop version is written in the subset of Python that numba compiles (arrays, scalars, heapq on a list)
+    and is compiled with numba.njit(cache=True) on its first use, the machine code is cached on disk
+    (__pycache__ next to the module), so later runs skip the compilation.
+    backend: numpy (references), jit (compiled loops) or auto (jit when numba is importable).
+    the backend is set with set_backend or the environment variable CATCHMENT_KERNEL_BACKEND.
+    """
+
+    def __init__(self, backend: str = None):
+        self.kernel_dict: dict[str, tuple[callable, callable, callable]] = {}
+        self.compiled_dict: dict[str, callable] = {}
+        self.backend = "auto"
+        self.set_backend(backend or os.environ.get(KERNEL_BACKEND_ENV, "auto"))
+
+    def set_backend(self, backend: str):
+        if backend not in KERNEL_BACKEND_LIST:
+            raise ValueError(f"backend must be one of {', '.join(KERNEL_BACKEND_LIST)}.")
+        if backend == "jit" and not self.is_jit_available():
+            logging.warning("numba is not installed, the numpy kernels are used")
+        self.backend = backend
+
+    def is_jit_available(self) -> bool:
+        return numba is not None
+
+    def get_backend(self) -> str:
+        """numpy or jit, the backend actually used"""
+        if self.backend == "numpy" or not self.is_jit_available():
+            return "numpy"
+        return "jit"
+
+    def register(self, name: str, reference: callable, loop: callable, is_equal: callable = None):
+        """is_equal(reference_result, loop_result) for compare, np.array_equal by default"""
+        self.kernel_dict[name] = (reference, loop, is_equal or np.array_equal)
+        self.compiled_dict.pop(name, None)
+
+    def get(self, name: str, backend: str = None) -> callable:
+        if name not in self.kernel_dict:
+            raise KeyError(f"kernel {name} is not registered.")
+        reference, loop, _ = self.kernel_dict[name]
+        backend = self.get_backend() if backend is None else backend
+        if backend == "numpy":
+            return reference
+        if not self.is_jit_available():
+            # the loop version runs as plain Python without numba, correct but slow
+            return loop
+        if name not in self.compiled_dict:
+            self.compiled_dict[name] = numba.njit(cache=True)(loop)
+        return self.compiled_dict[name]
+
+    def compare(self, name: str, *args) -> dict[str, float]:
+        """
+        seconds of the numpy and jit kernels on copies of the same inputs, checked to give the same result.
+        the jit time includes the compilation (or the cache load) on its first call.
+        """
+        _, _, is_equal = self.kernel_dict[name]
+        result_dict, second_dict = {}, {}
+        for backend in ["numpy", "jit"]:
+            kernel = self.get(name, backend)
+            copied_args = [np.array(arg) if isinstance(arg, np.ndarray) else arg for arg in args]
+            start = time()
+            result_dict[backend] = kernel(*copied_args)
+            second_dict[backend] = time() - start
+            logging.info(f"{name} {backend}: {second_dict[backend]:.3f} sec")
+        if not is_equal(result_dict["numpy"], result_dict["jit"]):
+            raise ValueError(f"jit kernel {name} differs from the numpy kernel")
+        return second_dict
+
+
+def is_same_index_set(index_a: np.ndarray, index_b: np.ndarray) -> bool:
+    """the same cells in any order"""
+    return np.array_equal(np.sort(index_a), np.sort(index_b))
+
+
+kernel_registry = KernelRegistry()
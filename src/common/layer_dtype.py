@@ -0,0 +1,79 @@
+import numpy as np
+
+
+class LayerDtypePolicy:
+    """
+    dtype of every layer, applied when a layer is read, derived and saved.
+    elevation: float32
+    flow direction: smallest unsigned int holding the codes of the rule (uint8 for D8 and D16)
+    catchment area and watershed boundary: uint8 mask (saved as 1 bit by the mono savers)
+    flow accumulation: smallest unsigned int holding the cell count, float32 or float64 for proportional routing
+    receiver index: int32 while the cell count fits, otherwise int64
+    """
+
+    elevation = np.float32
+    mask = np.uint8
+    # float32 holds integers exactly up to 2 ** 24
+    float32_exact_limit = 2**24
+    # cells of a block of rows converted at once
+    block_cell_cnt = 2**20
+
+    def to_elevation(self, array) -> np.ndarray:
+        return np.asarray(array).astype(self.elevation, copy=False)
+
+    def get_flow_direction_dtype(self, flow_direction_rule_matrix: list[list[int]]) -> np.dtype:
+        max_code = max(rule for rule_x in flow_direction_rule_matrix for rule in rule_x if rule is not None)
+        return np.min_scalar_type(max_code)
+
+    def to_flow_direction(self, array, flow_direction_rule_matrix: list[list[int]]) -> np.ndarray:
+        """
+        negative codes are read by their low bits (128 of D8 stored as int8 is -128),
+        values that are no code of the rule (nodata such as -1 or -32768) become 0, no flow direction.
+        the codes are remapped in blocks of rows, so a memmap is read once without full size temporaries.
+        """
+        array = np.asarray(array)
+        dtype = self.get_flow_direction_dtype(flow_direction_rule_matrix)
+        if array.dtype == dtype:
+            return array
+        code_list = [0] + [rule for rule_x in flow_direction_rule_matrix for rule in rule_x if rule is not None]
+        flow_direction_array = np.empty(array.shape, dtype=dtype)
+        block_row_cnt = max(1, self.block_cell_cnt // max(int(np.prod(array.shape[1:])), 1))
+        for y_start in range(0, array.shape[0], block_row_cnt):
+            block = array[y_start : y_start + block_row_cnt]
+            if block.dtype.kind == "i":
+                block = np.where(block < 0, block.astype(np.int64) & np.iinfo(dtype).max, block)
+            flow_direction_array[y_start : y_start + block_row_cnt] = np.where(np.isin(block, code_list), block, 0)
+        return flow_direction_array
+
+    def to_mask(self, array) -> np.ndarray:
+        return np.asarray(array).astype(self.mask, copy=False)
+
+    def get_index_dtype(self, cell_cnt: int) -> np.dtype:
+        return np.dtype(np.int32) if cell_cnt < np.iinfo(np.int32).max else np.dtype(np.int64)
+
+    def get_count_dtype(self, cell_cnt: int) -> np.dtype:
+        """the upstream cell count is at most the cell count of the scene"""
+        for dtype in [np.uint16, np.uint32, np.uint64]:
+            if cell_cnt <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+        raise OverflowError(f"{cell_cnt} cells do not fit in uint64")
+
+    def get_weighted_dtype(self, total_weight: float) -> np.dtype:
+        """float32 while the total weight is exact in float32, otherwise float64"""
+        if total_weight < self.float32_exact_limit:
+            return np.dtype(np.float32)
+        return np.dtype(np.float64)
+
+    def cast_checked(self, array: np.ndarray, dtype: np.dtype) -> np.ndarray:
+        """astype raising OverflowError instead of wrapping around (or overflowing to inf)"""
+        dtype = np.dtype(dtype)
+        if array.dtype == dtype or array.size == 0:
+            return array.astype(dtype, copy=False)
+        if dtype.kind in "ui":
+            value_info = np.iinfo(dtype)
+            if array.min() < value_info.min or array.max() > value_info.max:
+                raise OverflowError(f"values from {array.min()} to {array.max()} do not fit in {dtype}")
+        elif dtype.kind == "f" and array.dtype.kind == "f":
+            if np.abs(array[np.isfinite(array)]).max(initial=0) > np.finfo(dtype).max:
+                raise OverflowError(f"values up to {np.abs(array).max()} do not fit in {dtype}")
+        return array.astype(dtype)
@@ -0,0 +1,111 @@
+import logging
+from time import time
+
+import numpy as np
+from PIL import Image
+
+from common.figure_setting import TiffTag
+from common.geotiff_writer import GeoTiffWriter
+
+
+class Overview:
+    """
+    reduced resolution pyramid of a layer, every level halves the previous one.
+    the reduction depends on the layer: mean for DEM, max for accumulation, mode for directions and any for masks.
+    """
+
+    REDUCTION_LIST = ["mean", "max", "mode", "any"]
+    # viridis like anchors for the preview colormap
+    COLORMAP_ANCHOR = np.array(
+        [
+            [68, 1, 84],
+            [59, 82, 139],
+            [33, 145, 140],
+            [94, 201, 98],
+            [253, 231, 37],
+        ],
+        dtype=np.float64,
+    )
+
+    def __init__(self, reduction: str, min_size: int = 256):
+        if reduction not in self.REDUCTION_LIST:
+            raise ValueError("reduction must be mean, max, mode or any")
+        self.reduction = reduction
+        self.min_size = min_size
+
+    def build_level_list(self, array: np.ndarray) -> list[np.ndarray]:
+        """[full resolution, 1/2, 1/4, ...] until the longer side is not larger than min_size"""
+        level_list = [np.asarray(array)]
+        while max(level_list[-1].shape) > self.min_size:
+            level_list.append(self.reduce_half(level_list[-1]))
+        return level_list
+
+    def reduce_half(self, array: np.ndarray) -> np.ndarray:
+        """2x2 block reduction, an odd last row or column is repeated"""
+        pad_width = ((0, array.shape[0] % 2), (0, array.shape[1] % 2))
+        if any(width for _, width in pad_width):
+            array = np.pad(array, pad_width, mode="edge")
+        block = np.stack([array[0::2, 0::2], array[0::2, 1::2], array[1::2, 0::2], array[1::2, 1::2]])
+        if self.reduction == "mean":
+            mean_dtype = array.dtype if array.dtype.kind == "f" else np.float32
+            return block.mean(axis=0, dtype=np.float64).astype(mean_dtype)
+        elif self.reduction == "max":
+            return block.max(axis=0)
+        elif self.reduction == "any":
+            return block.any(axis=0)
+        # mode of 4 values, ties go to the upper left one
+        count = sum((block == block[i]).astype(np.uint8) for i in range(4))
+        most_common = np.argmax(count, axis=0)
+        return np.take_along_axis(block, most_common[np.newaxis], axis=0)[0]
+
+    def get_level_tag(self, tag, factor: int) -> dict:
+        """geo tags of a level, only the pixel scale changes (the tie point is the same upper left corner)"""
+        level_tag = {tag_id: tuple(tag[tag_id]) for tag_id in GeoTiffWriter.GEO_TAG_TYPE if tag_id in tag}
+        if TiffTag.ModelPixelScaleTag in level_tag:
+            scale_x, scale_y, scale_z = level_tag[TiffTag.ModelPixelScaleTag]
+            level_tag[TiffTag.ModelPixelScaleTag] = (scale_x * factor, scale_y * factor, scale_z)
+        return level_tag
+
+    def save_level_list(self, level_list: list[np.ndarray], tag, path_base: str, **writer_kwargs) -> list[str]:
+        """every reduced level as {path_base}_ovr{factor}.tif"""
+        path_list = []
+        for level, array in enumerate(level_list[1:], start=1):
+            factor = 2**level
+            path = f"{path_base}_ovr{factor}.tif"
+            writer = GeoTiffWriter(path, array.shape, array.dtype, self.get_level_tag(tag, factor), **writer_kwargs)
+            writer.open()
+            writer.write_array(array)
+            writer.close()
+            path_list.append(path)
+        return path_list
+
+    def select_fitting_level(self, level_list: list[np.ndarray], max_size: int) -> np.ndarray:
+        """the largest level whose longer side fits in max_size (the smallest one if none fits)"""
+        for array in level_list:
+            if max(array.shape) <= max_size:
+                return array
+        return level_list[-1]
+
+    def get_colormap(self) -> np.ndarray:
+        """256 x 3 uint8 lookup table"""
+        anchor_position = np.linspace(0, 255, len(self.COLORMAP_ANCHOR))
+        colormap = [np.interp(np.arange(256), anchor_position, channel) for channel in self.COLORMAP_ANCHOR.T]
+        return np.stack(colormap, axis=1).round().astype(np.uint8)
+
+    def render_preview(
+        self, level_list: list[np.ndarray], max_size: int = 1024, is_log_scale: bool = False
+    ) -> Image.Image:
+        """RGB quick look from the largest level fitting in max_size, nan is drawn black"""
+        start = time()
+        array = self.select_fitting_level(level_list, max_size).astype(np.float64)
+        is_valid = np.isfinite(array)
+        if is_log_scale:
+            array = np.log1p(np.clip(array, 0, None))
+        valid_value = array[is_valid]
+        low, high = (valid_value.min(), valid_value.max()) if valid_value.size > 0 else (0.0, 1.0)
+        with np.errstate(invalid="ignore"):
+            normalized = (array - low) / max(high - low, np.finfo(np.float64).tiny)
+        color_index = np.where(is_valid, np.nan_to_num(normalized) * 255, 0).round().astype(np.uint8)
+        rgb = np.where(is_valid[..., np.newaxis], self.get_colormap()[color_index], 0).astype(np.uint8)
+        logging.info(f"preview {rgb.shape[1]}x{rgb.shape[0]} rendered in {time() - start:.3f} sec")
+        return Image.fromarray(rgb, mode="RGB")
@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+from collections import deque
+from typing import Iterator
+
+import numpy as np
+
+from common.image_processing import GeoJsonProcessing
+
+
+class LabelPolygonizer(GeoJsonProcessing):
+    """
+    polygons with holes of every label (> 0) of an integer label raster, in one sweep over the rows.
+    the boundary edges between cells of different labels are chained into rings with the label on the left
+    (counterclockwise exteriors, clockwise holes in map coordinates). a label touching itself only diagonally
+    is split there (4-connected parts), so every ring is simple.
+    a label is written as soon as the sweep passes its last row, so the open chains are bounded by the width
+    and only the rings of labels still crossing the sweep line are kept.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.start_dict: dict[tuple, list] = {}
+        self.end_dict: dict[tuple, list] = {}
+        self.ring_dict: dict[int, list[list[tuple[int, int]]]] = {}
+        self.ambiguous_dict: dict[int, set[tuple[int, int]]] = {}
+
+    def iterate_feature(self, label_array: np.ndarray, property_dict: dict[int, dict] = None) -> Iterator[dict]:
+        """
+        label_array: 2d integer array (a memmap is read row by row), 0 is background
+        property_dict: properties of the features by label, in addition to label and area_km2
+        """
+        property_dict = property_dict or {}
+        y_size, x_size = label_array.shape
+        finished_label_list = self.get_finished_label_list(label_array)
+        self.start_dict, self.end_dict, self.ring_dict = {}, {}, {}
+        zero_row = np.zeros(x_size, dtype=np.int64)
+        above = zero_row
+        below = np.asarray(label_array[0], dtype=np.int64) if y_size > 0 else zero_row
+        self.ambiguous_dict = {0: self.get_ambiguous_set(above, below)}
+        for y in range(y_size + 1):
+            self.add_horizontal_edge(above, below, y)
+            # labels whose last row is y - 1 are closed now
+            for label in finished_label_list[y]:
+                yield self.get_feature(int(label), property_dict.get(int(label), {}))
+            if y == y_size:
+                break
+            following = np.asarray(label_array[y + 1], dtype=np.int64) if y + 1 < y_size else zero_row
+            self.ambiguous_dict = {y: self.ambiguous_dict[y], y + 1: self.get_ambiguous_set(below, following)}
+            self.add_vertical_edge(below, y)
+            above, below = below, following
+        if self.start_dict:
+            logging.warning(f"{len(self.start_dict)} chains are not closed")
+
+    def get_finished_label_list(self, label_array: np.ndarray, chunk_row_cnt: int = 256) -> list[np.ndarray]:
+        """labels by the row after their last row, from a pass over chunks of rows"""
+        y_size = label_array.shape[0]
+        last_row_dict: dict[int, int] = {}
+        for start in range(0, y_size, chunk_row_cnt):
+            chunk = np.asarray(label_array[start : start + chunk_row_cnt])
+            # the first of a label in the reversed chunk is its last cell
+            label, position = np.unique(chunk[::-1].ravel(), return_index=True)
+            last_row = start + chunk.shape[0] - 1 - position // chunk.shape[1]
+            last_row_dict.update(zip(label[label > 0].tolist(), last_row[label > 0].tolist()))
+        finished_label_list = [[] for _ in range(y_size + 1)]
+        for label, last_row in sorted(last_row_dict.items()):
+            finished_label_list[last_row + 1].append(label)
+        return finished_label_list
+
+    def get_ambiguous_set(self, above: np.ndarray, below: np.ndarray) -> set[tuple[int, int]]:
+        """(label, x) of the vertices on the line between two rows where a label touches itself only diagonally"""
+        above = np.pad(above, 1)
+        below = np.pad(below, 1)
+        north_west, north_east, south_west, south_east = above[:-1], above[1:], below[:-1], below[1:]
+        is_main = (north_west == south_east) & (north_west != north_east) & (north_west != south_west)
+        is_anti = (north_east == south_west) & (north_east != north_west) & (north_east != south_east)
+        x_main = np.flatnonzero(is_main & (north_west > 0))
+        x_anti = np.flatnonzero(is_anti & (north_east > 0))
+        return set(zip(north_west[x_main].tolist(), x_main.tolist())) | set(
+            zip(north_east[x_anti].tolist(), x_anti.tolist())
+        )
+
+    def add_horizontal_edge(self, above: np.ndarray, below: np.ndarray, y: int):
+        """edges on the line y between rows y - 1 and y, collinear cells of a label merged into one edge"""
+        is_boundary = above != below
+        for label_row, direction in [(below, 2), (above, 0)]:
+            is_edge = is_boundary & (label_row > 0)
+            is_continued = np.zeros_like(is_edge)
+            is_continued[1:] = is_edge[1:] & is_edge[:-1] & (label_row[1:] == label_row[:-1])
+            run_start = np.flatnonzero(is_edge & ~is_continued)
+            is_run_end = is_edge.copy()
+            is_run_end[:-1] &= ~is_continued[1:]
+            run_end = np.flatnonzero(is_run_end) + 1
+            for label, x_start, x_end in zip(label_row[run_start].tolist(), run_start.tolist(), run_end.tolist()):
+                if direction == 0:
+                    self.add_edge(label, (x_start, y), (x_end, y), direction)
+                else:
+                    self.add_edge(label, (x_end, y), (x_start, y), direction)
+
+    def add_vertical_edge(self, row: np.ndarray, y: int):
+        """edges between horizontally neighboring cells of row y"""
+        padded = np.pad(row, 1)
+        left, right = padded[:-1], padded[1:]
+        x_edge = np.flatnonzero(left != right)
+        for x, left_label, right_label in zip(x_edge.tolist(), left[x_edge].tolist(), right[x_edge].tolist()):
+            if right_label > 0:
+                self.add_edge(right_label, (x, y), (x, y + 1), 1)
+            if left_label > 0:
+                self.add_edge(left_label, (x, y + 1), (x, y), 3)
+
+    def get_vertex_key(self, label: int, vertex: tuple[int, int], direction: int) -> tuple:
+        """
+        at a diagonal touch a label has two chains in and two out,
+        the chain coming in is continued by the edge turning left of it (direction of the edge going out).
+        """
+        if (label, vertex[0]) in self.ambiguous_dict[vertex[1]]:
+            return (label, vertex, direction)
+        return (label, vertex)
+
+    def add_edge(self, label: int, start: tuple[int, int], end: tuple[int, int], direction: int):
+        """direction of the edge in the image: 0 +x, 1 +y, 2 -x, 3 -y"""
+        start_key = self.get_vertex_key(label, start, direction)
+        end_key = self.get_vertex_key(label, end, (direction + 3) % 4)
+        # chain: [vertices, start key, end key]
+        previous = self.end_dict.pop(start_key, None)
+        following = self.start_dict.pop(end_key, None)
+        if previous is not None and previous is following:
+            self.ring_dict.setdefault(label, []).extend(self.get_ring_list(previous[0]))
+        elif previous is not None and following is not None:
+            # the shorter chain is copied into the longer one
+            if len(previous[0]) >= len(following[0]):
+                previous[0].extend(following[0])
+                previous[2] = following[2]
+                self.end_dict[previous[2]] = previous
+            else:
+                following[0].extendleft(reversed(previous[0]))
+                following[1] = previous[1]
+                self.start_dict[following[1]] = following
+        elif previous is not None:
+            previous[0].append(end)
+            previous[2] = end_key
+            self.end_dict[end_key] = previous
+        elif following is not None:
+            following[0].appendleft(start)
+            following[1] = start_key
+            self.start_dict[start_key] = following
+        else:
+            chain = [deque([start, end]), start_key, end_key]
+            self.start_dict[start_key] = chain
+            self.end_dict[end_key] = chain
+
+    def get_ring_list(self, vertex_deque: deque) -> list[list[tuple[int, int]]]:
+        """
+        closed rings in pixel corners without collinear vertices, the first vertex repeated at the end.
+        a hole whose outside cells touch diagonally passes a vertex twice and is split there into simple rings.
+        """
+        vertex_list = list(vertex_deque)
+        if len(set(vertex_list)) == len(vertex_list):
+            return [self.get_corner_ring(vertex_list)]
+        ring_list = []
+        path, position_dict = [], {}
+        for vertex in vertex_list + vertex_list[:1]:
+            if vertex in position_dict:
+                position = position_dict[vertex]
+                ring_list.append(self.get_corner_ring(path[position:]))
+                for removed in path[position + 1 :]:
+                    del position_dict[removed]
+                del path[position + 1 :]
+                continue
+            position_dict[vertex] = len(path)
+            path.append(vertex)
+        return ring_list
+
+    def get_corner_ring(self, vertex_list: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        # edges are axis aligned, a vertex is a corner if its neighbors differ in both x and y
+        previous_list = vertex_list[-1:] + vertex_list[:-1]
+        following_list = vertex_list[1:] + vertex_list[:1]
+        ring = [
+            vertex
+            for previous, vertex, following in zip(previous_list, vertex_list, following_list)
+            if previous[0] != following[0] and previous[1] != following[1]
+        ]
+        return ring + ring[:1]
+
+    def get_feature(self, label: int, properties: dict) -> dict:
+        ring_list = self.ring_dict.pop(label, [])
+        # shoelace area in pixels, positive for exteriors in map coordinates (y of the image flipped)
+        area_list = [-self.get_signed_area(ring) for ring in ring_list]
+        # exteriors from the smallest, so a hole goes to the innermost exterior around it
+        exterior_list = sorted((area, index) for index, area in enumerate(area_list) if area > 0)
+        polygon_list = [[ring_list[index]] for _, index in exterior_list]
+        bound_box_list = None
+        for ring, area in zip(ring_list, area_list):
+            if area > 0:
+                continue
+            if len(polygon_list) == 1:
+                polygon_list[0].append(ring)
+                continue
+            if bound_box_list is None:
+                bound_box_list = [self.get_ring_bound_box(polygon[0]) for polygon in polygon_list]
+            # center of the labeled cell on the left of the first edge of the hole
+            dx = (ring[1][0] > ring[0][0]) - (ring[1][0] < ring[0][0])
+            dy = (ring[1][1] > ring[0][1]) - (ring[1][1] < ring[0][1])
+            point = (ring[0][0] + (dx + dy) / 2, ring[0][1] + (dy - dx) / 2)
+            polygon = next(
+                polygon
+                for polygon, (x_min, y_min, x_max, y_max) in zip(polygon_list, bound_box_list)
+                if x_min < point[0] < x_max and y_min < point[1] < y_max and self.is_in_ring(point, polygon[0])
+            )
+            polygon.append(ring)
+        polygon_coordinate_list = [[self.get_ring_coordinate(ring) for ring in polygon] for polygon in polygon_list]
+        if len(polygon_coordinate_list) == 1:
+            geometry = {"type": "Polygon", "coordinates": polygon_coordinate_list[0]}
+        else:
+            geometry = {"type": "MultiPolygon", "coordinates": polygon_coordinate_list}
+        pixel_cnt = sum(area_list)
+        return {
+            "type": "Feature",
+            "properties": {"label": label, "area_km2": pixel_cnt * self.get_cell_area_km2(), **properties},
+            "geometry": geometry,
+        }
+
+    def get_signed_area(self, ring: list[tuple[int, int]]) -> float:
+        return sum(start[0] * end[1] - end[0] * start[1] for start, end in zip(ring[:-1], ring[1:])) / 2
+
+    def get_ring_bound_box(self, ring: list[tuple[int, int]]) -> tuple[int, int, int, int]:
+        x_list, y_list = zip(*ring)
+        return min(x_list), min(y_list), max(x_list), max(y_list)
+
+    def is_in_ring(self, point: tuple[float, float], ring: list[tuple[int, int]]) -> bool:
+        """even-odd rule over the vertical edges, the point is never on the ring (a cell center)"""
+        is_in = False
+        for start, end in zip(ring[:-1], ring[1:]):
+            if start[0] == end[0] and start[0] > point[0] and (start[1] > point[1]) != (end[1] > point[1]):
+                is_in = not is_in
+        return is_in
+
+    def get_ring_coordinate(self, ring: list[tuple[int, int]]) -> list[list[float]]:
+        # rings are mostly a few vertices, plain arithmetic is faster than arrays here
+        geo_transform = self.get_geo_transform()
+        x_origin, y_origin = geo_transform.x_origin, geo_transform.y_origin
+        x_resolution, y_resolution = geo_transform.x_resolution, geo_transform.y_resolution
+        return [[x_origin + x * x_resolution, y_origin - y * y_resolution] for x, y in ring]
+
+    def save_geojson(
+        self,
+        label_array: np.ndarray,
+        file_name: str,
+        property_dict: dict[int, dict] = None,
+        is_line_delimited: bool = False,
+    ) -> str:
+        """
+        features written one by one, as a FeatureCollection (.geojson)
+        or newline-delimited GeoJSON (.geojsonl, one feature per line)
+        """
+        os.makedirs(self.save_dir, exist_ok=True)
+        path = os.path.join(self.save_dir, file_name + (".geojsonl" if is_line_delimited else ".geojson"))
+        crs = self.get_crs_from_tag(self.image_tag) or "urn:ogc:def:crs:OGC:1.3:CRS84"
+        feature_cnt = 0
+        with open(path, "w", encoding="utf-8") as file:
+            if not is_line_delimited:
+                file.write('{"type": "FeatureCollection", ')
+                file.write(f'"crs": {json.dumps({"type": "name", "properties": {"name": crs}})}, "features": [\n')
+            for feature in self.iterate_feature(label_array, property_dict):
+                separator = "" if feature_cnt == 0 else "\n" if is_line_delimited else ",\n"
+                file.write(separator + json.dumps(feature, ensure_ascii=False))
+                feature_cnt += 1
+            file.write("\n" if is_line_delimited else "\n]}\n")
+        logging.info(f"{feature_cnt} polygons saved to {path}")
+        return path
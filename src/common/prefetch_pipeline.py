@@ -0,0 +1,157 @@
+import logging
+import queue
+import threading
+from time import perf_counter
+
+STAGE_LIST = ["read", "compute", "write"]
+QUEUE_POLL_SEC = 0.1
+
+
+class PrefetchPipeline:
+    """
+    items (e.g., scenes) read, computed and written in three overlapping stages.
+    a reader thread decodes up to prefetch_count items ahead of the compute in the calling thread,
+    and a writer thread saves the outputs of the previous items while the next one is computed.
+    both queues are bounded, so a slow stage blocks the stage before it instead of piling scenes up in memory.
+    file reads, decoding (zlib) and writes release the GIL, so the wall time approaches the slowest stage
+    rather than the sum of the stages.
+    an item failed in any stage is reported with its error and does not stop the other items.
+    prefetch_count 0 runs the stages one after another in the calling thread, as a baseline.
+    """
+
+    def __init__(
+        self,
+        read_func: callable,
+        compute_func: callable,
+        write_func: callable = None,
+        prefetch_count: int = 1,
+        write_queue_size: int = 1,
+    ):
+        """read_func(item) -> data, compute_func(item, data) -> output, write_func(item, output)"""
+        self.read_func = read_func
+        self.compute_func = compute_func
+        self.write_func = write_func
+        self.prefetch_count = max(0, prefetch_count)
+        self.write_queue_size = max(1, write_queue_size)
+        self.lock = threading.Lock()
+        self.second_dict: dict[str, float] = {}
+
+    def run(self, item_list: list) -> list[dict]:
+        """{"item", "stage", "error"} of every item in order, stage and error are None when the item is done"""
+        self.second_dict = {name: 0.0 for name in [*STAGE_LIST, "compute_wait", "wall"]}
+        result_list = [{"item": item, "stage": None, "error": None} for item in item_list]
+        start = perf_counter()
+        if self.prefetch_count == 0:
+            for result in result_list:
+                output = self.compute_item(result, self.read_item(result))
+                self.write_item(result, output)
+        else:
+            self.run_overlapped(result_list)
+        self.second_dict["wall"] = perf_counter() - start
+        report = self.get_overlap_report()
+        overlap = "-" if report["overlap_ratio"] is None else f"{report['overlap_ratio']:.0%}"
+        logging.info(
+            f"pipeline: {len(result_list)} items in {report['wall_sec']:.2f} sec, read {report['read_sec']:.2f} / "
+            f"compute {report['compute_sec']:.2f} / write {report['write_sec']:.2f} sec, overlap {overlap}"
+        )
+        return result_list
+
+    def run_overlapped(self, result_list: list[dict]):
+        read_queue = queue.Queue(maxsize=self.prefetch_count)
+        write_queue = queue.Queue(maxsize=self.write_queue_size)
+        stop_event = threading.Event()
+        reader = threading.Thread(target=self.read_all, args=(result_list, read_queue, stop_event), daemon=True)
+        writer = threading.Thread(target=self.write_all, args=(write_queue, stop_event), daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            for _ in result_list:
+                wait_start = perf_counter()
+                result, data = read_queue.get()
+                self.add_second("compute_wait", perf_counter() - wait_start)
+                output = self.compute_item(result, data)
+                del data
+                if result["error"] is None:
+                    self.put_until_stopped(write_queue, (result, output), stop_event)
+                del output
+            self.put_until_stopped(write_queue, None, stop_event)
+            writer.join()
+        finally:
+            # on an interrupt of the compute, the threads leave at their next queue operation
+            stop_event.set()
+        reader.join()
+
+    def read_all(self, result_list: list[dict], read_queue: queue.Queue, stop_event: threading.Event):
+        for result in result_list:
+            if stop_event.is_set():
+                return
+            data = self.read_item(result)
+            self.put_until_stopped(read_queue, (result, data), stop_event)
+            del data
+
+    def write_all(self, write_queue: queue.Queue, stop_event: threading.Event):
+        while not stop_event.is_set():
+            try:
+                entry = write_queue.get(timeout=QUEUE_POLL_SEC)
+            except queue.Empty:
+                continue
+            if entry is None:
+                return
+            self.write_item(*entry)
+
+    def put_until_stopped(self, item_queue: queue.Queue, entry, stop_event: threading.Event):
+        while not stop_event.is_set():
+            try:
+                item_queue.put(entry, timeout=QUEUE_POLL_SEC)
+                return
+            except queue.Full:
+                continue
+
+    def read_item(self, result: dict):
+        return self.run_stage("read", result, self.read_func, result["item"])
+
+    def compute_item(self, result: dict, data):
+        if result["error"] is not None:
+            return None
+        return self.run_stage("compute", result, self.compute_func, result["item"], data)
+
+    def write_item(self, result: dict, output):
+        if result["error"] is not None or self.write_func is None:
+            return
+        self.run_stage("write", result, self.write_func, result["item"], output)
+
+    def run_stage(self, stage: str, result: dict, func: callable, *args):
+        start = perf_counter()
+        try:
+            return func(*args)
+        except Exception as error:
+            logging.error(f"{result['item']} failed in {stage}: {error!r}")
+            result["stage"] = stage
+            result["error"] = error
+            return None
+        finally:
+            self.add_second(stage, perf_counter() - start)
+
+    def add_second(self, name: str, second: float):
+        with self.lock:
+            self.second_dict[name] += second
+
+    def get_overlap_report(self) -> dict[str, float]:
+        """
+        busy seconds of every stage against the wall time of the last run.
+        overlap_ratio: share of the possible saving achieved, 0 when the stages ran one after another
+        (wall = read + compute + write) and 1 when the wall time is down to the slowest stage.
+        compute_wait_sec: time the compute waited for a read, the read is the bottleneck when it is large.
+        """
+        with self.lock:
+            second_dict = dict(self.second_dict)
+        serial_sec = sum(second_dict[stage] for stage in STAGE_LIST)
+        bound_sec = max(second_dict[stage] for stage in STAGE_LIST)
+        wall_sec = second_dict["wall"]
+        report = {f"{name}_sec": second for name, second in second_dict.items()}
+        report["serial_sec"] = serial_sec
+        report["bound_sec"] = bound_sec
+        report["speedup"] = serial_sec / wall_sec if wall_sec > 0 else None
+        saving_sec = serial_sec - bound_sec
+        report["overlap_ratio"] = min(max((serial_sec - wall_sec) / saving_sec, 0.0), 1.0) if saving_sec > 0 else None
+        return report
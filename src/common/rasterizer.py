@@ -0,0 +1,55 @@
+import numpy as np
+
+from common.geo_transform import GeoTransform
+
+
+def get_polygon_cell_index(geometry: dict, geo_transform: GeoTransform, array_shape: tuple[int, int]) -> np.ndarray:
+    """
+    flattened index of the cells whose center is inside a GeoJSON Polygon or MultiPolygon (even-odd rule),
+    in ascending order. the edges are crossed with the rows of cell centers all at once,
+    so the cost is in the number of vertices and rows, not in the cells of the bound box.
+    """
+    if geometry["type"] == "Polygon":
+        ring_list = geometry["coordinates"]
+    elif geometry["type"] == "MultiPolygon":
+        ring_list = [ring for polygon in geometry["coordinates"] for ring in polygon]
+    else:
+        raise ValueError("geometry must be Polygon or MultiPolygon.")
+    y_size, x_size = array_shape
+    start_list, end_list = [], []
+    for ring in ring_list:
+        coordinate = np.asarray(ring, dtype=np.float64)[:, :2]
+        if coordinate.shape[0] < 3:
+            continue
+        # vertices in pixel units, the center of cell (i, j) is (i + 0.5, j + 0.5)
+        vertex = np.stack(
+            [
+                (coordinate[:, 0] - geo_transform.x_origin) / geo_transform.x_resolution,
+                (geo_transform.y_origin - coordinate[:, 1]) / geo_transform.y_resolution,
+            ],
+            axis=1,
+        )
+        start_list.append(vertex)
+        end_list.append(np.roll(vertex, -1, axis=0))
+    if not start_list:
+        return np.zeros(0, dtype=np.int64)
+    start, end = np.concatenate(start_list), np.concatenate(end_list)
+    # an edge crosses the center row j when min_y <= j + 0.5 < max_y, horizontal edges never
+    min_y, max_y = np.minimum(start[:, 1], end[:, 1]), np.maximum(start[:, 1], end[:, 1])
+    first_row = np.ceil(min_y - 0.5).clip(0, y_size).astype(np.int64)
+    end_row = np.ceil(max_y - 0.5).clip(0, y_size).astype(np.int64)
+    row_cnt = (end_row - first_row).clip(min=0)
+    edge = np.repeat(np.arange(row_cnt.size), row_cnt)
+    row = np.repeat(first_row - np.cumsum(row_cnt) + row_cnt, row_cnt) + np.arange(row_cnt.sum())
+    ratio = (row + 0.5 - start[edge, 1]) / (end[edge, 1] - start[edge, 1])
+    crossing_x = start[edge, 0] + ratio * (end[edge, 0] - start[edge, 0])
+    order = np.lexsort((crossing_x, row))
+    row, crossing_x = row[order], crossing_x[order]
+    # every row has an even number of crossings, cells between the 1st and 2nd, the 3rd and 4th ... are inside
+    run_row = row[0::2]
+    run_start = np.ceil(crossing_x[0::2] - 0.5).clip(0, x_size).astype(np.int64)
+    run_end = np.ceil(crossing_x[1::2] - 0.5).clip(0, x_size).astype(np.int64)
+    run_length = (run_end - run_start).clip(min=0)
+    run_first = run_row * x_size + run_start
+    cell_index = np.repeat(run_first - np.cumsum(run_length) + run_length, run_length) + np.arange(run_length.sum())
+    return np.unique(cell_index)
@@ -0,0 +1,134 @@
+import numpy as np
+
+from common.layer_dtype import LayerDtypePolicy
+
+
+class RunLengthMask:
+    """
+    mask of a scene as horizontal runs of cells, a few bytes per run instead of a byte per cell of the scene.
+    run_array: (y, x_start, x_end) of every run in row order, x_end exclusive, runs of a row neither touch nor overlap
+    the same runs as ActiveCellIndex.get_row_run_array. set operations merge the run boundaries of both masks
+    with one sort, so their cost is in the number of runs, not in the cells of the scene.
+    """
+
+    def __init__(self, array_shape: tuple[int, int], run_array: np.ndarray):
+        self.array_shape = tuple(array_shape)
+        self.run_array = run_array
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, nodata: float = 0) -> "RunLengthMask":
+        """cells that are not nodata"""
+        is_inside = np.asarray(array) != nodata
+        y_size, x_size = is_inside.shape
+        padded = np.zeros((y_size, x_size + 2), dtype=np.int8)
+        padded[:, 1:-1] = is_inside
+        edge_y, edge_x = np.nonzero(np.diff(padded, axis=1))
+        # edges alternate start and end in every row
+        run_array = np.stack([edge_y[0::2], edge_x[0::2], edge_x[1::2]], axis=1)
+        return cls((y_size, x_size), run_array.astype(LayerDtypePolicy().get_index_dtype(is_inside.size)))
+
+    @classmethod
+    def from_index(cls, array_shape: tuple[int, int], flat_index: np.ndarray) -> "RunLengthMask":
+        """cells at flat_index, in any order (e.g., trace_upstream_index)"""
+        x_size = array_shape[1]
+        index_dtype = LayerDtypePolicy().get_index_dtype(array_shape[0] * x_size)
+        flat_index = np.unique(np.asarray(flat_index, dtype=np.int64))
+        if flat_index.size == 0:
+            return cls(array_shape, np.zeros((0, 3), dtype=index_dtype))
+        # a run breaks at a gap or at the end of a row
+        is_run_start = np.ones(flat_index.size, dtype=np.bool_)
+        is_run_start[1:] = (np.diff(flat_index) != 1) | (flat_index[1:] % x_size == 0)
+        run_length = np.diff(np.append(np.flatnonzero(is_run_start), flat_index.size))
+        y, x_start = np.divmod(flat_index[is_run_start], x_size)
+        return cls(array_shape, np.stack([y, x_start, x_start + run_length], axis=1).astype(index_dtype))
+
+    def get_run_cnt(self) -> int:
+        return self.run_array.shape[0]
+
+    def get_cell_cnt(self) -> int:
+        return int((self.run_array[:, 2] - self.run_array[:, 1]).sum())
+
+    def get_area_km2(self, cell_area_km2: float) -> float:
+        return self.get_cell_cnt() * cell_area_km2
+
+    def get_bound_box(self) -> tuple[int, int, int, int]:
+        """left, upper, right, lower according to PIL.Image.crop, None for an empty mask"""
+        if self.get_run_cnt() == 0:
+            return None
+        return (
+            int(self.run_array[:, 1].min()),
+            int(self.run_array[0, 0]),
+            int(self.run_array[:, 2].max()),
+            int(self.run_array[-1, 0]) + 1,
+        )
+
+    def get_index(self) -> np.ndarray:
+        """flattened index of the cells in ascending order"""
+        y, x_start, x_end = (self.run_array[:, column].astype(np.int64) for column in range(3))
+        run_length = x_end - x_start
+        run_first = y * self.array_shape[1] + x_start
+        return np.repeat(run_first - np.cumsum(run_length) + run_length, run_length) + np.arange(run_length.sum())
+
+    def to_array(self, bound_box: tuple[int, int, int, int] = None, dtype=LayerDtypePolicy.mask) -> np.ndarray:
+        """1 in the mask, 0 outside, of the scene or of the crop by bound_box"""
+        mask = self if bound_box is None else self.crop(bound_box)
+        array = np.zeros(mask.array_shape, dtype=dtype)
+        array.ravel()[mask.get_index()] = 1
+        return array
+
+    def crop(self, bound_box: tuple[int, int, int, int]) -> "RunLengthMask":
+        """mask in the coordinates of the crop (left, upper, right, lower) as PIL.Image.crop"""
+        left, upper, right, lower = bound_box
+        y, x_start, x_end = (self.run_array[:, column].astype(np.int64) for column in range(3))
+        x_start, x_end = np.maximum(x_start, left), np.minimum(x_end, right)
+        is_inside = (upper <= y) & (y < lower) & (x_start < x_end)
+        run_array = np.stack([y[is_inside] - upper, x_start[is_inside] - left, x_end[is_inside] - left], axis=1)
+        return RunLengthMask((lower - upper, right - left), run_array.astype(self.run_array.dtype))
+
+    def union(self, other: "RunLengthMask") -> "RunLengthMask":
+        return self.combine(other, np.logical_or)
+
+    def intersection(self, other: "RunLengthMask") -> "RunLengthMask":
+        return self.combine(other, np.logical_and)
+
+    def difference(self, other: "RunLengthMask") -> "RunLengthMask":
+        return self.combine(other, lambda is_in_self, is_in_other: is_in_self & ~is_in_other)
+
+    def combine(self, other: "RunLengthMask", operation: callable) -> "RunLengthMask":
+        """
+        cells where operation(in self, in other) holds. between two consecutive run boundaries of both masks
+        a cell is in or out of each mask as a whole, so the result is decided once per such segment.
+        """
+        if self.array_shape != other.array_shape:
+            raise ValueError("masks must have the same array_shape.")
+        start_a, end_a = self.get_run_key()
+        start_b, end_b = other.get_run_key()
+        boundary = np.unique(np.concatenate([start_a, end_a, start_b, end_b]))
+        if boundary.size == 0:
+            return RunLengthMask(self.array_shape, self.run_array[:0])
+        # a boundary is in a mask when more runs have started than ended up to it
+        is_in_a = np.searchsorted(start_a, boundary, side="right") > np.searchsorted(end_a, boundary, side="right")
+        is_in_b = np.searchsorted(start_b, boundary, side="right") > np.searchsorted(end_b, boundary, side="right")
+        is_in = operation(is_in_a, is_in_b)[:-1]
+        segment_start, segment_end = boundary[:-1][is_in], boundary[1:][is_in]
+        # segments that touch are one run
+        is_run_start = np.ones(segment_start.size, dtype=np.bool_)
+        is_run_start[1:] = segment_start[1:] != segment_end[:-1]
+        is_run_end = np.ones(segment_start.size, dtype=np.bool_)
+        is_run_end[:-1] = is_run_start[1:]
+        row_width = self.array_shape[1] + 1
+        y, x_start = np.divmod(segment_start[is_run_start], row_width)
+        x_end = segment_end[is_run_end] - y * row_width
+        return RunLengthMask(self.array_shape, np.stack([y, x_start, x_end], axis=1).astype(self.run_array.dtype))
+
+    def get_run_key(self) -> tuple[np.ndarray, np.ndarray]:
+        """start and end of the runs as y * (x_size + 1) + x, rows are apart so that their runs never touch"""
+        row_width = self.array_shape[1] + 1
+        y = self.run_array[:, 0].astype(np.int64) * row_width
+        return y + self.run_array[:, 1], y + self.run_array[:, 2]
+
+    def get_iou(self, other: "RunLengthMask") -> float:
+        """intersection over union of the cells, None when both are empty"""
+        intersection_cnt = self.intersection(other).get_cell_cnt()
+        union_cnt = self.get_cell_cnt() + other.get_cell_cnt() - intersection_cnt
+        return intersection_cnt / union_cnt if union_cnt > 0 else None
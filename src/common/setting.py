@@ -1,2 +1,3 @@
 class ValueSetting:
     nodata = 0
+    km_per_degree = 111.32
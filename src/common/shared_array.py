@@ -0,0 +1,40 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedArray:
+    """
+    numpy array on multiprocessing shared memory.
+    the owner creates it from an array and the workers attach it by descriptor (read-only by default).
+    """
+
+    def __init__(self, shared_memory_block: shared_memory.SharedMemory, shape: tuple, dtype: str, is_owner: bool):
+        self.shared_memory_block = shared_memory_block
+        self.shape = shape
+        self.dtype = dtype
+        self.is_owner = is_owner
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shared_memory_block.buf)
+
+    @classmethod
+    def create_from_array(cls, array: np.ndarray) -> "SharedArray":
+        shared_memory_block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared_array = cls(shared_memory_block, array.shape, array.dtype.str, is_owner=True)
+        shared_array.array[...] = array
+        return shared_array
+
+    @classmethod
+    def attach(cls, descriptor: tuple[str, tuple, str], is_writable: bool = False) -> "SharedArray":
+        name, shape, dtype = descriptor
+        shared_memory_block = shared_memory.SharedMemory(name=name)
+        shared_array = cls(shared_memory_block, shape, dtype, is_owner=False)
+        shared_array.array.flags.writeable = is_writable
+        return shared_array
+
+    def get_descriptor(self) -> tuple[str, tuple, str]:
+        return (self.shared_memory_block.name, self.shape, self.dtype)
+
+    def close(self):
+        self.array = None
+        self.shared_memory_block.close()
+        if self.is_owner:
+            self.shared_memory_block.unlink()
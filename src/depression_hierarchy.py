@@ -0,0 +1,275 @@
+import heapq
+
+import numpy as np
+
+from pit_fill import PriorityFloodPitFill
+
+DEPRESSION_COLUMNS = [
+    "depression_id",
+    "label",
+    "parent_id",
+    "child_id",
+    "spill_x",
+    "spill_y",
+    "spill_elevation",
+    "min_elevation",
+    "depth_m",
+    "area_km2",
+    "volume_m3",
+]
+
+
+class DepressionHierarchy:
+    """
+    depressions of a DEM and how they merge while they fill,
+    after Barnes, Callaghan and Wickert, Earth Surface Dynamics 8 (2020) 431-445.
+    one priority-flood pass from the outlets (border and cells next to nodata) and from every pit
+    labels the cells by the pit they drain to (label_array, 0 where they drain to an outlet)
+    and keeps the lowest pass between every two adjacent labels.
+    the passes in ascending order merge the depressions into a tree: the two depressions meeting at a pass
+    are both full at its elevation and become the children of a new depression,
+    a depression meeting an outlet spills there and is a root.
+    nodes: leaves (one per pit, node = label - 1) first, then the merged depressions, children before parents.
+    """
+
+    def __init__(self, cell_area_km2: float = 1.0):
+        self.cell_area_km2 = cell_area_km2
+        self.label_array: np.ndarray = None
+        self.leaf_cnt = 0
+        self.parent: np.ndarray = None
+        self.child: np.ndarray = None
+        self.spill_elevation: np.ndarray = None
+        self.spill_index: np.ndarray = None
+        self.min_elevation: np.ndarray = None
+        self.cell_cnt: np.ndarray = None
+        self.volume: np.ndarray = None
+
+    def derive(self, dem_array: np.ndarray, is_active: np.ndarray = None):
+        spill_dict, leaf_min_elevation = self.flood_from_pit(dem_array, is_active)
+        self.merge_depression(spill_dict, leaf_min_elevation)
+        self.set_volume(dem_array)
+
+    def flood_from_pit(self, dem_array: np.ndarray, is_active: np.ndarray = None) -> tuple[dict, list[float]]:
+        """
+        label_array, the lowest pass {(label_a, label_b): (elevation, flattened index of the pass cell)}
+        with outlets as label 0, and the elevation of every pit.
+        cells are flooded in order of their own elevation, so every cell gets the label of a pit
+        or an outlet it descends to. cells of a flat pit share the label of the first of them.
+        """
+        y_size, x_size = dem_array.shape
+        dem_array = np.asarray(dem_array)
+        if is_active is None:
+            is_active = np.ones((y_size, x_size), dtype=np.bool_)
+        is_outlet, _ = PriorityFloodPitFill().get_outlet_array(is_active)
+        is_pit = is_active & ~is_outlet & (dem_array <= self.get_lowest_neighbor_array(dem_array, is_active))
+        # -1 until flooded, 0 for cells flooded from an outlet
+        label_array = np.full((y_size, x_size), -1, dtype=np.int32)
+        label_array[is_outlet] = 0
+        is_closed = ~is_active | is_outlet
+        is_expanded = np.zeros((y_size, x_size), dtype=np.bool_)
+        seed_y, seed_x = np.nonzero(is_outlet | is_pit)
+        queue = list(zip(dem_array[seed_y, seed_x].tolist(), seed_y.tolist(), seed_x.tolist()))
+        heapq.heapify(queue)
+        spill_dict = {}
+        leaf_min_elevation = []
+        while queue:
+            elevation, y, x = heapq.heappop(queue)
+            if is_expanded[y, x]:
+                continue
+            is_expanded[y, x] = True
+            if label_array[y, x] == -1:
+                leaf_min_elevation.append(elevation)
+                label_array[y, x] = len(leaf_min_elevation)
+                is_closed[y, x] = True
+            label = label_array[y, x]
+            for ny in range(max(y - 1, 0), min(y + 2, y_size)):
+                for nx in range(max(x - 1, 0), min(x + 2, x_size)):
+                    if is_closed[ny, nx]:
+                        neighbor_label = label_array[ny, nx]
+                        if neighbor_label >= 0 and neighbor_label != label:
+                            # the pass is the higher cell of the two
+                            if dem_array[ny, nx] > elevation:
+                                pass_elevation, pass_index = dem_array[ny, nx], ny * x_size + nx
+                            else:
+                                pass_elevation, pass_index = elevation, y * x_size + x
+                            self._update_pass(spill_dict, label, neighbor_label, pass_elevation, pass_index)
+                        continue
+                    is_closed[ny, nx] = True
+                    label_array[ny, nx] = label
+                    heapq.heappush(queue, (dem_array[ny, nx], ny, nx))
+        label_array[label_array < 0] = 0
+        self.label_array = label_array
+        self.leaf_cnt = len(leaf_min_elevation)
+        return spill_dict, leaf_min_elevation
+
+    def get_lowest_neighbor_array(self, dem_array: np.ndarray, is_active: np.ndarray) -> np.ndarray:
+        """lowest elevation of the 8 active neighbors, inf without one"""
+        y_size, x_size = dem_array.shape
+        padded = np.pad(np.where(is_active, dem_array, np.inf), 1, constant_values=np.inf)
+        lowest_neighbor_array = np.full((y_size, x_size), np.inf)
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                if dy == 1 and dx == 1:
+                    continue
+                np.minimum(lowest_neighbor_array, padded[dy : dy + y_size, dx : dx + x_size], out=lowest_neighbor_array)
+        return lowest_neighbor_array
+
+    def _update_pass(self, spill_dict: dict, label_a: int, label_b: int, elevation: float, pass_index: int):
+        key = (min(label_a, label_b), max(label_a, label_b))
+        if (elevation, pass_index) < spill_dict.get(key, (float("inf"), -1)):
+            spill_dict[key] = (float(elevation), pass_index)
+
+    def merge_depression(self, spill_dict: dict, leaf_min_elevation: list[float]):
+        """the tree of depressions by the passes in ascending order (Kruskal with union-find on the labels)"""
+        leaf_cnt = self.leaf_cnt
+        # union-find over the labels, the outlets are label 0
+        root = list(range(leaf_cnt + 1))
+        component_node = [-1] + list(range(leaf_cnt))
+
+        def find(label: int) -> int:
+            while root[label] != label:
+                root[label] = root[root[label]]
+                label = root[label]
+            return label
+
+        parent_list = [-1] * leaf_cnt
+        child_list = [(-1, -1)] * leaf_cnt
+        spill_list = [(float("inf"), -1)] * leaf_cnt
+        for (label_a, label_b), (elevation, pass_index) in sorted(spill_dict.items(), key=lambda item: item[1]):
+            root_a, root_b = find(label_a), find(label_b)
+            if root_a == root_b:
+                continue
+            outlet_root = find(0)
+            if outlet_root in (root_a, root_b):
+                # the depression spills to an outlet
+                node = component_node[root_b if root_a == outlet_root else root_a]
+                spill_list[node] = (elevation, pass_index)
+                root[root_a if root_a != outlet_root else root_b] = outlet_root
+                continue
+            node_a, node_b = component_node[root_a], component_node[root_b]
+            new_node = len(parent_list)
+            parent_list[node_a] = parent_list[node_b] = new_node
+            spill_list[node_a] = spill_list[node_b] = (elevation, pass_index)
+            parent_list.append(-1)
+            child_list.append((node_a, node_b))
+            spill_list.append((float("inf"), -1))
+            root[root_b] = root_a
+            component_node[root_a] = new_node
+        self.parent = np.array(parent_list, dtype=np.int64)
+        self.child = np.array(child_list, dtype=np.int64).reshape(-1, 2)
+        self.spill_elevation = np.array([spill[0] for spill in spill_list], dtype=np.float64)
+        self.spill_index = np.array([spill[1] for spill in spill_list], dtype=np.int64)
+        min_elevation = np.full(len(parent_list), np.inf)
+        min_elevation[:leaf_cnt] = leaf_min_elevation
+        for node in range(leaf_cnt, len(parent_list)):
+            min_elevation[node] = min_elevation[self.child[node]].min()
+        self.min_elevation = min_elevation
+
+    def set_volume(self, dem_array: np.ndarray):
+        """
+        cells and volume below the spill elevation of every depression.
+        a cell belongs to the lowest depression containing its pit whose spill elevation is above the cell,
+        found for all cells at once by climbing the tree in powers of two.
+        """
+        node_cnt = self.parent.size
+        label = self.label_array.ravel()
+        is_labeled = label > 0
+        elevation = np.asarray(dem_array).ravel()[is_labeled].astype(np.float64)
+        node = label[is_labeled].astype(np.int64) - 1
+        # node_cnt is a virtual root above every root with an infinite spill elevation
+        spill_elevation = np.append(self.spill_elevation, np.inf)
+        ancestor = np.append(np.where(self.parent >= 0, self.parent, node_cnt), node_cnt)
+        ancestor_list = [ancestor]
+        while not np.array_equal(ancestor_list[-1][ancestor_list[-1]], ancestor_list[-1]):
+            ancestor_list.append(ancestor_list[-1][ancestor_list[-1]])
+        # climb while the spill elevation of the node is not above the cell
+        is_above_spill = spill_elevation[node] <= elevation
+        for ancestor in reversed(ancestor_list):
+            candidate = ancestor[node]
+            is_climbing = is_above_spill & (spill_elevation[candidate] <= elevation)
+            node = np.where(is_climbing, candidate, node)
+        node = np.where(is_above_spill, ancestor_list[0][node], node)
+        is_in_depression = node < node_cnt
+        band_cnt = np.bincount(node[is_in_depression], minlength=node_cnt)
+        band_sum = np.bincount(node[is_in_depression], weights=elevation[is_in_depression], minlength=node_cnt)
+        # children are before their parents
+        cell_cnt, elevation_sum = band_cnt.astype(np.int64), band_sum
+        for parent_node in range(self.leaf_cnt, node_cnt):
+            cell_cnt[parent_node] += cell_cnt[self.child[parent_node]].sum()
+            elevation_sum[parent_node] += elevation_sum[self.child[parent_node]].sum()
+        self.cell_cnt = cell_cnt
+        is_finite = np.isfinite(self.spill_elevation)
+        finite_spill_elevation = np.where(is_finite, self.spill_elevation, 0)
+        self.volume = np.where(is_finite, cell_cnt * finite_spill_elevation - elevation_sum, np.inf)
+
+    def get_depth(self) -> np.ndarray:
+        return self.spill_elevation - self.min_elevation
+
+    def get_area_km2(self) -> np.ndarray:
+        return self.cell_cnt * self.cell_area_km2
+
+    def get_volume_m3(self) -> np.ndarray:
+        """elevations in m"""
+        return self.volume * self.cell_area_km2 * 1e6
+
+    def get_filled_node_array(
+        self, max_volume_m3: float = None, max_area_km2: float = None, max_depth_m: float = None
+    ) -> np.ndarray:
+        """depressions within every given threshold, a threshold of None is not checked"""
+        is_filled = np.isfinite(self.spill_elevation)
+        if max_volume_m3 is not None:
+            is_filled &= self.get_volume_m3() <= max_volume_m3
+        if max_area_km2 is not None:
+            is_filled &= self.get_area_km2() <= max_area_km2
+        if max_depth_m is not None:
+            is_filled &= self.get_depth() <= max_depth_m
+        return is_filled
+
+    def get_selectively_filled_array(
+        self,
+        dem_array: np.ndarray,
+        max_volume_m3: float = None,
+        max_area_km2: float = None,
+        max_depth_m: float = None,
+    ) -> np.ndarray:
+        """
+        DEM with the depressions within the thresholds filled to their spill elevation, from the stored tree.
+        volume, area and depth grow towards the root, so the filled depressions are the subtrees
+        below the highest filled ancestor of every pit; larger depressions are kept as sinks.
+        """
+        is_filled = self.get_filled_node_array(max_volume_m3, max_area_km2, max_depth_m)
+        node_cnt = self.parent.size
+        fill_level = np.full(node_cnt, -np.inf)
+        for node in range(node_cnt - 1, -1, -1):
+            parent = self.parent[node]
+            if parent >= 0 and is_filled[parent]:
+                fill_level[node] = fill_level[parent]
+            elif is_filled[node]:
+                fill_level[node] = self.spill_elevation[node]
+        label_fill_level = np.concatenate([[-np.inf], fill_level[: self.leaf_cnt]])
+        filled_array = np.maximum(dem_array, label_fill_level[self.label_array]).astype(dem_array.dtype)
+        return filled_array
+
+    def get_table(self) -> list[dict]:
+        """one row per depression, parent_id 0 for depressions spilling to an outlet"""
+        x_size = self.label_array.shape[1]
+        depth, area_km2, volume_m3 = self.get_depth(), self.get_area_km2(), self.get_volume_m3()
+        row_list = []
+        for node in range(self.parent.size):
+            spill_y, spill_x = divmod(int(self.spill_index[node]), x_size)
+            row_list.append(
+                {
+                    "depression_id": node + 1,
+                    "label": node + 1 if node < self.leaf_cnt else 0,
+                    "parent_id": int(self.parent[node]) + 1,
+                    "child_id": " ".join(str(child + 1) for child in self.child[node] if child >= 0),
+                    "spill_x": spill_x if self.spill_index[node] >= 0 else None,
+                    "spill_y": spill_y if self.spill_index[node] >= 0 else None,
+                    "spill_elevation": float(self.spill_elevation[node]),
+                    "min_elevation": float(self.min_elevation[node]),
+                    "depth_m": float(depth[node]),
+                    "area_km2": float(area_km2[node]),
+                    "volume_m3": float(volume_m3[node]),
+                }
+            )
+        return row_list
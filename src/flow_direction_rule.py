@@ -1,4 +1,11 @@
+import numpy as np
+
+from common.layer_dtype import LayerDtypePolicy
+
+
 class FlowDirectionRuleMatrix:
+    # (dx, dy) of the 8 neighbors, the D8 code of the k-th neighbor is 1 << k
+    NEIGHBOR_DELTA_XY = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
     D8 = [
         [32, 64, 128],
         [16, 0, 1],
@@ -29,8 +36,8 @@ class FlowDirectionRule(FlowDirectionRuleMatrix):
             self.flow_direction_rule_matrix = self.D8
         elif self.flow_direction_rule == "D16":
             self.flow_direction_rule_matrix = self.D16
-        self.set_dy_range()
-        self.set_dx_range()
+        self.dy_range = self.set_dy_range()
+        self.dx_range = self.set_dx_range()
 
     def set_dy_range(self) -> range:
         y_start = (len(self.flow_direction_rule_matrix) // 2) * -1
@@ -55,6 +62,52 @@ class FlowDirectionRule(FlowDirectionRuleMatrix):
         x = dx + (len(self.flow_direction_rule_matrix[0]) // 2)
         return self.flow_direction_rule_matrix[y][x]
 
+    def get_delta_xy_table(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        lookup tables indexed by flow direction code (0-255): dx, dy and whether the code points to a neighbor.
+        the center code (no flow direction) and codes not in the rule matrix are not valid.
+        """
+        dx_table = np.zeros(256, dtype=np.int64)
+        dy_table = np.zeros(256, dtype=np.int64)
+        is_valid_table = np.zeros(256, dtype=np.bool_)
+        y_start = (len(self.flow_direction_rule_matrix) // 2) * -1
+        x_start = (len(self.flow_direction_rule_matrix[0]) // 2) * -1
+        for dy, rule_x in enumerate(self.flow_direction_rule_matrix, y_start):
+            for dx, rule in enumerate(rule_x, x_start):
+                if rule is None or self.is_center(dx, dy):
+                    continue
+                dx_table[rule] = dx
+                dy_table[rule] = dy
+                is_valid_table[rule] = True
+        return dx_table, dy_table, is_valid_table
+
+    def get_receiver_index_array(self, flow_direction_array: np.ndarray) -> np.ndarray:
+        """
+        flattened index of the downstream cell for every cell.
+        -1 where the flow leaves the array or has no direction (edge and sink outlets).
+        """
+        y_size, x_size = flow_direction_array.shape
+        index_dtype = LayerDtypePolicy().get_index_dtype(y_size * x_size)
+        dx_table, dy_table, is_valid_table = self.get_delta_xy_table()
+        # the lowest byte of the code, as the & 0xFF of the lookup tables
+        code = np.asarray(flow_direction_array).astype(np.uint8, copy=False)
+        nx = np.arange(x_size, dtype=index_dtype)[np.newaxis, :] + dx_table.astype(index_dtype)[code]
+        ny = np.arange(y_size, dtype=index_dtype)[:, np.newaxis] + dy_table.astype(index_dtype)[code]
+        is_inside = is_valid_table[code] & (0 <= nx) & (nx < x_size) & (0 <= ny) & (ny < y_size)
+        receiver_index_array = np.where(is_inside, ny * x_size + nx, -1).astype(index_dtype, copy=False)
+        return receiver_index_array.ravel()
+
+    def get_receiver_index_of_cells(self, flow_direction_array: np.ndarray, flat_index: np.ndarray) -> np.ndarray:
+        """get_receiver_index_array for the cells at flat_index only"""
+        y_size, x_size = flow_direction_array.shape
+        dx_table, dy_table, is_valid_table = self.get_delta_xy_table()
+        code = np.asarray(flow_direction_array).ravel()[flat_index].astype(np.uint8, copy=False)
+        y, x = np.divmod(np.asarray(flat_index).astype(np.int64), x_size)
+        nx = x + dx_table[code]
+        ny = y + dy_table[code]
+        is_inside = is_valid_table[code] & (0 <= nx) & (nx < x_size) & (0 <= ny) & (ny < y_size)
+        return np.where(is_inside, ny * x_size + nx, -1)
+
     def is_center(self, dx: int, dy: int) -> bool:
         if dx == 0 and dy == 0:
             return True
@@ -0,0 +1,132 @@
+import logging
+
+import numpy as np
+
+from common.active_cell import ActiveCellIndex
+from common.figure_setting import TiffTag
+from common.flow_graph import get_topological_wave_list
+from common.layer_dtype import LayerDtypePolicy
+from common.logging_decorator import logging_decorator
+from common.util import load_json
+from make_catchment_area import CatchmentAreaArrangement
+from make_catchment_area import FlowDirection
+
+
+FLOW_DIRECTION_PATH = "base_data/FlowDir_30m_drone_mean.tif"
+DAM_GEOJSON_PATH = "base_data/W01-14-g_Dam.geojson"
+SAVE_DIR = "output/flow-length"
+
+
+def main():
+    catchment_area = CatchmentAreaArrangement()
+    catchment_area.set_save_dir(SAVE_DIR)
+    catchment_area.set_flow_direction_rule("D8")
+    catchment_area.set_flow_direction(FLOW_DIRECTION_PATH)
+    catchment_area.derive_flow_accumulation()
+    catchment_area.set_dam_point_as_mouth(load_json(DAM_GEOJSON_PATH), "松尾", "小丸川")
+    flow_direction_array = np.asarray(catchment_area.flow_direction)
+    flow_length = FlowLength(catchment_area)
+    flow_length.derive(flow_direction_array, catchment_area.get_catchment_area_array(flow_direction_array))
+    flow_length.save()
+
+
+class FlowLength:
+    """
+    longest flow path above every cell (upstream flow length) and length of the flow path below it to the outlet
+    (distance to outlet) in km, for travel time estimates.
+    a step is the distance between the cell centers, so diagonal and D16 steps are longer than straight ones,
+    with the pixel size of ModelPixelScaleTag (degrees at the center latitude as get_cell_area_km2).
+    upstream flow length is one topological pass from the heads down, distance to outlet the same waves reversed.
+    the cells can be restricted to a bound box and a mask (e.g., a catchment area), flow leaving them ends there.
+    """
+
+    def __init__(self, catchment_area: FlowDirection):
+        self.catchment_area = catchment_area
+        self.cell_index: ActiveCellIndex = None
+        self.upstream_length_km: np.ndarray = None
+        self.distance_to_outlet_km: np.ndarray = None
+
+    @logging_decorator
+    def derive(
+        self,
+        flow_direction_array: np.ndarray,
+        mask_array: np.ndarray = None,
+        bound_box: tuple[int, int, int, int] = None,
+    ):
+        """
+        mask_array: only its non-zero cells, within their bound box unless bound_box is given
+        bound_box: (left, upper, right, lower) as PIL.Image.crop
+        """
+        flow_direction_array = np.asarray(flow_direction_array)
+        self.cell_index = self.get_cell_index(flow_direction_array.shape, mask_array, bound_box)
+        cell_index = self.cell_index.active_index
+        receiver_index = self.catchment_area.get_receiver_index_of_cells(flow_direction_array, cell_index)
+        # receivers in cell positions, -1 where the flow leaves the cells
+        receiver_array = self.cell_index.get_position(receiver_index)
+        code = flow_direction_array.ravel()[cell_index].astype(np.uint8, copy=False)
+        step_km = np.where(receiver_array >= 0, self.get_step_length_table()[code], 0.0)
+        wave_list = get_topological_wave_list(receiver_array)
+        self.upstream_length_km = np.zeros(receiver_array.size, dtype=np.float64)
+        for wave in wave_list:
+            receiver = receiver_array[wave]
+            has_receiver = receiver >= 0
+            donor, receiver = wave[has_receiver], receiver[has_receiver]
+            np.maximum.at(self.upstream_length_km, receiver, self.upstream_length_km[donor] + step_km[donor])
+        self.distance_to_outlet_km = np.zeros(receiver_array.size, dtype=np.float64)
+        for wave in reversed(wave_list):
+            receiver = receiver_array[wave]
+            has_receiver = receiver >= 0
+            donor, receiver = wave[has_receiver], receiver[has_receiver]
+            self.distance_to_outlet_km[donor] = self.distance_to_outlet_km[receiver] + step_km[donor]
+        logging.info(f"{cell_index.size} cells, longest flow path {self.upstream_length_km.max(initial=0):.3f} km")
+
+    def get_cell_index(
+        self,
+        array_shape: tuple[int, int],
+        mask_array: np.ndarray = None,
+        bound_box: tuple[int, int, int, int] = None,
+    ) -> ActiveCellIndex:
+        """valid cells of the scene in the mask and the bound box"""
+        active_cell_index = self.catchment_area.get_active_cell_index(array_shape)
+        if mask_array is None and bound_box is None:
+            if active_cell_index is not None:
+                return active_cell_index
+            return ActiveCellIndex(array_shape, np.arange(array_shape[0] * array_shape[1]))
+        if bound_box is None:
+            y, x = np.nonzero(mask_array)
+            if y.size == 0:
+                raise ValueError("mask has no cell.")
+            bound_box = (int(x.min()), int(y.min()), int(x.max()) + 1, int(y.max()) + 1)
+        left, upper, right, lower = bound_box
+        is_inside = np.ones((lower - upper, right - left), dtype=np.bool_)
+        if mask_array is not None:
+            is_inside &= np.asarray(mask_array)[upper:lower, left:right] != 0
+        if active_cell_index is not None:
+            is_inside &= active_cell_index.get_active_array()[upper:lower, left:right]
+        y, x = np.nonzero(is_inside)
+        index_dtype = LayerDtypePolicy().get_index_dtype(array_shape[0] * array_shape[1])
+        return ActiveCellIndex(array_shape, ((y + upper) * array_shape[1] + x + left).astype(index_dtype))
+
+    def get_step_length_table(self) -> np.ndarray:
+        """length in km of the step of every flow direction code (0-255), 0 for codes without a neighbor"""
+        dx_table, dy_table, is_valid_table = self.catchment_area.get_delta_xy_table()
+        x_resolution_km, y_resolution_km, _ = self.catchment_area.change_resolution_to_km(
+            self.catchment_area.image_tag[TiffTag.ModelPixelScaleTag]
+        )
+        return np.where(is_valid_table, np.hypot(dx_table * x_resolution_km, dy_table * y_resolution_km), 0.0)
+
+    def get_upstream_length_array(self) -> np.ndarray:
+        """upstream flow length raster in km, 0 at heads and off the cells"""
+        return self.cell_index.scatter(self.upstream_length_km.astype(np.float32), 0)
+
+    def get_distance_to_outlet_array(self) -> np.ndarray:
+        """distance to outlet raster in km, 0 at outlets and off the cells"""
+        return self.cell_index.scatter(self.distance_to_outlet_km.astype(np.float32), 0)
+
+    def save(self):
+        self.catchment_area.save_tiff(self.get_upstream_length_array(), "upstream_flow_length")
+        self.catchment_area.save_tiff(self.get_distance_to_outlet_array(), "distance_to_outlet")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import numpy as np
+
+from flow_direction_rule import FlowDirectionRuleMatrix
+
+
+class FlowProportion:
+    """
+    flow proportion to the 8 neighbors of every cell, shape (8, y, x) in NEIGHBOR_DELTA_XY order.
+    proportions are stored as uint16 summing to PROPORTION_SCALE (0 for cells without downslope neighbor).
+    """
+
+    PROPORTION_SCALE = 65535
+
+    def quantize_proportion(self, proportion_array: np.ndarray) -> np.ndarray:
+        """float proportions (summing to 1 or 0) to uint16, the rounding remainder goes to the largest one"""
+        quantized_array = np.floor(proportion_array * self.PROPORTION_SCALE).astype(np.int64)
+        remainder = np.where(
+            proportion_array.sum(axis=0) > 0,
+            self.PROPORTION_SCALE - quantized_array.sum(axis=0),
+            0,
+        )
+        largest = np.argmax(proportion_array, axis=0)
+        np.put_along_axis(
+            quantized_array,
+            largest[np.newaxis],
+            np.take_along_axis(quantized_array, largest[np.newaxis], axis=0) + remainder,
+            axis=0,
+        )
+        return quantized_array.astype(np.uint16)
+
+    def get_dominant_flow_direction_array(
+        self, flow_proportion_array: np.ndarray, neighbor_code_list: list[int] = None
+    ) -> np.ndarray:
+        """
+        code of the neighbor receiving the largest proportion, 0 for cells without flow.
+        neighbor_code_list: code of each of the 8 neighbors in the rule matrix, D8 codes (1 << k) by default.
+        """
+        if neighbor_code_list is None:
+            neighbor_code_list = [1 << k for k in range(len(FlowDirectionRuleMatrix.NEIGHBOR_DELTA_XY))]
+        dominant = np.argmax(flow_proportion_array, axis=0)
+        code = np.asarray(neighbor_code_list, dtype=np.uint8)[dominant]
+        return np.where(flow_proportion_array.max(axis=0) > 0, code, 0).astype(np.uint8)
+
+    def get_neighbor_drop_array(self, dem_array: np.ndarray) -> np.ndarray:
+        """elevation drop to each of the 8 neighbors, nan outside the array"""
+        y_size, x_size = dem_array.shape
+        padded = np.pad(np.asarray(dem_array, dtype=np.float64), 1, constant_values=np.nan)
+        drop_array = np.empty((8, y_size, x_size), dtype=np.float64)
+        center = padded[1 : y_size + 1, 1 : x_size + 1]
+        for k, (dx, dy) in enumerate(FlowDirectionRuleMatrix.NEIGHBOR_DELTA_XY):
+            drop_array[k] = center - padded[1 + dy : y_size + 1 + dy, 1 + dx : x_size + 1 + dx]
+        return drop_array
+
+
+class DInfinityFlowProportion(FlowProportion):
+    """
+    A new method for the determination of flow directions and upslope areas in grid digital elevation models
+    by D. G. Tarboton, Water Resources Research 33 (1997) 309-319
+    flow is split between the two neighbors bounding the steepest of the 8 triangular facets.
+    """
+
+    def get_flow_proportion_array(self, dem_array: np.ndarray) -> np.ndarray:
+        drop_array = self.get_neighbor_drop_array(dem_array)
+        y_size, x_size = dem_array.shape
+        max_slope = np.zeros((y_size, x_size), dtype=np.float64)
+        cardinal_proportion = np.zeros((y_size, x_size), dtype=np.float64)
+        cardinal = np.zeros((y_size, x_size), dtype=np.int64)
+        diagonal = np.zeros((y_size, x_size), dtype=np.int64)
+        for cardinal_k in (0, 2, 4, 6):
+            for diagonal_k in ((cardinal_k + 1) % 8, (cardinal_k - 1) % 8):
+                s1 = drop_array[cardinal_k]
+                s2 = drop_array[diagonal_k] - drop_array[cardinal_k]
+                with np.errstate(invalid="ignore"):
+                    angle = np.arctan2(s2, s1)
+                    slope = np.hypot(s1, s2)
+                    slope = np.where(angle < 0, s1, slope)
+                    slope = np.where(angle > np.pi / 4, drop_array[diagonal_k] / np.sqrt(2), slope)
+                    angle = np.clip(angle, 0, np.pi / 4)
+                    is_steeper = np.nan_to_num(slope, nan=-np.inf) > max_slope
+                max_slope = np.where(is_steeper, slope, max_slope)
+                cardinal_proportion = np.where(is_steeper, 1 - angle / (np.pi / 4), cardinal_proportion)
+                cardinal = np.where(is_steeper, cardinal_k, cardinal)
+                diagonal = np.where(is_steeper, diagonal_k, diagonal)
+        has_flow = max_slope > 0
+        proportion_array = np.zeros((8, y_size, x_size), dtype=np.float64)
+        np.put_along_axis(proportion_array, cardinal[np.newaxis], (cardinal_proportion * has_flow)[np.newaxis], axis=0)
+        diagonal_proportion = np.take_along_axis(proportion_array, diagonal[np.newaxis], axis=0)
+        diagonal_proportion += ((1 - cardinal_proportion) * has_flow)[np.newaxis]
+        np.put_along_axis(proportion_array, diagonal[np.newaxis], diagonal_proportion, axis=0)
+        return self.quantize_proportion(proportion_array)
+
+
+class FreemanFlowProportion(FlowProportion):
+    """
+    Calculating catchment area with divergent flow based on a regular grid
+    by T. G. Freeman, Computers & Geosciences 17 (1991) 413-422
+    flow is split among all downslope neighbors in proportion to (tan slope) ** exponent.
+    """
+
+    exponent = 1.1
+
+    def get_flow_proportion_array(self, dem_array: np.ndarray) -> np.ndarray:
+        drop_array = self.get_neighbor_drop_array(dem_array)
+        distance = np.array([np.hypot(dx, dy) for dx, dy in FlowDirectionRuleMatrix.NEIGHBOR_DELTA_XY])
+        tan_slope = np.nan_to_num(drop_array / distance[:, np.newaxis, np.newaxis], nan=0.0).clip(min=0)
+        weight_array = tan_slope**self.exponent
+        weight_sum = weight_array.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            proportion_array = np.where(weight_sum > 0, weight_array / weight_sum, 0.0)
+        return self.quantize_proportion(proportion_array)
+
+
+class FlowRoutingAlgorithm(DInfinityFlowProportion, FreemanFlowProportion):
+    def select_algorithm(self, algorithm: str) -> callable:
+        if algorithm == "d_infinity":
+            return self.d_infinity
+        elif algorithm == "mfd":
+            return self.mfd
+        else:
+            raise ValueError("algorithm must be d_infinity or mfd")
+
+    def d_infinity(self, dem_array: np.ndarray) -> np.ndarray:
+        return DInfinityFlowProportion.get_flow_proportion_array(self, dem_array)
+
+    def mfd(self, dem_array: np.ndarray) -> np.ndarray:
+        return FreemanFlowProportion.get_flow_proportion_array(self, dem_array)
@@ -0,0 +1,273 @@
+import logging
+
+import numpy as np
+
+from common.active_cell import ActiveCellIndex
+from common.active_cell import get_active_array
+from common.flow_graph import accumulate_downstream
+from common.layer_dtype import LayerDtypePolicy
+from common.logging_decorator import logging_decorator
+from make_catchment_area import FlowAccumulation
+from parallel_pit_fill import TiledPriorityFloodPitFill
+from parallel_pit_fill import finalize_tile_array
+from parallel_pit_fill import flood_tile_array
+from pit_fill import PriorityFloodPitFill
+
+
+class IncrementalFlowUpdate:
+    """
+    pit fill, flow direction and flow accumulation kept up to date after local DEM edits.
+    pit fill keeps the tile floods of TiledPriorityFloodPitFill, so an edit only floods the edited tiles again,
+    solves the spill graph between tile labels and raises the tiles whose spill elevation changed.
+    flow direction is derived again around the cells whose filled elevation changed and flow accumulation
+    only on the old and new downstream paths of the cells whose receiver changed.
+    nodata cells are skipped as in the full computation (set_skipping_nodata), edits must keep them as they are.
+    the result is identical to a full recompute with priority_flood and steepest_descent.
+    """
+
+    def __init__(self, flow_accumulation: FlowAccumulation, tile_size: int = 256):
+        if flow_accumulation.pit_fill_rule != "priority_flood":
+            raise ValueError("incremental update is only for priority_flood.")
+        if flow_accumulation.is_multiple_flow_direction():
+            raise ValueError("incremental update is only for steepest_descent.")
+        self.flow_accumulation = flow_accumulation
+        self.tiled_pit_fill = TiledPriorityFloodPitFill(tile_size=tile_size)
+        self.tile_size = tile_size
+        self.max_label_per_tile = 4 * tile_size
+        self.radius = len(flow_accumulation.flow_direction_rule_matrix) // 2
+        self.tile_list: list[tuple[int, int, int, int]] = []
+        self.tile_result_list: list[dict] = []
+        self.spill_array: np.ndarray = None
+        self.nodata: float = None
+        self.is_active: np.ndarray = None
+        self.dem_array: np.ndarray = None
+        self.local_filled_array: np.ndarray = None
+        self.label_array: np.ndarray = None
+        self.pit_filled_array: np.ndarray = None
+        self.flow_direction_array: np.ndarray = None
+        self.receiver_index_array: np.ndarray = None
+        self.flux_array: np.ndarray = None
+
+    @logging_decorator
+    def initialize(self, dem_array: np.ndarray):
+        """full computation, the tile floods are kept for later updates"""
+        self.dem_array = np.array(LayerDtypePolicy().to_elevation(dem_array))
+        array_shape = self.dem_array.shape
+        self.flow_accumulation.derive_active_cell_index(self.dem_array)
+        active_cell_index = self.flow_accumulation.get_active_cell_index(array_shape)
+        self.nodata = None if active_cell_index is None else self.flow_accumulation.get_nodata()
+        self.is_active = None if active_cell_index is None else active_cell_index.get_active_array().ravel()
+        self.local_filled_array = np.empty(array_shape, dtype=np.float64)
+        self.label_array = np.empty(array_shape, dtype=np.int64)
+        self.tile_list = self.tiled_pit_fill.make_tile_list(array_shape)
+        self.tile_result_list = [None] * len(self.tile_list)
+        self.max_label_per_tile = self.get_max_label_per_tile()
+        for tile_index in range(len(self.tile_list)):
+            self.flood_tile(tile_index)
+        self.spill_array = self.solve_spill_graph()
+        self.pit_filled_array = np.empty_like(self.dem_array)
+        for tile_index in range(len(self.tile_list)):
+            self.finalize_tile(tile_index)
+
+        self.flow_direction_array = self.flow_accumulation.get_flow_direction_array(self.pit_filled_array)
+        receiver_index_array = self.flow_accumulation.get_receiver_index_array(self.flow_direction_array)
+        self.receiver_index_array = self.drop_receiver_in_nodata(receiver_index_array)
+        self.flux_array = accumulate_downstream(
+            self.receiver_index_array, np.ones(self.receiver_index_array.size, dtype=np.int64)
+        )
+        self.set_layers()
+
+    def get_max_label_per_tile(self) -> int:
+        """
+        a tile has at most one label per flood seed, its perimeter cells and the cells next to nodata.
+        edits keep the nodata cells, so the bound holds for every later flood.
+        """
+        if self.is_active is None:
+            return 4 * self.tile_size
+        is_active = self.is_active.reshape(self.dem_array.shape)
+        seed_cnt_list = [
+            np.count_nonzero(PriorityFloodPitFill().get_outlet_array(is_active[y_start:y_end, x_start:x_end])[0])
+            for y_start, y_end, x_start, x_end in self.tile_list
+        ]
+        return max(seed_cnt_list + [1])
+
+    def update_cells(self, x_list: list[int], y_list: list[int], value_list: list[float]):
+        """cells (x, y) of the DEM set to the values"""
+        x_array = np.asarray(x_list, dtype=np.int64)
+        y_array = np.asarray(y_list, dtype=np.int64)
+        self.check_nodata_kept(self.dem_array[y_array, x_array], np.asarray(value_list))
+        self.dem_array[y_array, x_array] = value_list
+        tile_x_cnt = -(-self.dem_array.shape[1] // self.tile_size)
+        edited_tile_index = np.unique((y_array // self.tile_size) * tile_x_cnt + x_array // self.tile_size)
+        self.update_tiles(edited_tile_index.tolist())
+
+    def update_bound_box(self, bound_box: tuple[int, int, int, int], dem_window: np.ndarray):
+        """DEM in bound_box (left, upper, right, lower) replaced with dem_window"""
+        left, upper, right, lower = bound_box
+        self.check_nodata_kept(self.dem_array[upper:lower, left:right], np.asarray(dem_window))
+        self.dem_array[upper:lower, left:right] = dem_window
+        edited_tile_index = [
+            tile_index
+            for tile_index, (y_start, y_end, x_start, x_end) in enumerate(self.tile_list)
+            if y_start < lower and upper < y_end and x_start < right and left < x_end
+        ]
+        self.update_tiles(edited_tile_index)
+
+    def check_nodata_kept(self, old_array: np.ndarray, new_array: np.ndarray):
+        """an edit adding or removing nodata cells changes the valid cells of every stage, initialize again"""
+        if not self.flow_accumulation.is_skipping_nodata:
+            return
+        nodata = self.flow_accumulation.get_nodata()
+        if not np.array_equal(get_active_array(old_array, nodata), get_active_array(new_array, nodata)):
+            raise ValueError("edits must not add or remove nodata cells, initialize again instead.")
+
+    @logging_decorator
+    def update_tiles(self, edited_tile_index: list[int]):
+        for tile_index in edited_tile_index:
+            self.flood_tile(tile_index)
+        old_spill_array = self.spill_array
+        self.spill_array = self.solve_spill_graph()
+        changed_label = np.flatnonzero(self.spill_array != old_spill_array)
+        changed_label = changed_label[changed_label > 0]
+        finalize_tile_index = set(edited_tile_index) | set(((changed_label - 1) // self.max_label_per_tile).tolist())
+        logging.info(f"{len(edited_tile_index)} tiles flooded, {len(finalize_tile_index)} tiles raised")
+
+        changed_index_list = [self.update_flow_direction(self.finalize_tile(i)) for i in sorted(finalize_tile_index)]
+        changed_index = np.concatenate([np.zeros(0, dtype=np.int64)] + changed_index_list)
+        self.update_flow_accumulation(changed_index)
+        self.set_layers()
+
+    def flood_tile(self, tile_index: int):
+        y_start, y_end, x_start, x_end = self.tile_list[tile_index]
+        label_offset = 1 + tile_index * self.max_label_per_tile
+        dem_tile = np.array(self.dem_array[y_start:y_end, x_start:x_end], dtype=np.float64)
+        filled_tile, label_tile, tile_result = flood_tile_array(
+            dem_tile, (y_start, x_start), label_offset, self.dem_array.shape[1], self.nodata
+        )
+        self.local_filled_array[y_start:y_end, x_start:x_end] = filled_tile
+        self.label_array[y_start:y_end, x_start:x_end] = label_tile
+        self.tile_result_list[tile_index] = tile_result
+
+    def solve_spill_graph(self) -> np.ndarray:
+        label_cnt = 1 + len(self.tile_list) * self.max_label_per_tile
+        return self.tiled_pit_fill.solve_spill_graph(self.tile_result_list, self.dem_array.shape, label_cnt)
+
+    def finalize_tile(self, tile_index: int) -> tuple[int, int, int, int]:
+        """bound box (left, upper, right, lower) of the cells whose filled elevation changed, None if no change"""
+        y_start, y_end, x_start, x_end = self.tile_list[tile_index]
+        label_offset = 1 + tile_index * self.max_label_per_tile
+        filled_tile = finalize_tile_array(
+            self.local_filled_array[y_start:y_end, x_start:x_end],
+            self.label_array[y_start:y_end, x_start:x_end],
+            label_offset,
+            self.spill_array[label_offset : label_offset + self.max_label_per_tile],
+        ).astype(self.pit_filled_array.dtype)
+        changed_y, changed_x = np.nonzero(filled_tile != self.pit_filled_array[y_start:y_end, x_start:x_end])
+        self.pit_filled_array[y_start:y_end, x_start:x_end] = filled_tile
+        if changed_y.size == 0:
+            return None
+        return (
+            x_start + changed_x.min(),
+            y_start + changed_y.min(),
+            x_start + changed_x.max() + 1,
+            y_start + changed_y.max() + 1,
+        )
+
+    def update_flow_direction(self, bound_box: tuple[int, int, int, int]) -> np.ndarray:
+        """flow direction around bound_box derived again, the flattened index of the changed cells is returned"""
+        if bound_box is None:
+            return np.zeros(0, dtype=np.int64)
+        y_size, x_size = self.dem_array.shape
+        left, upper, right, lower = bound_box
+        # cells within the rule radius see the changed cells, the window needs one more radius of neighbors
+        y_start, y_end = max(upper - self.radius, 0), min(lower + self.radius, y_size)
+        x_start, x_end = max(left - self.radius, 0), min(right + self.radius, x_size)
+        window_y_start, window_y_end = max(y_start - self.radius, 0), min(y_end + self.radius, y_size)
+        window_x_start, window_x_end = max(x_start - self.radius, 0), min(x_end + self.radius, x_size)
+        window_pit_filled = self.pit_filled_array[window_y_start:window_y_end, window_x_start:window_x_end]
+        if self.nodata is None:
+            window_flow_direction = self.flow_accumulation.get_steepest_descent_flow_direction_array(window_pit_filled)
+        else:
+            window_active_cell_index = ActiveCellIndex.from_array(
+                self.dem_array[window_y_start:window_y_end, window_x_start:window_x_end], self.nodata
+            )
+            window_flow_direction = self.flow_accumulation.get_active_steepest_descent_flow_direction_array(
+                window_pit_filled, window_active_cell_index
+            )
+        flow_direction = window_flow_direction[
+            y_start - window_y_start : y_end - window_y_start, x_start - window_x_start : x_end - window_x_start
+        ]
+        changed_y, changed_x = np.nonzero(flow_direction != self.flow_direction_array[y_start:y_end, x_start:x_end])
+        self.flow_direction_array[y_start:y_end, x_start:x_end] = flow_direction
+        return (changed_y + y_start) * x_size + (changed_x + x_start)
+
+    def get_receiver_index_of_cells(self, flat_index: np.ndarray) -> np.ndarray:
+        receiver_index = self.flow_accumulation.get_receiver_index_of_cells(self.flow_direction_array, flat_index)
+        return self.drop_receiver_in_nodata(receiver_index)
+
+    def drop_receiver_in_nodata(self, receiver_index: np.ndarray) -> np.ndarray:
+        """-1 where the flow goes into nodata, it leaves the scene as in calculate_active_flow_accumulation"""
+        if self.is_active is not None:
+            receiver_index[(receiver_index >= 0) & ~self.is_active[receiver_index]] = -1
+        return receiver_index
+
+    def trace_downstream(self, start_index: np.ndarray, is_visited: np.ndarray) -> list[np.ndarray]:
+        """cells downstream of start_index until the outlets or already visited cells"""
+        path_list = []
+        frontier = self.receiver_index_array[start_index]
+        while frontier.size > 0:
+            frontier = np.unique(frontier[frontier >= 0])
+            frontier = frontier[~is_visited[frontier]]
+            is_visited[frontier] = True
+            path_list.append(frontier)
+            frontier = self.receiver_index_array[frontier]
+        return path_list
+
+    def get_donor_flux_sum(self, affected_index: np.ndarray, is_affected: np.ndarray) -> np.ndarray:
+        """flux from donors outside the affected cells, which did not change"""
+        y_size, x_size = self.dem_array.shape
+        dx_table, dy_table, is_valid_table = self.flow_accumulation.get_delta_xy_table()
+        flat_flow_direction = self.flow_direction_array.ravel()
+        y, x = np.divmod(affected_index, x_size)
+        donor_flux_sum = np.zeros(affected_index.size, dtype=np.int64)
+        for code in np.flatnonzero(is_valid_table):
+            donor_x = x - dx_table[code]
+            donor_y = y - dy_table[code]
+            is_inside = (0 <= donor_x) & (donor_x < x_size) & (0 <= donor_y) & (donor_y < y_size)
+            donor_index = np.where(is_inside, donor_y * x_size + donor_x, 0)
+            is_donor = is_inside & ((flat_flow_direction[donor_index].astype(np.int64) & 0xFF) == code)
+            is_donor &= ~is_affected[donor_index]
+            donor_flux_sum += np.where(is_donor, self.flux_array[donor_index], 0)
+        return donor_flux_sum
+
+    def update_flow_accumulation(self, changed_index: np.ndarray):
+        """
+        only the upstream cells of the old and new downstream paths of the changed cells can change.
+        they are accumulated again with the flux from the other donors as weight.
+        """
+        if changed_index.size == 0:
+            return
+        is_affected = np.zeros(self.receiver_index_array.size, dtype=np.bool_)
+        is_affected[changed_index] = True
+        old_path_list = self.trace_downstream(changed_index, is_affected)
+        self.receiver_index_array[changed_index] = self.get_receiver_index_of_cells(changed_index)
+        new_path_list = self.trace_downstream(changed_index, is_affected)
+        affected_index = np.unique(np.concatenate([changed_index] + old_path_list + new_path_list))
+        logging.info(f"{changed_index.size} flow directions changed, {affected_index.size} cells accumulated again")
+
+        receiver = self.receiver_index_array[affected_index]
+        position = np.searchsorted(affected_index, receiver).clip(max=affected_index.size - 1)
+        local_receiver = np.where(receiver >= 0, position, -1)
+        weight = 1 + self.get_donor_flux_sum(affected_index, is_affected)
+        self.flux_array[affected_index] = accumulate_downstream(local_receiver, weight)
+
+    def set_layers(self):
+        flow_accumulation = self.flow_accumulation
+        flow_accumulation.dem = self.dem_array
+        flow_accumulation.pit_filled_dem = self.pit_filled_array
+        flow_accumulation.altitude_correction = self.pit_filled_array - self.dem_array
+        flow_accumulation.flow_direction = self.flow_direction_array
+        layer_dtype_policy = LayerDtypePolicy()
+        count_dtype = layer_dtype_policy.get_count_dtype(self.flux_array.size)
+        flow_accumulation_array = layer_dtype_policy.cast_checked(self.flux_array - 1, count_dtype)
+        flow_accumulation.flow_accumulation = flow_accumulation_array.reshape(self.dem_array.shape)
@@ -0,0 +1,204 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+import numpy as np
+
+from common.layer_dtype import LayerDtypePolicy
+from make_catchment_area import CatchmentAreaArrangement
+
+
+FLOW_DIRECTION_PATH = "base_data/FlowDir_30m_drone_mean.tif"
+SAVE_DIR = "output/catchment-area"
+
+
+def main():
+    catchment_area = CatchmentAreaArrangement()
+    catchment_area.set_save_dir(SAVE_DIR)
+    catchment_area.set_flow_direction_rule("D8")
+    layer_pipeline = LayerPipeline(catchment_area)
+    layer_pipeline.set_source("flow_direction", FLOW_DIRECTION_PATH)
+    layer_array_dict = layer_pipeline.run(["flow_accumulation"], is_saving=True)
+    catchment_area.set_river_mouth_point(*layer_pipeline.get_max_point(layer_array_dict["flow_accumulation"]))
+    layer_pipeline.run(["catchment_area", "watershed_boundary"], is_saving=True)
+
+
+class LayerNode:
+    def __init__(self, name: str, input_name_list: list[str], derive_func: callable, save_func: callable):
+        self.name = name
+        self.input_name_list = input_name_list
+        self.derive_func = derive_func
+        self.save_func = save_func
+
+
+class LayerPipeline:
+    """
+    layers as a graph of nodes declaring their inputs, evaluated lazily on request.
+    only the ancestors of the requested layers are derived (stopping at layers given as source),
+    independent nodes and the saving of requested layers run concurrently in a thread pool
+    and an intermediate layer is dropped as soon as all of its consumers are done.
+    settings (rules, modes, river mouth, save dir) are taken from the CatchmentAreaArrangement.
+    """
+
+    def __init__(self, catchment_area: CatchmentAreaArrangement, worker_count: int = 4):
+        self.catchment_area = catchment_area
+        self.worker_count = worker_count
+        self.source_dict: dict[str, np.ndarray] = {}
+        self.node_dict = self.make_node_dict()
+
+    def make_node_dict(self) -> dict[str, LayerNode]:
+        catchment_area = self.catchment_area
+        node_list = [
+            LayerNode("dem", [], None, self.save_dem),
+            LayerNode("pit_filled_dem", ["dem"], catchment_area.fill_pit_array, self.save_tiff),
+            LayerNode(
+                "altitude_correction", ["dem", "pit_filled_dem"], self.derive_altitude_correction, self.save_preview
+            ),
+            LayerNode(
+                "flow_direction", ["pit_filled_dem"], catchment_area.get_flow_direction_array, self.save_flow_direction
+            ),
+            LayerNode(
+                "flow_accumulation", ["flow_direction"], self.derive_flow_accumulation, self.save_flow_accumulation
+            ),
+            LayerNode(
+                "catchment_area", ["flow_direction"], catchment_area.get_catchment_area_array, self.save_mono_layer
+            ),
+            LayerNode(
+                "watershed_boundary",
+                ["catchment_area"],
+                catchment_area.get_watershed_boundary_array,
+                self.save_mono_layer,
+            ),
+        ]
+        return {node.name: node for node in node_list}
+
+    def set_source(self, name: str, path: str):
+        """layer read from file, its ancestors are never derived"""
+        self.set_source_array(name, np.asarray(self.catchment_area.open_layer(path)))
+
+    def set_source_array(self, name: str, array: np.ndarray):
+        if name not in self.node_dict:
+            raise ValueError(f"unknown layer {name}")
+        layer_dtype_policy = LayerDtypePolicy()
+        if name in ["dem", "pit_filled_dem"]:
+            array = layer_dtype_policy.to_elevation(array)
+            if name == "dem":
+                self.catchment_area.derive_active_cell_index(array)
+        elif name == "flow_direction":
+            array = layer_dtype_policy.to_flow_direction(array, self.catchment_area.flow_direction_rule_matrix)
+        elif name in ["catchment_area", "watershed_boundary"]:
+            array = layer_dtype_policy.to_mask(array)
+        self.source_dict[name] = array
+
+    def get_required_name_list(self, target_name_list: list[str]) -> list[str]:
+        """requested layers and their ancestors in topological order"""
+        required_name_list = []
+
+        def visit(name: str):
+            if name in required_name_list:
+                return
+            if name not in self.node_dict:
+                raise ValueError(f"unknown layer {name}")
+            if name not in self.source_dict:
+                if self.node_dict[name].derive_func is None:
+                    raise ValueError(f"{name} has to be given as source")
+                for input_name in self.node_dict[name].input_name_list:
+                    visit(input_name)
+            required_name_list.append(name)
+
+        for target_name in target_name_list:
+            visit(target_name)
+        return required_name_list
+
+    def get_consumer_count_dict(self, required_name_list: list[str]) -> dict[str, int]:
+        consumer_count_dict = {name: 0 for name in required_name_list}
+        for name in required_name_list:
+            if name in self.source_dict:
+                continue
+            for input_name in self.node_dict[name].input_name_list:
+                consumer_count_dict[input_name] += 1
+        return consumer_count_dict
+
+    def run(self, target_name_list: list[str], is_saving: bool = False) -> dict[str, np.ndarray]:
+        """arrays of the requested layers"""
+        required_name_list = self.get_required_name_list(target_name_list)
+        logging.info(f"layer pipeline: {' -> '.join(required_name_list)}")
+        consumer_count_dict = self.get_consumer_count_dict(required_name_list)
+        array_dict = {name: self.source_dict[name] for name in required_name_list if name in self.source_dict}
+        pending_name_list = [name for name in required_name_list if name not in array_dict]
+        with ThreadPoolExecutor(max_workers=self.worker_count) as executor:
+            future_dict = {}
+            save_future_list = []
+            for name in array_dict:
+                if is_saving and name in target_name_list:
+                    save_future_list.append(executor.submit(self.node_dict[name].save_func, name, array_dict[name]))
+            while pending_name_list or future_dict:
+                for name in list(pending_name_list):
+                    node = self.node_dict[name]
+                    if all(input_name in array_dict for input_name in node.input_name_list):
+                        input_list = [array_dict[input_name] for input_name in node.input_name_list]
+                        future_dict[executor.submit(node.derive_func, *input_list)] = name
+                        pending_name_list.remove(name)
+                done_set, _ = wait(future_dict, return_when=FIRST_COMPLETED)
+                for future in done_set:
+                    name = future_dict.pop(future)
+                    array_dict[name] = future.result()
+                    logging.info(f"layer {name} derived")
+                    if is_saving and name in target_name_list:
+                        save_future_list.append(executor.submit(self.node_dict[name].save_func, name, array_dict[name]))
+                    self.release_input(name, array_dict, consumer_count_dict, target_name_list)
+            for save_future in save_future_list:
+                save_future.result()
+        return {name: array_dict[name] for name in target_name_list}
+
+    def release_input(
+        self, name: str, array_dict: dict, consumer_count_dict: dict[str, int], target_name_list: list[str]
+    ):
+        for input_name in self.node_dict[name].input_name_list:
+            consumer_count_dict[input_name] -= 1
+            if consumer_count_dict[input_name] == 0 and input_name not in target_name_list:
+                del array_dict[input_name]
+                logging.info(f"layer {input_name} released")
+
+    def derive_altitude_correction(self, dem_array: np.ndarray, pit_filled_array: np.ndarray) -> np.ndarray:
+        return pit_filled_array - dem_array
+
+    def derive_flow_accumulation(self, flow_direction_array: np.ndarray) -> np.ndarray:
+        catchment_area = self.catchment_area
+        if catchment_area.is_multiple_flow_direction() and catchment_area.flow_proportion_array is not None:
+            return catchment_area.calculate_proportional_flow_accumulation(catchment_area.flow_proportion_array)
+        return catchment_area.calculate_flow_accumulation(flow_direction_array)
+
+    def get_max_point(self, array: np.ndarray) -> tuple[int, int]:
+        y, x = np.unravel_index(np.argmax(array), array.shape)
+        return int(x), int(y)
+
+    def save_tiff(self, name: str, array: np.ndarray):
+        self.catchment_area.save_tiff(array, name)
+
+    def save_dem(self, name: str, array: np.ndarray):
+        self.catchment_area.save_tiff(array, name)
+        self.catchment_area.save_overview(array, name, "mean")
+
+    def save_preview(self, name: str, array: np.ndarray):
+        self.catchment_area.save_tiff(array, name)
+        self.catchment_area.save_preview(array, name, "max")
+
+    def save_flow_direction(self, name: str, array: np.ndarray):
+        self.catchment_area.save_tiff(array, name)
+        self.catchment_area.save_overview(array, name, "mode")
+        self.catchment_area.save_flow_proportion()
+
+    def save_flow_accumulation(self, name: str, array: np.ndarray):
+        self.catchment_area.save_tiff(array, name)
+        level_list = self.catchment_area.save_overview(array, name, "max")
+        self.catchment_area.save_preview(array, name, "max", is_log_scale=True, level_list=level_list)
+
+    def save_mono_layer(self, name: str, array: np.ndarray):
+        self.catchment_area.save_tiff(array, name)
+        self.catchment_area.save_mono_png(array, name)
+
+
+if __name__ == "__main__":
+    main()
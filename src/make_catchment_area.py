@@ -1,14 +1,32 @@
+import csv
 import numpy as np
+import os
 import sys
 import logging
+from time import time
 
 from flow_direction_rule import FlowDirectionRule
+from flow_direction_rule import FlowDirectionRuleMatrix
+from flow_routing import FlowProportion
+from flow_routing import FlowRoutingAlgorithm
+from common.active_cell import ActiveCellIndex
+from common.checkpoint import Checkpoint
 from common.image_processing import ImageProcessing
+from common.layer_dtype import LayerDtypePolicy
+from common.run_length_mask import RunLengthMask
 from common.setting import ValueSetting
 from common.util import load_json
 from common.util import make_neighbor_boundary_xy
 from common.logging_decorator import logging_decorator
+from common.flow_graph import accumulate_downstream
+from common.flow_graph import accumulate_proportion_downstream
+from common.flow_graph import make_donor_csr
+from common.kernel import kernel_registry
+from depression_hierarchy import DEPRESSION_COLUMNS
+from depression_hierarchy import DepressionHierarchy
 from pit_fill import PitFillAlgorithm
+from parallel_flow_accumulation import TiledFlowAccumulation
+from parallel_pit_fill import TiledPriorityFloodPitFill
 
 
 FLOW_DIRECTION_PATH = "base_data/FlowDir_30m_drone_mean.tif"
@@ -42,33 +60,170 @@ class PitFill(ImageProcessing, FlowDirectionRule):
         self.pit_filled_dem = None
         self.altitude_correction = None
         self.pit_fill_rule = "normal"
+        self.pit_fill_mode = "serial"
+        self.pit_fill_worker_count = None
+        self.pit_fill_tile_size = 1024
+        self.is_skipping_nodata = True
+        self.active_cell_index: ActiveCellIndex = None
+        self.checkpoint: Checkpoint = None
+        self.depression_fill_threshold = {"max_volume_m3": None, "max_area_km2": None, "max_depth_m": None}
+        self.depression_hierarchy: DepressionHierarchy = None
 
     def set_elevation(self, path):
-        self.dem = self.open_image(path)
+        self.dem = self.open_layer(path)
 
     def set_pit_filled(self, path):
-        self.pit_filled_dem = self.open_image(path)
+        self.pit_filled_dem = self.open_layer(path)
+
+    def set_pit_fill_rule(self, rule: str):
+        self.pit_fill_rule = rule
+
+    def set_pit_fill_mode(self, mode: str, worker_count: int = None, tile_size: int = None):
+        """tiled mode is the parallel version of priority_flood"""
+        if mode not in ["serial", "tiled"]:
+            raise ValueError("mode must be 'serial' or 'tiled'.")
+        self.pit_fill_mode = mode
+        if worker_count is not None:
+            self.pit_fill_worker_count = worker_count
+        if tile_size is not None:
+            self.pit_fill_tile_size = tile_size
+
+    def set_depression_fill_threshold(
+        self, max_volume_m3: float = None, max_area_km2: float = None, max_depth_m: float = None
+    ):
+        """
+        selective pit fill fills only the depressions within every given threshold,
+        larger depressions (lakes, quarries, karst) are kept as sinks
+        """
+        self.depression_fill_threshold = {
+            "max_volume_m3": max_volume_m3,
+            "max_area_km2": max_area_km2,
+            "max_depth_m": max_depth_m,
+        }
+
+    def set_skipping_nodata(self, is_skipping_nodata: bool):
+        """nodata cells (sea, voids) are skipped by every stage and regarded as outside of the scene"""
+        self.is_skipping_nodata = is_skipping_nodata
+        if not is_skipping_nodata:
+            self.active_cell_index = None
+
+    def derive_active_cell_index(self, elevation_array: np.ndarray):
+        """valid cells of the DEM, None while every cell is valid"""
+        self.active_cell_index = None
+        if not self.is_skipping_nodata:
+            return
+        active_cell_index = ActiveCellIndex.from_array(elevation_array, self.get_nodata())
+        logging.info(f"{active_cell_index.get_active_ratio():.1%} of the cells are valid")
+        if not active_cell_index.is_all_active():
+            self.active_cell_index = active_cell_index
+
+    def get_active_cell_index(self, array_shape: tuple[int, int]) -> ActiveCellIndex:
+        """active cell index of the scene, None if there is none for this shape"""
+        if self.active_cell_index is None or self.active_cell_index.array_shape != tuple(array_shape):
+            return None
+        return self.active_cell_index
+
+    def set_checkpoint_dir(self, checkpoint_dir: str, progress_interval_sec: float = 60.0):
+        """
+        finished stages and partial progress are saved in checkpoint_dir,
+        a restarted run reuses them when the hash of the inputs and settings is the same.
+        """
+        self.checkpoint = Checkpoint(checkpoint_dir, progress_interval_sec)
+
+    def get_checkpoint_hash(self, array_list: list[np.ndarray], setting_dict: dict) -> str:
+        """hash of the inputs of a stage, None without checkpoint"""
+        if self.checkpoint is None:
+            return None
+        if self.active_cell_index is not None:
+            array_list = array_list + [self.active_cell_index.active_index]
+        return self.checkpoint.get_input_hash(array_list, setting_dict)
+
+    def load_checkpoint(self, stage: str, input_hash: str) -> dict[str, np.ndarray]:
+        if input_hash is None:
+            return None
+        array_dict = self.checkpoint.load(stage, input_hash)
+        if array_dict is not None:
+            logging.info(f"{stage} resumed from checkpoint")
+        return array_dict
+
+    def save_checkpoint(self, stage: str, input_hash: str, **array_dict):
+        if input_hash is not None:
+            self.checkpoint.save(stage, input_hash, **array_dict)
 
     @logging_decorator
     def fill_pit(self):
         if self.dem is None:
             raise Exception("Elevation is not set.")
-        elevation_array = np.array(self.dem)
-        pit_filled_array = self.fill_pit_array(elevation_array)
+        elevation_array = LayerDtypePolicy().to_elevation(self.dem)
+        self.derive_active_cell_index(elevation_array)
+        setting_dict = {"pit_fill_rule": self.pit_fill_rule}
+        if self.pit_fill_rule == "selective":
+            setting_dict.update(self.depression_fill_threshold)
+        input_hash = self.get_checkpoint_hash([elevation_array], setting_dict)
+        checkpoint = self.load_checkpoint("pit_fill", input_hash)
+        if checkpoint is None:
+            pit_filled_array = self.fill_pit_array(elevation_array, input_hash)
+            self.save_checkpoint("pit_fill", input_hash, pit_filled_dem=pit_filled_array)
+        else:
+            pit_filled_array = checkpoint["pit_filled_dem"]
         self.pit_filled_dem = self.open_image_from_array(pit_filled_array)
-        altitude_correction = self.pit_filled_dem - self.dem
+        altitude_correction = pit_filled_array - elevation_array
         self.altitude_correction = self.open_image_from_array(altitude_correction)
 
-    def fill_pit_array(self, elevation_array: np.ndarray) -> np.ndarray:
+    def fill_pit_array(self, elevation_array: np.ndarray, input_hash: str = None) -> np.ndarray:
+        """nodata cells are kept, priority_flood drains their neighbors into them like into the DEM edge"""
+        active_cell_index = self.get_active_cell_index(elevation_array.shape)
+        if self.pit_fill_mode == "tiled":
+            if self.pit_fill_rule != "priority_flood":
+                raise ValueError("tiled pit fill is only for priority_flood.")
+            tiled_pit_fill = TiledPriorityFloodPitFill(
+                worker_count=self.pit_fill_worker_count,
+                tile_size=self.pit_fill_tile_size,
+                nodata=None if active_cell_index is None else self.get_nodata(),
+                checkpoint=self.checkpoint,
+                input_hash=input_hash,
+            )
+            return tiled_pit_fill.fill(elevation_array).astype(elevation_array.dtype, copy=False)
+        if self.pit_fill_rule == "selective":
+            return self.fill_depression_selectively(elevation_array)
         pit_filled_array = np.copy(elevation_array)
-        algorithm_func = PitFillAlgorithm.select_algorithm(self.pit_fill_rule)
-        return algorithm_func(pit_filled_array)
+        if active_cell_index is None:
+            PitFillAlgorithm().select_algorithm(self.pit_fill_rule)(pit_filled_array)
+        elif self.pit_fill_rule == "priority_flood":
+            PitFillAlgorithm().priority_flood(pit_filled_array, active_cell_index.get_active_array())
+        else:
+            logging.warning(f"{self.pit_fill_rule} pit fill does not skip nodata, nodata cells are restored after it")
+            PitFillAlgorithm().select_algorithm(self.pit_fill_rule)(pit_filled_array)
+            is_nodata = ~active_cell_index.get_active_array()
+            pit_filled_array[is_nodata] = elevation_array[is_nodata]
+        return pit_filled_array
+
+    def fill_depression_selectively(self, elevation_array: np.ndarray) -> np.ndarray:
+        """depressions within the thresholds filled from one pass of the depression hierarchy"""
+        active_cell_index = self.get_active_cell_index(elevation_array.shape)
+        is_active = None if active_cell_index is None else active_cell_index.get_active_array()
+        self.depression_hierarchy = DepressionHierarchy(self.get_cell_area_km2())
+        self.depression_hierarchy.derive(elevation_array, is_active)
+        logging.info(f"{self.depression_hierarchy.leaf_cnt} depressions")
+        return self.depression_hierarchy.get_selectively_filled_array(elevation_array, **self.depression_fill_threshold)
+
+    def save_depression_inventory(self, file_name: str = "depression"):
+        """the depressions as csv and the label of the pit every cell drains to as tif (0: an outlet)"""
+        if self.depression_hierarchy is None:
+            raise Exception("Depression hierarchy is not derived, use the selective pit fill rule.")
+        os.makedirs(self.save_dir, exist_ok=True)
+        with open(os.path.join(self.save_dir, file_name + ".csv"), "w", encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=DEPRESSION_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.depression_hierarchy.get_table())
+        self.save_tiff(self.open_image_from_array(self.depression_hierarchy.label_array), file_name + "_label")
 
     def save_image(self):
         self.save_tiff(self.dem, "dem")
+        self.save_overview(self.dem, "dem", "mean")
         self.save_tiff(self.pit_filled_dem, "pit_filled_dem")
         self.save_tiff(self.altitude_correction, "altitude_correction")
-        self.save_png(self.altitude_correction, "altitude_correction")
+        self.save_preview(self.altitude_correction, "altitude_correction", "max")
 
     def close_used_images(self):
         self.close_image(self.dem)
@@ -82,56 +237,157 @@ class FlowDirection(PitFill):
         logging.info("init FlowDirection")
         self.flow_direction = None
         self.flow_direction_algorithm = "steepest_descent"
+        self.flow_proportion_array: np.ndarray = None
+        self.flow_direction_block_cell_cnt = 2**20
 
     def set_flow_direction(self, path: str):
-        self.flow_direction = self.open_image(path)
+        flow_direction = self.open_layer(path)
+        self.flow_direction = LayerDtypePolicy().to_flow_direction(flow_direction, self.flow_direction_rule_matrix)
+        self.close_image(flow_direction)
 
     @logging_decorator
     def derive_flow_direction(self):
         if self.pit_filled_dem is None:
             self.fill_pit()
-        flow_direction_array = self.get_flow_direction_array()
+        pit_filled_array = np.asarray(self.pit_filled_dem)
+        input_hash = self.get_checkpoint_hash([pit_filled_array], self.get_flow_direction_setting_dict())
+        checkpoint = self.load_checkpoint("flow_direction", input_hash)
+        if checkpoint is None:
+            flow_direction_array = self.get_flow_direction_array(pit_filled_array)
+            proportion_dict = {}
+            if self.is_multiple_flow_direction():
+                proportion_dict["flow_proportion"] = self.flow_proportion_array
+            self.save_checkpoint("flow_direction", input_hash, flow_direction=flow_direction_array, **proportion_dict)
+        else:
+            flow_direction_array = checkpoint["flow_direction"]
+            self.flow_proportion_array = checkpoint.get("flow_proportion")
         self.flow_direction = self.open_image_from_array(flow_direction_array)
 
-    def get_flow_direction_array(self) -> np.ndarray:
-        array_shape = self.get_array_shape_from_image(self.pit_filled_dem)
-        flow_direction_array = np.zeros(array_shape, dtype=np.int8)
-        pit_filled_array = np.array(self.dem)
-        for y, x in np.ndindex(array_shape):
-            flow_direction_array[y][x] = self.get_flow_direction(array=pit_filled_array, x=x, y=y)
+    def get_flow_direction_setting_dict(self) -> dict:
+        return {
+            "flow_direction_rule_matrix": self.flow_direction_rule_matrix,
+            "flow_direction_algorithm": self.flow_direction_algorithm,
+        }
+
+    def set_flow_direction_algorithm(self, algorithm: str):
+        """steepest_descent (D8/D16 by rule), d_infinity or mfd"""
+        if algorithm not in ["steepest_descent", "d_infinity", "mfd"]:
+            raise ValueError("algorithm must be steepest_descent, d_infinity or mfd")
+        self.flow_direction_algorithm = algorithm
+
+    def is_multiple_flow_direction(self) -> bool:
+        return self.flow_direction_algorithm in ["d_infinity", "mfd"]
+
+    def get_flow_direction_array(self, pit_filled_array: np.ndarray = None) -> np.ndarray:
+        """
+        for d_infinity and mfd, flow proportions are kept in self.flow_proportion_array
+        and the flow direction is the code of the dominant neighbor in the rule matrix.
+        """
+        if pit_filled_array is None:
+            pit_filled_array = np.asarray(self.pit_filled_dem)
+        active_cell_index = self.get_active_cell_index(np.shape(pit_filled_array))
+        if self.is_multiple_flow_direction():
+            flow_routing = FlowRoutingAlgorithm()
+            if active_cell_index is not None:
+                # nodata cells as nan receive nothing and have no flow
+                is_active = active_cell_index.get_active_array()
+                pit_filled_array = np.where(is_active, pit_filled_array, np.nan)
+            self.flow_proportion_array = flow_routing.select_algorithm(self.flow_direction_algorithm)(pit_filled_array)
+            if active_cell_index is not None:
+                self.flow_proportion_array[:, ~is_active] = 0
+            neighbor_code_list = [
+                self.get_flow_direction_from_delta_xy(dx, dy) for dx, dy in FlowDirectionRuleMatrix.NEIGHBOR_DELTA_XY
+            ]
+            return flow_routing.get_dominant_flow_direction_array(self.flow_proportion_array, neighbor_code_list)
+        if active_cell_index is not None:
+            return self.get_active_steepest_descent_flow_direction_array(pit_filled_array, active_cell_index)
+        return self.get_steepest_descent_flow_direction_array(pit_filled_array)
+
+    def get_steepest_descent_flow_direction_array(self, array: np.ndarray) -> np.ndarray:
+        """code of the neighbor with the largest drop per distance in the rule matrix, 0 if there is none"""
+        y_size, x_size = array.shape
+        flow_direction_dtype = LayerDtypePolicy().get_flow_direction_dtype(self.flow_direction_rule_matrix)
+        flow_direction_array = np.zeros((y_size, x_size), dtype=flow_direction_dtype)
+        # float64 work arrays are limited to a block of rows
+        block_row_cnt = max(1, self.flow_direction_block_cell_cnt // x_size)
+        for y_start in range(0, y_size, block_row_cnt):
+            y_end = min(y_start + block_row_cnt, y_size)
+            self.set_steepest_descent_block(array, y_start, flow_direction_array[y_start:y_end])
+        logging.info(f"No flow direction at {np.count_nonzero(flow_direction_array == 0)} cells")
         return flow_direction_array
 
-    def get_flow_direction(self, array, x, y) -> int:
-        if self.flow_direction_algorithm == "steepest_descent":
-            return self.get_steepest_descent_flow_direction(array, x, y)
+    def set_steepest_descent_block(self, array: np.ndarray, y_start: int, flow_direction_block: np.ndarray):
+        y_size = array.shape[0]
+        y_end = y_start + flow_direction_block.shape[0]
+        radius = len(self.flow_direction_rule_matrix) // 2
+        row_start, row_end = max(y_start - radius, 0), min(y_end + radius, y_size)
+        pad_width = ((radius - (y_start - row_start), radius - (row_end - y_end)), (radius, radius))
+        padded = np.pad(np.asarray(array[row_start:row_end], dtype=np.float64), pad_width, constant_values=np.nan)
+        block_y_size, block_x_size = y_end - y_start, array.shape[1]
+        center = padded[radius : radius + block_y_size, radius : radius + block_x_size]
+        steepest_drop = np.zeros((block_y_size, block_x_size), dtype=np.float64)
+        for dy, rule_x in enumerate(self.flow_direction_rule_matrix, -radius):
+            for dx, rule in enumerate(rule_x, -radius):
+                if rule is None or self.is_center(dx, dy):
+                    continue
+                neighbor = padded[radius + dy : radius + dy + block_y_size, radius + dx : radius + dx + block_x_size]
+                drop = (center - neighbor) / np.hypot(dx, dy)
+                is_steeper = np.nan_to_num(drop, nan=-np.inf) > steepest_drop
+                steepest_drop = np.where(is_steeper, drop, steepest_drop)
+                flow_direction_block[is_steeper] = rule
+
+    def get_active_steepest_descent_flow_direction_array(
+        self, array: np.ndarray, active_cell_index: ActiveCellIndex
+    ) -> np.ndarray:
+        """steepest descent over the valid cells only, nodata cells have no flow direction and receive no flow"""
+        y_size, x_size = array.shape
+        flow_direction_dtype = LayerDtypePolicy().get_flow_direction_dtype(self.flow_direction_rule_matrix)
+        flow_direction_array = np.zeros((y_size, x_size), dtype=flow_direction_dtype)
+        flat_array = np.asarray(array).ravel()
+        is_active = active_cell_index.get_active_array().ravel()
+        active_index = active_cell_index.active_index
+        for start in range(0, active_index.size, self.flow_direction_block_cell_cnt):
+            index = active_index[start : start + self.flow_direction_block_cell_cnt].astype(np.int64)
+            flow_direction = self.get_steepest_descent_of_cells(flat_array, is_active, index, x_size)
+            flow_direction_array.ravel()[index] = flow_direction
+        logging.info(f"No flow direction at {np.count_nonzero(flow_direction_array == 0)} cells")
+        return flow_direction_array
 
-    def get_steepest_descent_flow_direction(self, array: np.ndarray, x: int, y: int) -> int:
-        dx, dy = self.get_steepest_downstream_dx_dy(array, x, y)
-        flow_direction = self.get_flow_direction_from_delta_xy(dx=dx, dy=dy)
-        if flow_direction == 0:
-            logging.info(f"No flow direction at ({x=}, {y=})")
+    def get_steepest_descent_of_cells(
+        self, flat_array: np.ndarray, is_active: np.ndarray, index: np.ndarray, x_size: int
+    ) -> np.ndarray:
+        y_size = flat_array.size // x_size
+        y, x = np.divmod(index, x_size)
+        center = flat_array[index].astype(np.float64)
+        steepest_drop = np.zeros(index.size, dtype=np.float64)
+        flow_direction_dtype = LayerDtypePolicy().get_flow_direction_dtype(self.flow_direction_rule_matrix)
+        flow_direction = np.zeros(index.size, dtype=flow_direction_dtype)
+        radius = len(self.flow_direction_rule_matrix) // 2
+        for dy, rule_x in enumerate(self.flow_direction_rule_matrix, -radius):
+            for dx, rule in enumerate(rule_x, -radius):
+                if rule is None or self.is_center(dx, dy):
+                    continue
+                neighbor_y, neighbor_x = y + dy, x + dx
+                is_inside = (0 <= neighbor_y) & (neighbor_y < y_size) & (0 <= neighbor_x) & (neighbor_x < x_size)
+                neighbor_index = np.where(is_inside, neighbor_y * x_size + neighbor_x, 0)
+                is_valid = is_inside & is_active[neighbor_index]
+                drop = (center - flat_array[neighbor_index]) / np.hypot(dx, dy)
+                is_steeper = is_valid & (drop > steepest_drop)
+                steepest_drop = np.where(is_steeper, drop, steepest_drop)
+                flow_direction[is_steeper] = rule
         return flow_direction
 
-    def get_steepest_downstream_dx_dy(self, array: np.ndarray, x: int, y: int) -> tuple[int, int]:
-        array_shape = array.shape
-        lowest_dem = array[y][x]
-        downstream_dx = x.copy()
-        downstream_dy = y.copy()
-        for dx, dy in self.neighbor_delta_xy_generator():
-            nx = x + dx
-            ny = y + dy
-            if self.is_out_of_array(array_shape, nx, ny):
-                continue
-            neighbor_value = array[ny][nx]
-            if lowest_dem < neighbor_value:
-                lowest_dem = neighbor_value
-                downstream_dx = dx
-                downstream_dy = dy
-        return downstream_dx, downstream_dy
+    def save_flow_proportion(self):
+        if self.flow_proportion_array is None:
+            return
+        os.makedirs(self.save_dir, exist_ok=True)
+        np.save(os.path.join(self.save_dir, "flow_proportion.npy"), self.flow_proportion_array)
 
     def save_image(self):
         super().save_image()
         self.save_tiff(self.flow_direction, "flow_direction")
+        self.save_overview(self.flow_direction, "flow_direction", "mode")
+        self.save_flow_proportion()
 
     def close_used_images(self):
         super().close_used_images()
@@ -144,50 +400,162 @@ class FlowAccumulation(FlowDirection):
         logging.info("init FlowAccumulation")
         self.flow_accumulation = None
         self.flow_accumulation_array = None
+        self.flow_accumulation_mode = "serial"
+        self.flow_accumulation_worker_count = None
+        self.flow_accumulation_tile_size = 1024
 
     def set_flow_accumulation(self, path):
-        self.flow_accumulation = self.open_image(path)
+        self.flow_accumulation = self.open_layer(path)
 
     @logging_decorator
     def derive_flow_accumulation(self):
         if self.flow_direction is None:
             self.derive_flow_direction()
-        flow_accumulation_array = self.get_flow_accumulation_array()
+        input_list = [np.asarray(self.flow_direction)]
+        if self.is_multiple_flow_direction() and self.flow_proportion_array is not None:
+            input_list.append(self.flow_proportion_array)
+        input_hash = self.get_checkpoint_hash(input_list, self.get_flow_direction_setting_dict())
+        checkpoint = self.load_checkpoint("flow_accumulation", input_hash)
+        if checkpoint is None:
+            flow_accumulation_array = self.get_flow_accumulation_array()
+            self.save_checkpoint("flow_accumulation", input_hash, flow_accumulation=flow_accumulation_array)
+        else:
+            flow_accumulation_array = checkpoint["flow_accumulation"]
         self.flow_accumulation = self.open_image_from_array(flow_accumulation_array)
 
     def get_flow_accumulation_array(self) -> np.ndarray:
-        flow_dir_array = np.array(self.flow_direction)
+        if self.is_multiple_flow_direction() and self.flow_proportion_array is not None:
+            return self.calculate_proportional_flow_accumulation(self.flow_proportion_array)
+        flow_dir_array = np.asarray(self.flow_direction)
         flow_acc_array = self.calculate_flow_accumulation(flow_dir_array)
 
         return flow_acc_array
 
+    def calculate_proportional_flow_accumulation(self, flow_proportion_array: np.ndarray) -> np.ndarray:
+        """upstream area in cells for d_infinity and mfd routing"""
+        array_shape = flow_proportion_array.shape[1:]
+        active_cell_index = self.get_active_cell_index(array_shape)
+        weight_array = np.ones(array_shape, dtype=np.float64)
+        if active_cell_index is not None:
+            weight_array = active_cell_index.get_active_array().astype(np.float64)
+        flux_array = accumulate_proportion_downstream(
+            flow_proportion_array,
+            weight_array,
+            FlowDirectionRuleMatrix.NEIGHBOR_DELTA_XY,
+            FlowProportion.PROPORTION_SCALE,
+        )
+        # upstream cells without the cell itself, 0 at nodata cells
+        flux_array = np.clip(flux_array - weight_array.ravel(), 0, None)
+        layer_dtype_policy = LayerDtypePolicy()
+        accumulation_dtype = layer_dtype_policy.get_weighted_dtype(flux_array.size)
+        return layer_dtype_policy.cast_checked(flux_array, accumulation_dtype).reshape(array_shape)
+
+    def set_flow_accumulation_mode(self, mode: str, worker_count: int = None, tile_size: int = None):
+        if mode not in ["serial", "parallel"]:
+            raise ValueError("mode must be 'serial' or 'parallel'.")
+        self.flow_accumulation_mode = mode
+        if worker_count is not None:
+            self.flow_accumulation_worker_count = worker_count
+        if tile_size is not None:
+            self.flow_accumulation_tile_size = tile_size
+
     def calculate_flow_accumulation(
         self,
         flow_direction_array: np.array,
     ) -> np.array:
+        """number of upstream cells of every cell, in one topological pass over the receivers"""
         array_shape = flow_direction_array.shape
-        flow_accumulation_array = np.zeros(array_shape, dtype=np.uint32)
-        for y, x in np.ndindex(array_shape):
-            searched_array = np.zeros(array_shape, dtype=np.bool_)
-            while True:
-                flow_direction = flow_direction_array[y][x]
-                dx, dy = self.get_downstream_delta_xy(flow_direction)
-                nx, ny = x + dx, y + dy
-                if self.meet_break_condition(searched_array, nx, ny):
-                    break
-                searched_array[y][x] = True
-                flow_accumulation_array[ny][nx] += 1
-                x, y = nx, ny
-        return flow_accumulation_array
-
-    def meet_break_condition(self, searched_array, x, y):
-        shape = searched_array.shape
-        return self.is_out_of_array(shape, x, y) or searched_array[y][x]
+        active_cell_index = self.get_active_cell_index(array_shape)
+        if active_cell_index is not None and self.flow_accumulation_mode == "serial":
+            return self.calculate_active_flow_accumulation(flow_direction_array, active_cell_index)
+        receiver_index_array = self.get_receiver_index_array(flow_direction_array)
+        if active_cell_index is not None:
+            # flow into nodata leaves the scene
+            is_active = active_cell_index.get_active_array().ravel()
+            is_to_nodata = (receiver_index_array >= 0) & ~is_active[receiver_index_array]
+            receiver_index_array[is_to_nodata | ~is_active] = -1
+        layer_dtype_policy = LayerDtypePolicy()
+        count_dtype = layer_dtype_policy.get_count_dtype(receiver_index_array.size)
+        if self.flow_accumulation_mode == "parallel":
+            tiled_flow_accumulation = TiledFlowAccumulation(
+                worker_count=self.flow_accumulation_worker_count,
+                tile_size=self.flow_accumulation_tile_size,
+            )
+            flux_array = tiled_flow_accumulation.accumulate(receiver_index_array, array_shape)
+        else:
+            weight_array = np.ones(receiver_index_array.size, dtype=count_dtype)
+            flux_array = self.accumulate_downstream_with_progress(receiver_index_array, weight_array)
+        return layer_dtype_policy.cast_checked(flux_array - 1, count_dtype).reshape(array_shape)
+
+    def accumulate_downstream_with_progress(self, receiver_index_array: np.ndarray, weight_array: np.ndarray):
+        """accumulate_downstream saving the flux of the finished waves as checkpoint progress"""
+        if self.checkpoint is None:
+            return accumulate_downstream(receiver_index_array, weight_array)
+        input_hash = self.checkpoint.get_input_hash([receiver_index_array, weight_array])
+        start_wave = 0
+        progress = self.checkpoint.load_progress("flow_accumulation", input_hash)
+        if progress is not None:
+            weight_array, start_wave = progress["flux"], int(progress["next_wave"])
+            logging.info(f"flow accumulation resumed from wave {start_wave}")
+
+        def save_progress(next_wave: int, flux_array: np.ndarray):
+            if self.checkpoint.is_progress_due():
+                self.checkpoint.save_progress(
+                    "flow_accumulation", input_hash, flux=flux_array, next_wave=np.array(next_wave)
+                )
+
+        return accumulate_downstream(
+            receiver_index_array, weight_array, start_wave=start_wave, wave_callback=save_progress
+        )
+
+    def calculate_active_flow_accumulation(
+        self, flow_direction_array: np.ndarray, active_cell_index: ActiveCellIndex
+    ) -> np.ndarray:
+        """flow accumulation on the graph of the valid cells only, 0 at nodata cells"""
+        flat_index = active_cell_index.active_index
+        receiver_index = self.get_receiver_index_of_cells(flow_direction_array, flat_index)
+        # position of the receiver among the valid cells, -1 when it is nodata or outside of the scene
+        active_receiver_index = active_cell_index.get_position(receiver_index)
+        layer_dtype_policy = LayerDtypePolicy()
+        count_dtype = layer_dtype_policy.get_count_dtype(flow_direction_array.size)
+        flux_array = self.accumulate_downstream_with_progress(
+            active_receiver_index, np.ones(flat_index.size, dtype=count_dtype)
+        )
+        return active_cell_index.scatter(layer_dtype_policy.cast_checked(flux_array - 1, count_dtype), 0)
+
+    def benchmark_flow_accumulation(self, worker_count_list: list[int]) -> dict[int, float]:
+        """speed-up of the parallel mode per worker count, checked to be identical to the serial result"""
+        flow_direction_array = np.asarray(self.flow_direction)
+        mode = self.flow_accumulation_mode
+        worker_count = self.flow_accumulation_worker_count
+        self.flow_accumulation_mode = "serial"
+        start = time()
+        serial_array = self.calculate_flow_accumulation(flow_direction_array)
+        serial_sec = time() - start
+        logging.info(f"serial flow accumulation: {serial_sec:.3f} sec")
+        speed_up_dict = {}
+        for benchmark_worker_count in worker_count_list:
+            self.set_flow_accumulation_mode("parallel", worker_count=benchmark_worker_count)
+            start = time()
+            parallel_array = self.calculate_flow_accumulation(flow_direction_array)
+            parallel_sec = time() - start
+            if not np.array_equal(serial_array, parallel_array):
+                raise ValueError(
+                    f"parallel flow accumulation with {benchmark_worker_count} workers differs from serial"
+                )
+            speed_up_dict[benchmark_worker_count] = serial_sec / parallel_sec
+            logging.info(
+                f"{benchmark_worker_count} workers: {parallel_sec:.3f} sec, "
+                f"speed-up x{speed_up_dict[benchmark_worker_count]:.2f}"
+            )
+        self.set_flow_accumulation_mode(mode, worker_count=worker_count)
+        return speed_up_dict
 
     def save_image(self):
         super().save_image()
         self.save_tiff(self.flow_accumulation, "flow_accumulation")
-        self.save_png(self.flow_accumulation, "flow_accumulation")
+        level_list = self.save_overview(self.flow_accumulation, "flow_accumulation", "max")
+        self.save_preview(self.flow_accumulation, "flow_accumulation", "max", is_log_scale=True, level_list=level_list)
 
     def close_used_images(self):
         super().close_used_images()
@@ -199,6 +567,7 @@ class RiverMouth(FlowAccumulation):
         super().__init__()
         logging.info("init RiverMouth")
         self.river_mouth = None
+        self.river_mouth_list: list[tuple[int, int]] = []
         self.river_mouth_threshold_km2 = 10
 
     def set_river_mouth_point(self, x, y):
@@ -207,7 +576,7 @@ class RiverMouth(FlowAccumulation):
     def search_true_river_mouth(self, x: int, y: int) -> tuple[int, int]:
         if self.flow_accumulation is None:
             self.derive_flow_accumulation()
-        flow_accumulation_array = np.array(self.flow_accumulation)
+        flow_accumulation_array = np.asarray(self.flow_accumulation)
         if self.is_more_than_threshold(flow_accumulation_array[y][x]):
             return (x, y)
         return self._search_true_river_mouth(x, y)
@@ -217,7 +586,7 @@ class RiverMouth(FlowAccumulation):
 
     def _search_true_river_mouth(self, x: int, y: int):
         radius = 1
-        flow_accumulation = np.array(self.flow_accumulation)
+        flow_accumulation = np.asarray(self.flow_accumulation)
         while True:
             for nx, ny in make_neighbor_boundary_xy(x, y, radius):
                 if self.is_more_than_threshold(flow_accumulation[y][x]):
@@ -231,27 +600,55 @@ class RiverMouth(FlowAccumulation):
         self.river_mouth = self.get_max_flowacc_point()
 
     def get_max_flowacc_point(self) -> tuple:
-        array = np.array(self.flow_accumulation)
-        max_value = 0
-        max_point = None
-        for y, x in np.ndindex(array.shape):
-            value = array[y][x]
-            if max_value < value:
-                max_value = value
-                max_point = (x, y)
-        return max_point
+        top_points = self.get_top_k_flowacc_points(k=1)
+        if len(top_points) == 0:
+            return None
+        return top_points[0]
+
+    def get_top_k_flowacc_points(self, k: int) -> list[tuple[int, int]]:
+        """k cells with the largest flow accumulation in descending order, by partial sort"""
+        array = np.asarray(self.flow_accumulation)
+        flat_array = array.ravel()
+        k = min(k, flat_array.size)
+        if k <= 0:
+            return []
+        candidate = np.argpartition(flat_array, flat_array.size - k)[flat_array.size - k :]
+        candidate = candidate[np.argsort(-flat_array[candidate].astype(np.float64), kind="stable")]
+        y, x = np.divmod(candidate, array.shape[1])
+        return list(zip(x.tolist(), y.tolist()))
+
+    def get_outlet_points(self, threshold_km2: float = None) -> list[tuple[int, int]]:
+        """
+        edge and sink outlets (cells without a downstream cell in the array)
+        whose drainage area is more than threshold_km2, in descending order of flow accumulation.
+        """
+        if self.flow_accumulation is None:
+            self.derive_flow_accumulation()
+        if threshold_km2 is None:
+            threshold_km2 = self.river_mouth_threshold_km2
+        flow_accumulation_array = np.asarray(self.flow_accumulation)
+        receiver_index_array = self.get_receiver_index_array(np.asarray(self.flow_direction))
+        threshold_cell = threshold_km2 / self.get_cell_area_km2()
+        flat_accumulation = flow_accumulation_array.ravel()
+        outlet = np.flatnonzero((receiver_index_array == -1) & (flat_accumulation >= threshold_cell))
+        outlet = outlet[np.argsort(-flat_accumulation[outlet].astype(np.float64), kind="stable")]
+        y, x = np.divmod(outlet, flow_accumulation_array.shape[1])
+        return list(zip(x.tolist(), y.tolist()))
+
+    def derive_outlets_as_river_mouths(self, threshold_km2: float = None, k: int = None):
+        """every major basin of the scene: outlets over threshold_km2, at most k of them"""
+        outlet_points = self.get_outlet_points(threshold_km2)
+        if k is not None:
+            outlet_points = outlet_points[:k]
+        self.river_mouth_list = outlet_points
+        logging.info(f"{len(outlet_points)} outlets found")
 
     def set_dam_point_as_mouth(self, geojson: dict[str, any], dam: str, river: str):
         coordinate = self.get_dam_coordinate_from_geojson(geojson, dam, river)
-        x_origin = self.get_x_origin(self.image_tag)
-        y_origin = self.get_y_origin(self.image_tag)
-        x_resolution = self.get_x_resolution(self.image_tag)
-        y_resolution = self.get_y_resolution(self.image_tag)
-        x = int((coordinate[0] - x_origin) / x_resolution)
-        y = int(-(coordinate[1] - y_origin) / y_resolution)
+        x, y = self.get_pixel_xy_from_coordinate(self.image_tag, coordinate)
         self.set_river_mouth_point(x, y)
-        if self.flow_accumulation:
-            print(f"{self.flow_accumulation.getpixel((x, y))=}")
+        if self.flow_accumulation is not None:
+            print(f"flow_accumulation at mouth: {np.asarray(self.flow_accumulation)[y, x]}")
 
     def get_dam_coordinate_from_geojson(self, geojson: dict[str, any], dam: str, river) -> list[float, float]:
         features = geojson["features"]
@@ -280,51 +677,21 @@ class CatchmentArea(RiverMouth):
     def arrange_catchment_area_array(self):
         if self.flow_direction is None:
             self.derive_flow_direction()
-        array_shape = self.get_array_shape_from_image(self.flow_direction)
-        self.catchment_area_array = np.full(array_shape, ValueSetting.nodata, dtype=np.int8)
-        x = self.river_mouth[0]
-        y = self.river_mouth[1]
-        self.catchment_area_array[y][x] = 1
-        flow_direction_array = np.array(self.flow_direction)
-        self.identify_catchment_area_array_recursively(flow_direction_array=flow_direction_array, x=x, y=y)
-
-    def identify_catchment_area_array_recursively(self, flow_direction_array, x, y):
-        array_shape = flow_direction_array.shape
-        while True:
-            self.catchment_area_array[y][x] = 1
-            is_upend_stream = True
-            num_neighbor_upstream = 0
-            upstream_candidate_list: list[tuple[int, int]] = []
-            for dx, dy in self.neighbor_delta_xy_generator():
-                nx = x + dx
-                ny = y + dy
-                if self.is_out_of_array(array_shape=array_shape, x=nx, y=ny):
-                    continue
-                neighbor_flow_direction = flow_direction_array[ny][nx]
-                if self.is_upstream(
-                    neighbor_flow_direction=neighbor_flow_direction,
-                    dx=dx,
-                    dy=dy,
-                ):
-                    is_upend_stream = False
-                    if self.is_already_searched(x=nx, y=ny):
-                        continue
-                    num_neighbor_upstream += 1
-                    upstream_candidate_list.append((nx, ny))
-            if is_upend_stream:
-                break
-            if num_neighbor_upstream == 0:
-                break
-            elif num_neighbor_upstream == 1:
-                x, y = upstream_candidate_list[0]
-            elif num_neighbor_upstream > 1:
-                for nx, ny in upstream_candidate_list:
-                    self.identify_catchment_area_array_recursively(
-                        flow_direction_array=flow_direction_array, x=nx, y=ny
-                    )
-
-    def is_already_searched(self, x, y) -> bool:
-        return self.catchment_area_array[y][x] != ValueSetting.nodata
+        self.catchment_area_array = self.get_catchment_area_array(np.asarray(self.flow_direction))
+
+    def get_catchment_area_array(self, flow_direction_array: np.ndarray) -> np.ndarray:
+        """cells draining to the river mouth, traced upstream over the donor graph"""
+        if self.river_mouth is None:
+            raise ValueError("river mouth is not set.")
+        x, y = self.river_mouth
+        receiver_index_array = self.get_receiver_index_array(flow_direction_array)
+        donor_index_pointer, donor_index_array = make_donor_csr(receiver_index_array)
+        outlet_index = y * flow_direction_array.shape[1] + x
+        trace_upstream = kernel_registry.get("trace_upstream")
+        upstream_index = trace_upstream(donor_index_pointer, donor_index_array, outlet_index)
+        catchment_area_array = np.full(flow_direction_array.shape, ValueSetting.nodata, dtype=LayerDtypePolicy.mask)
+        catchment_area_array.ravel()[upstream_index] = 1
+        return catchment_area_array
 
     def save_image(self):
         super().save_image()
@@ -343,7 +710,7 @@ class WatershedBoundary(CatchmentArea):
         self.watershed_boundary = None
 
     def set_watershed_boundary(self, path):
-        self.watershed_boundary = self.open_image(path)
+        self.watershed_boundary = self.open_layer(path)
 
     @logging_decorator
     def derive_watershed_boundary(self):
@@ -354,32 +721,17 @@ class WatershedBoundary(CatchmentArea):
         self.watershed_boundary = self.open_image_from_array(watershed_boundary_array)
         print(len(watershed_boundary_array[watershed_boundary_array > 0]))
 
-    def get_watershed_boundary_array(self) -> np.ndarray:
-        watershed_boundary_array = self.catchment_area_array.copy()
-        for y, x in np.ndindex(watershed_boundary_array.shape):
-            if watershed_boundary_array[y][x] == ValueSetting.nodata:
-                continue
-            if self.is_not_watershed_boundary(self.catchment_area_array, x=x, y=y):
-                watershed_boundary_array[y][x] = ValueSetting.nodata
+    def get_watershed_boundary_array(self, catchment_area_array: np.ndarray = None) -> np.ndarray:
+        """catchment cells with a 4-neighbor outside the catchment area or outside the array"""
+        if catchment_area_array is None:
+            catchment_area_array = self.catchment_area_array
+        is_catchment = catchment_area_array == 1
+        padded = np.pad(is_catchment, 1, constant_values=False)
+        is_inner = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+        watershed_boundary_array = catchment_area_array.copy()
+        watershed_boundary_array[is_inner & is_catchment] = ValueSetting.nodata
         return watershed_boundary_array
 
-    def is_not_watershed_boundary(self, watershed_boundary_array, x, y):
-        watershed_boundary_pixel_cnt = 0
-        array_shape = watershed_boundary_array.shape
-        for dx, dy in self.neighbor_delta_xy_generator(include_center=True):
-            if dx * dy != 0:
-                continue
-            nx = x + dx
-            ny = y + dy
-            if self.is_out_of_array(array_shape=array_shape, x=nx, y=ny):
-                continue
-            if watershed_boundary_array[ny][nx] == 1:
-                watershed_boundary_pixel_cnt += 1
-        if watershed_boundary_pixel_cnt >= 5:
-            return True
-        else:
-            return False
-
     def save_image(self):
         super().save_image()
         self.save_tiff(self.watershed_boundary, "watershed_boundary")
@@ -395,17 +747,23 @@ class CatchmentAreaArrangement(WatershedBoundary):
         super().__init__()
         logging.info("init CatchmentAreaArrangement")
 
-    def clip_by_catchment_area(self, image: bytes) -> bytes:
+    def get_catchment_area_mask(self) -> RunLengthMask:
         if self.catchment_area_array is None:
             self.arrange_catchment_area_array()
+        return RunLengthMask.from_array(self.catchment_area_array, ValueSetting.nodata)
+
+    def clip_by_catchment_area(self, image: bytes, mask: RunLengthMask = None) -> bytes:
+        """cells out of the mask (the catchment area by default) set to nodata"""
+        if mask is None:
+            mask = self.get_catchment_area_mask()
         image_array = np.array(image)
-        for y, x in np.ndindex(image_array.shape):
-            if self.catchment_area_array[y][x] == ValueSetting.nodata:
-                image_array[y][x] = ValueSetting.nodata
-        return self.open_image_from_array(image_array)
+        clipped_array = np.full_like(image_array, ValueSetting.nodata)
+        mask_index = mask.get_index()
+        clipped_array.ravel()[mask_index] = image_array.ravel()[mask_index]
+        return self.open_image_from_array(clipped_array)
 
     def save_all_image_within_catchment_area(self):
-        bound_box = self.get_bound_box_from_image(self.catchment_area)
+        mask = self.get_catchment_area_mask()
         save_dict = {
             "catchment_area": self.catchment_area,
             "dem": self.dem,
@@ -418,8 +776,8 @@ class CatchmentAreaArrangement(WatershedBoundary):
         for file_name, image in save_dict.items():
             if image is None:
                 continue
-            image = self.clip_by_catchment_area(image)
-            image = self.crop_image(image, bound_box)
+            image = self.clip_by_catchment_area(image, mask)
+            image = self.crop_image(image, mask)
             file_name = "clipped_" + file_name
             if file_name == "clipped_watershed_boundary":
                 self.save_tiff_as_geojson(image, file_name)
@@ -0,0 +1,160 @@
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+
+from common.flow_graph import accumulate_downstream
+from common.flow_graph import get_terminal_index_array
+from common.flow_graph import get_topological_wave_list
+from common.shared_array import SharedArray
+
+
+class TiledFlowAccumulation:
+    """
+    flow accumulation split into tiles and solved in a process pool, identical to the serial result.
+    1. every tile accumulates its own cells (flux leaving the tile is cut) in parallel.
+    2. a small graph of tile exit cells propagates the flux between tiles centrally.
+    3. every tile adds the incoming flux along its local paths in parallel.
+    flux of a cell is its weight plus the weights of all upstream cells (weight is one per cell).
+    """
+
+    def __init__(self, worker_count: int = None, tile_size: int = 1024, halo_width: int = 2):
+        self.worker_count = worker_count or os.cpu_count()
+        self.tile_size = tile_size
+        self.halo_width = halo_width
+
+    def make_tile_list(self, array_shape: tuple[int, int]) -> list[tuple[int, int, int, int]]:
+        """(y_start, y_end, x_start, x_end) of every tile"""
+        tile_list = []
+        for y_start in range(0, array_shape[0], self.tile_size):
+            for x_start in range(0, array_shape[1], self.tile_size):
+                y_end = min(y_start + self.tile_size, array_shape[0])
+                x_end = min(x_start + self.tile_size, array_shape[1])
+                tile_list.append((y_start, y_end, x_start, x_end))
+        return tile_list
+
+    def accumulate(self, receiver_index_array: np.ndarray, array_shape: tuple[int, int]) -> np.ndarray:
+        tile_list = self.make_tile_list(array_shape)
+        shared_receiver = SharedArray.create_from_array(receiver_index_array)
+        shared_flux = SharedArray.create_from_array(np.zeros(array_shape, dtype=np.int64))
+        initargs = (shared_receiver.get_descriptor(), shared_flux.get_descriptor(), array_shape, self.halo_width)
+        try:
+            with multiprocessing.Pool(
+                processes=min(self.worker_count, len(tile_list)),
+                initializer=initialize_tile_worker,
+                initargs=initargs,
+            ) as pool:
+                tile_result_list = pool.map(accumulate_tile_locally, tile_list)
+                entry_inflow_list = self.solve_tile_boundary_graph(tile_result_list, shared_flux.array)
+                task_list = [
+                    (tile, entry_local_index, entry_inflow)
+                    for tile, (entry_local_index, entry_inflow) in zip(tile_list, entry_inflow_list)
+                    if entry_inflow.size > 0
+                ]
+                pool.map(add_tile_inflow, task_list)
+            return shared_flux.array.ravel().copy()
+        finally:
+            shared_receiver.close()
+            shared_flux.close()
+
+    def solve_tile_boundary_graph(self, tile_result_list: list[dict], flux_array: np.ndarray) -> list[tuple]:
+        """
+        nodes are tile exit cells (cells whose receiver is in another tile).
+        the next node of an exit is the exit (or outlet) its receiver drains to inside the receiver's tile.
+        """
+        flat_flux_array = flux_array.ravel()
+        exit_index = np.concatenate([result["exit_index"] for result in tile_result_list])
+        exit_receiver = np.concatenate([result["exit_receiver"] for result in tile_result_list])
+        entry_index = np.concatenate([result["entry_index"] for result in tile_result_list])
+        entry_terminal = np.concatenate([result["entry_terminal"] for result in tile_result_list])
+        logging.info(f"tile boundary graph: {exit_index.size} exits, {entry_index.size} entries")
+
+        entry_inflow = np.zeros(entry_index.size, dtype=np.int64)
+        if exit_index.size > 0:
+            entry_position = np.argsort(entry_index)
+            receiver_entry = entry_position[np.searchsorted(entry_index[entry_position], exit_receiver)]
+            terminal_of_receiver = entry_terminal[receiver_entry]
+            exit_position = np.argsort(exit_index)
+            sorted_exit_index = exit_index[exit_position]
+            candidate = np.searchsorted(sorted_exit_index, terminal_of_receiver).clip(max=exit_index.size - 1)
+            next_node = np.where(sorted_exit_index[candidate] == terminal_of_receiver, exit_position[candidate], -1)
+            total_outflow = accumulate_downstream(next_node, flat_flux_array[exit_index])
+            np.add.at(entry_inflow, receiver_entry, total_outflow)
+
+        entry_inflow_list = []
+        entry_start = 0
+        for result in tile_result_list:
+            entry_end = entry_start + result["entry_index"].size
+            entry_inflow_list.append((result["entry_local_index"], entry_inflow[entry_start:entry_end]))
+            entry_start = entry_end
+        return entry_inflow_list
+
+
+tile_worker_state: dict = {}
+
+
+def initialize_tile_worker(receiver_descriptor: tuple, flux_descriptor: tuple, array_shape: tuple, halo_width: int):
+    tile_worker_state["receiver"] = SharedArray.attach(receiver_descriptor)
+    tile_worker_state["flux"] = SharedArray.attach(flux_descriptor, is_writable=True)
+    tile_worker_state["array_shape"] = array_shape
+    tile_worker_state["halo_width"] = halo_width
+
+
+def get_local_receiver_index_array(tile: tuple[int, int, int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """receiver in tile-local flattened index (-1 when it leaves the tile) and the global receiver"""
+    y_start, y_end, x_start, x_end = tile
+    x_size = tile_worker_state["array_shape"][1]
+    receiver = tile_worker_state["receiver"].array.reshape(tile_worker_state["array_shape"])
+    global_receiver = receiver[y_start:y_end, x_start:x_end].ravel()
+    receiver_y, receiver_x = np.divmod(global_receiver, x_size)
+    is_inside = (global_receiver >= 0) & (y_start <= receiver_y) & (receiver_y < y_end)
+    is_inside &= (x_start <= receiver_x) & (receiver_x < x_end)
+    local_receiver = (receiver_y - y_start) * (x_end - x_start) + (receiver_x - x_start)
+    return np.where(is_inside, local_receiver, -1), global_receiver
+
+
+def accumulate_tile_locally(tile: tuple[int, int, int, int]) -> dict:
+    y_start, y_end, x_start, x_end = tile
+    y_size, x_size = tile_worker_state["array_shape"]
+    local_receiver, global_receiver = get_local_receiver_index_array(tile)
+    wave_list = get_topological_wave_list(local_receiver)
+    local_flux = accumulate_downstream(local_receiver, np.ones(local_receiver.size, dtype=np.int64), wave_list)
+    tile_worker_state["flux"].array[y_start:y_end, x_start:x_end] = local_flux.reshape(y_end - y_start, -1)
+
+    local_y, local_x = np.divmod(np.arange(local_receiver.size), x_end - x_start)
+    global_index = (local_y + y_start) * x_size + (local_x + x_start)
+    is_exit = (local_receiver == -1) & (global_receiver >= 0)
+
+    halo = tile_worker_state["halo_width"]
+    receiver = tile_worker_state["receiver"].array.reshape(y_size, x_size)
+    halo_y_start, halo_y_end = max(y_start - halo, 0), min(y_end + halo, y_size)
+    halo_x_start, halo_x_end = max(x_start - halo, 0), min(x_end + halo, x_size)
+    halo_receiver = receiver[halo_y_start:halo_y_end, halo_x_start:halo_x_end].ravel()
+    receiver_y, receiver_x = np.divmod(halo_receiver, x_size)
+    is_entry_receiver = (halo_receiver >= 0) & (y_start <= receiver_y) & (receiver_y < y_end)
+    is_entry_receiver &= (x_start <= receiver_x) & (receiver_x < x_end)
+    halo_y, halo_x = np.divmod(np.arange(halo_receiver.size), halo_x_end - halo_x_start)
+    is_outside_tile = (halo_y + halo_y_start < y_start) | (halo_y + halo_y_start >= y_end)
+    is_outside_tile |= (halo_x + halo_x_start < x_start) | (halo_x + halo_x_start >= x_end)
+    entry_index = np.unique(halo_receiver[is_entry_receiver & is_outside_tile])
+    entry_y, entry_x = np.divmod(entry_index, x_size)
+    entry_local_index = (entry_y - y_start) * (x_end - x_start) + (entry_x - x_start)
+    terminal_local_index = get_terminal_index_array(local_receiver, wave_list)[entry_local_index]
+    return {
+        "exit_index": global_index[is_exit],
+        "exit_receiver": global_receiver[is_exit],
+        "entry_index": entry_index,
+        "entry_local_index": entry_local_index,
+        "entry_terminal": global_index[terminal_local_index],
+    }
+
+
+def add_tile_inflow(task: tuple) -> None:
+    tile, entry_local_index, entry_inflow = task
+    y_start, y_end, x_start, x_end = tile
+    local_receiver, _ = get_local_receiver_index_array(tile)
+    weight = np.zeros(local_receiver.size, dtype=np.int64)
+    weight[entry_local_index] = entry_inflow
+    inflow = accumulate_downstream(local_receiver, weight)
+    tile_worker_state["flux"].array[y_start:y_end, x_start:x_end] += inflow.reshape(y_end - y_start, -1)
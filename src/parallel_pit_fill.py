@@ -0,0 +1,302 @@
+import heapq
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from common.active_cell import get_active_array
+from common.checkpoint import Checkpoint
+from common.layer_dtype import LayerDtypePolicy
+from pit_fill import PriorityFloodPitFill
+
+
+class TiledPriorityFloodPitFill:
+    """
+    Parallel Priority-Flood depression filling for trillion cell digital elevation models on desktops or clusters
+    by R. Barnes, Computers & Geosciences 96 (2016) 56-68
+    1. every tile is flooded from its own perimeter in a worker process, labeling cells by the perimeter cell.
+    2. the spill elevations between labels (inside tiles, across tile edges and to the DEM edge) are solved centrally.
+    3. every tile raises its cells to the spill elevation of their label in a worker process.
+    the DEM, the filled DEM and the labels stay on disk as .npy memory maps, so a worker only holds one tile.
+    the filled DEM keeps the dtype of the DEM and the labels are int32 while the cell count fits.
+    fill_npy streams a DEM larger than memory from .npy to .npy, fill takes and returns an in-memory array.
+    the result is identical to PriorityFloodPitFill.
+    cells equal to nodata are kept as they are and their neighbors drain to them like to the DEM edge.
+    with a checkpoint, the memory maps are kept in the checkpoint dir and the flooded tiles are saved as progress,
+    so a restarted run with the same input hash floods only the remaining tiles.
+    """
+
+    def __init__(
+        self,
+        worker_count: int = None,
+        tile_size: int = 1024,
+        work_dir: str = None,
+        nodata: float = None,
+        checkpoint: Checkpoint = None,
+        input_hash: str = None,
+    ):
+        self.worker_count = worker_count or os.cpu_count()
+        self.tile_size = tile_size
+        self.work_dir = work_dir
+        self.nodata = nodata
+        self.checkpoint = checkpoint if input_hash is not None else None
+        self.input_hash = input_hash
+
+    def fill(self, dem_array: np.ndarray) -> np.ndarray:
+        if self.checkpoint is not None:
+            work_dir = os.path.join(self.checkpoint.checkpoint_dir, "tiled_pit_fill")
+            os.makedirs(work_dir, exist_ok=True)
+            filled_array = self.fill_in_work_dir(dem_array, work_dir)
+            shutil.rmtree(work_dir)
+            self.checkpoint.remove_progress("tiled_pit_fill")
+            return filled_array
+        with tempfile.TemporaryDirectory(dir=self.work_dir) as work_dir:
+            return self.fill_in_work_dir(dem_array, work_dir)
+
+    def fill_in_work_dir(self, dem_array: np.ndarray, work_dir: str) -> np.ndarray:
+        """DEM written to the work dir once, the filled DEM read back as the only in-memory copy"""
+        dem_path = os.path.join(work_dir, "dem.npy")
+        filled_path = os.path.join(work_dir, "pit_filled_dem.npy")
+        np.save(dem_path, dem_array)
+        return np.array(self.fill_npy(dem_path, filled_path))
+
+    def fill_npy(self, dem_path: str, filled_path: str) -> np.memmap:
+        dem_array = np.load(dem_path, mmap_mode="r")
+        array_shape = dem_array.shape
+        label_path = os.path.splitext(filled_path)[0] + "_label.npy"
+        tile_list = self.make_tile_list(array_shape)
+        tile_result_list = [None] * len(tile_list)
+        if os.path.exists(filled_path) and os.path.exists(label_path):
+            tile_result_list = self.load_tile_progress(len(tile_list))
+        if all(result is None for result in tile_result_list):
+            label_dtype = LayerDtypePolicy().get_index_dtype(dem_array.size)
+            open_memmap(filled_path, mode="w+", dtype=dem_array.dtype, shape=array_shape).flush()
+            open_memmap(label_path, mode="w+", dtype=label_dtype, shape=array_shape).flush()
+        # tiles are labeled from 1 and shifted once the label count of every tile is known
+        remaining_index = [i for i, result in enumerate(tile_result_list) if result is None]
+        with multiprocessing.Pool(
+            processes=min(self.worker_count, len(tile_list)),
+            initializer=initialize_pit_fill_worker,
+            initargs=(dem_path, filled_path, label_path, self.nodata),
+        ) as pool:
+            task_list = [(tile_list[i], 1) for i in remaining_index]
+            for tile_index, tile_result in zip(remaining_index, pool.imap(flood_tile, task_list)):
+                tile_result_list[tile_index] = tile_result
+                if self.checkpoint is not None and self.checkpoint.is_progress_due():
+                    self.save_tile_progress(tile_result_list)
+            label_offset_list = self.shift_tile_label(tile_result_list)
+            label_cnt = label_offset_list[-1] + tile_result_list[-1]["label_cnt"]
+            spill_array = self.solve_spill_graph(tile_result_list, array_shape, label_cnt)
+            finalize_task_list = [
+                (tile, 1, spill_array[label_offset : label_offset + result["label_cnt"]])
+                for tile, label_offset, result in zip(tile_list, label_offset_list, tile_result_list)
+            ]
+            pool.map(finalize_tile, finalize_task_list)
+        os.remove(label_path)
+        return np.load(filled_path, mmap_mode="r")
+
+    def get_progress_hash(self) -> str:
+        return f"{self.input_hash}-{self.tile_size}"
+
+    def save_tile_progress(self, tile_result_list: list[dict]):
+        """results of the flooded tiles, their filled elevations and labels are already in the memory maps"""
+        array_dict = {
+            f"tile{tile_index}_{key}": np.asarray(value)
+            for tile_index, result in enumerate(tile_result_list)
+            if result is not None
+            for key, value in result.items()
+        }
+        self.checkpoint.save_progress("tiled_pit_fill", self.get_progress_hash(), **array_dict)
+
+    def load_tile_progress(self, tile_cnt: int) -> list[dict]:
+        """results of the flooded tiles, None for the remaining ones"""
+        tile_result_list = [None] * tile_cnt
+        if self.checkpoint is None:
+            return tile_result_list
+        array_dict = self.checkpoint.load_progress("tiled_pit_fill", self.get_progress_hash())
+        if array_dict is None:
+            return tile_result_list
+        for name, value in array_dict.items():
+            tile_name, key = name.split("_", 1)
+            tile_index = int(tile_name[len("tile") :])
+            if tile_result_list[tile_index] is None:
+                tile_result_list[tile_index] = {}
+            tile_result_list[tile_index][key] = int(value) if key == "label_cnt" else value
+        logging.info(f"{sum(result is not None for result in tile_result_list)} flooded tiles resumed")
+        return tile_result_list
+
+    def shift_tile_label(self, tile_result_list: list[dict]) -> list[int]:
+        """labels of the tile results (from 1 in every tile) made unique, the first label of every tile is returned"""
+        label_offset_list = []
+        label_offset = 1
+        for result in tile_result_list:
+            label_offset_list.append(label_offset)
+            for key in ["label_a", "label_b", "perimeter_label"]:
+                result[key] = get_global_label_array(result[key], label_offset)
+            label_offset += result["label_cnt"]
+        return label_offset_list
+
+    def make_tile_list(self, array_shape: tuple[int, int]) -> list[tuple[int, int, int, int]]:
+        """(y_start, y_end, x_start, x_end) of every tile"""
+        tile_list = []
+        for y_start in range(0, array_shape[0], self.tile_size):
+            for x_start in range(0, array_shape[1], self.tile_size):
+                y_end = min(y_start + self.tile_size, array_shape[0])
+                x_end = min(x_start + self.tile_size, array_shape[1])
+                tile_list.append((y_start, y_end, x_start, x_end))
+        return tile_list
+
+    def solve_spill_graph(self, tile_result_list: list[dict], array_shape: tuple[int, int], label_cnt: int):
+        """spill elevation of every label: the lowest possible highest elevation on a path to the DEM edge (label 0)"""
+        label_a_list = [result["label_a"] for result in tile_result_list]
+        label_b_list = [result["label_b"] for result in tile_result_list]
+        elevation_list = [result["spill_elevation"] for result in tile_result_list]
+
+        perimeter_index = np.concatenate([result["perimeter_index"] for result in tile_result_list])
+        perimeter_label = np.concatenate([result["perimeter_label"] for result in tile_result_list])
+        perimeter_elevation = np.concatenate([result["perimeter_elevation"] for result in tile_result_list])
+        perimeter_tile = np.concatenate(
+            [np.full(result["perimeter_index"].size, i) for i, result in enumerate(tile_result_list)]
+        )
+        order = np.argsort(perimeter_index)
+        perimeter_index = perimeter_index[order]
+        perimeter_label = perimeter_label[order]
+        perimeter_elevation = perimeter_elevation[order]
+        perimeter_tile = perimeter_tile[order]
+        y_size, x_size = array_shape
+        perimeter_y, perimeter_x = np.divmod(perimeter_index, x_size)
+
+        is_dem_edge = (perimeter_y == 0) | (perimeter_y == y_size - 1)
+        is_dem_edge |= (perimeter_x == 0) | (perimeter_x == x_size - 1)
+        label_a_list.append(np.zeros(is_dem_edge.sum(), dtype=np.int64))
+        label_b_list.append(perimeter_label[is_dem_edge])
+        elevation_list.append(perimeter_elevation[is_dem_edge])
+
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                neighbor_y = perimeter_y + dy
+                neighbor_x = perimeter_x + dx
+                is_inside = (0 <= neighbor_y) & (neighbor_y < y_size) & (0 <= neighbor_x) & (neighbor_x < x_size)
+                neighbor_index = np.where(is_inside, neighbor_y * x_size + neighbor_x, -1)
+                position = np.searchsorted(perimeter_index, neighbor_index).clip(max=perimeter_index.size - 1)
+                is_pair = is_inside & (perimeter_index[position] == neighbor_index)
+                is_pair &= perimeter_tile[position] != perimeter_tile
+                label_a_list.append(perimeter_label[is_pair])
+                label_b_list.append(perimeter_label[position[is_pair]])
+                elevation_list.append(np.maximum(perimeter_elevation[is_pair], perimeter_elevation[position[is_pair]]))
+
+        label_a = np.concatenate(label_a_list)
+        label_b = np.concatenate(label_b_list)
+        spill_elevation = np.concatenate(elevation_list)
+        logging.info(f"spill graph: {label_a.size} edges between tile labels")
+        return self.solve_minimax_from_edge(label_a, label_b, spill_elevation, label_cnt)
+
+    def solve_minimax_from_edge(
+        self, label_a: np.ndarray, label_b: np.ndarray, spill_elevation: np.ndarray, label_cnt: int
+    ) -> np.ndarray:
+        source = np.concatenate([label_a, label_b])
+        target = np.concatenate([label_b, label_a])
+        weight = np.concatenate([spill_elevation, spill_elevation])
+        order = np.argsort(source, kind="stable")
+        source, target, weight = source[order], target[order], weight[order]
+        index_pointer = np.searchsorted(source, np.arange(label_cnt + 1))
+        spill_array = np.full(label_cnt, np.inf)
+        spill_array[0] = -np.inf
+        queue = [(-np.inf, 0)]
+        while queue:
+            level, label = heapq.heappop(queue)
+            if level > spill_array[label]:
+                continue
+            for i in range(index_pointer[label], index_pointer[label + 1]):
+                next_level = max(level, weight[i])
+                if next_level < spill_array[target[i]]:
+                    spill_array[target[i]] = next_level
+                    heapq.heappush(queue, (next_level, target[i]))
+        return spill_array
+
+
+pit_fill_worker_state: dict = {}
+
+
+def initialize_pit_fill_worker(dem_path: str, filled_path: str, label_path: str, nodata: float = None):
+    pit_fill_worker_state["nodata"] = nodata
+    pit_fill_worker_state["dem"] = np.load(dem_path, mmap_mode="r")
+    pit_fill_worker_state["filled"] = np.load(filled_path, mmap_mode="r+")
+    pit_fill_worker_state["label"] = np.load(label_path, mmap_mode="r+")
+
+
+def flood_tile(task: tuple) -> dict:
+    (y_start, y_end, x_start, x_end), label_offset = task
+    x_size = pit_fill_worker_state["dem"].shape[1]
+    dem_tile = np.array(pit_fill_worker_state["dem"][y_start:y_end, x_start:x_end], dtype=np.float64)
+    filled_tile, global_label_tile, tile_result = flood_tile_array(
+        dem_tile, (y_start, x_start), label_offset, x_size, pit_fill_worker_state["nodata"]
+    )
+    pit_fill_worker_state["filled"][y_start:y_end, x_start:x_end] = filled_tile
+    pit_fill_worker_state["label"][y_start:y_end, x_start:x_end] = global_label_tile
+    # a returned tile is on disk, for the progress of a checkpoint
+    pit_fill_worker_state["filled"].flush()
+    pit_fill_worker_state["label"].flush()
+    return tile_result
+
+
+def flood_tile_array(
+    dem_tile: np.ndarray, tile_origin: tuple[int, int], label_offset: int, x_size: int, nodata: float = None
+) -> tuple[np.ndarray, np.ndarray, dict]:
+    """
+    tile flooded from its own perimeter, its global labels and its edges for solve_spill_graph.
+    nodata cells keep label 0 (outside of the DEM) and an elevation of -inf on the perimeter.
+    """
+    y_start, x_start = tile_origin
+    is_active = None if nodata is None else get_active_array(dem_tile, nodata)
+    filled_tile, label_tile, spill_dict = PriorityFloodPitFill().flood_from_border(
+        dem_tile, is_labeled=True, is_active=is_active
+    )
+    global_label_tile = get_global_label_array(label_tile, label_offset)
+
+    is_perimeter = np.ones(filled_tile.shape, dtype=np.bool_)
+    is_perimeter[1:-1, 1:-1] = False
+    local_y, local_x = np.nonzero(is_perimeter)
+    spill_key = np.array(list(spill_dict.keys()), dtype=np.int64).reshape(-1, 2)
+    perimeter_elevation = filled_tile[is_perimeter]
+    if is_active is not None:
+        perimeter_elevation[~is_active[is_perimeter]] = -np.inf
+    tile_result = {
+        "label_a": get_global_label_array(spill_key[:, 0], label_offset),
+        "label_b": get_global_label_array(spill_key[:, 1], label_offset),
+        "spill_elevation": np.array(list(spill_dict.values()), dtype=np.float64),
+        "perimeter_index": (local_y + y_start) * x_size + (local_x + x_start),
+        "perimeter_label": global_label_tile[is_perimeter],
+        "perimeter_elevation": perimeter_elevation,
+        "label_cnt": int(label_tile.max(initial=0)),
+    }
+    return filled_tile, global_label_tile, tile_result
+
+
+def get_global_label_array(label_array: np.ndarray, label_offset: int) -> np.ndarray:
+    """tile label 1, 2, ... to label_offset, label_offset + 1, ..., label 0 (outside of the DEM) stays 0"""
+    label_array = np.asarray(label_array).astype(np.int64)
+    return np.where(label_array > 0, label_array + (label_offset - 1), 0)
+
+
+def finalize_tile(task: tuple) -> None:
+    (y_start, y_end, x_start, x_end), label_offset, tile_spill_array = task
+    filled_tile = np.array(pit_fill_worker_state["filled"][y_start:y_end, x_start:x_end])
+    label_tile = np.array(pit_fill_worker_state["label"][y_start:y_end, x_start:x_end])
+    filled_tile = finalize_tile_array(filled_tile, label_tile, label_offset, tile_spill_array)
+    pit_fill_worker_state["filled"][y_start:y_end, x_start:x_end] = filled_tile
+    pit_fill_worker_state["filled"].flush()
+
+
+def finalize_tile_array(
+    filled_tile: np.ndarray, global_label_tile: np.ndarray, label_offset: int, tile_spill_array: np.ndarray
+) -> np.ndarray:
+    """cells raised to the spill elevation of their label, nodata cells (label 0) are kept"""
+    if tile_spill_array.size == 0:
+        return filled_tile
+    spill_tile = tile_spill_array[(global_label_tile - label_offset).clip(min=0)]
+    return np.where(global_label_tile > 0, np.maximum(filled_tile, spill_tile), filled_tile)
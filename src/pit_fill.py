@@ -1,5 +1,8 @@
+import heapq
 import numpy as np
 
+from common.kernel import kernel_registry
+
 
 class NormalPitFill:
     """
@@ -227,7 +230,130 @@ class Yamazaki2012PitFill:
         pass
 
 
-class PitFillAlgorithm(NormalPitFill, Planchon2001PitFill, Yamazaki2012PitFill):
+class PriorityFloodPitFill:
+    """
+    Priority-Flood: An optimal depression-filling and watershed-labeling algorithm for digital elevation models
+    by R. Barnes, C. Lehman and D. Mulla, Computers & Geosciences 62 (2014) 117-127
+    the border is flooded inward in order of elevation; depressions are filled to a strictly horizontal surface.
+    """
+
+    def pit_fill(self, dem_array: np.ndarray, is_active: np.ndarray = None) -> np.ndarray:
+        """flood of the kernel "priority_flood" of the selected backend"""
+        if is_active is None:
+            is_active = np.ones(dem_array.shape, dtype=np.bool_)
+        dem_array[...] = kernel_registry.get("priority_flood")(dem_array, is_active)
+        return dem_array
+
+    def flood_from_border(
+        self, dem_array: np.ndarray, is_labeled: bool = False, is_active: np.ndarray = None
+    ) -> tuple[np.ndarray, np.ndarray, dict]:
+        """
+        filled array, and if is_labeled, the label of the outlet cell every cell was flooded from (1, 2, ...)
+        with the lowest spill elevation between adjacent labels {(label_a, label_b): elevation}.
+        nodata cells (False in is_active) are kept as they are and get label 0.
+        cells next to them are outlets like the border, with a spill to label 0 at their own elevation.
+        """
+        y_size, x_size = dem_array.shape
+        # filled elevations are always elevations of the DEM, so its dtype is kept
+        filled_array = np.array(dem_array)
+        label_array = np.zeros((y_size, x_size), dtype=np.int32)
+        if is_active is None:
+            is_active = np.ones((y_size, x_size), dtype=np.bool_)
+        is_closed = ~is_active
+        is_outlet, is_nodata_outlet = self.get_outlet_array(is_active)
+        spill_dict = {}
+        outlet_y, outlet_x = np.nonzero(is_outlet)
+        queue = list(zip(filled_array[outlet_y, outlet_x].tolist(), outlet_y.tolist(), outlet_x.tolist()))
+        heapq.heapify(queue)
+        is_closed |= is_outlet
+        label_cnt = 0
+        while queue:
+            level, y, x = heapq.heappop(queue)
+            if label_array[y, x] == 0:
+                label_cnt += 1
+                label_array[y, x] = label_cnt
+                if is_labeled and is_nodata_outlet[y, x]:
+                    self._update_spill(spill_dict, 0, label_cnt, level)
+            label = label_array[y, x]
+            for ny in range(max(y - 1, 0), min(y + 2, y_size)):
+                for nx in range(max(x - 1, 0), min(x + 2, x_size)):
+                    if is_closed[ny, nx]:
+                        neighbor_label = label_array[ny, nx]
+                        if is_labeled and neighbor_label != 0 and neighbor_label != label:
+                            self._update_spill(spill_dict, label, neighbor_label, max(level, filled_array[ny, nx]))
+                        continue
+                    is_closed[ny, nx] = True
+                    label_array[ny, nx] = label
+                    if filled_array[ny, nx] < level:
+                        filled_array[ny, nx] = level
+                    heapq.heappush(queue, (filled_array[ny, nx], ny, nx))
+        return filled_array, label_array, spill_dict
+
+    def get_outlet_array(self, is_active: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """active cells on the border or next to nodata, and those next to nodata"""
+        is_border = np.zeros(is_active.shape, dtype=np.bool_)
+        is_border[[0, -1], :] = True
+        is_border[:, [0, -1]] = True
+        padded = np.pad(~is_active, 1, constant_values=False)
+        is_next_to_nodata = np.zeros(is_active.shape, dtype=np.bool_)
+        y_size, x_size = is_active.shape
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                is_next_to_nodata |= padded[dy : dy + y_size, dx : dx + x_size]
+        return (is_border | is_next_to_nodata) & is_active, is_next_to_nodata & is_active
+
+    def _update_spill(self, spill_dict: dict, label_a: int, label_b: int, elevation: float):
+        key = (min(label_a, label_b), max(label_a, label_b))
+        if elevation < spill_dict.get(key, float("inf")):
+            spill_dict[key] = elevation
+
+
+def priority_flood_reference(dem_array: np.ndarray, is_active: np.ndarray) -> np.ndarray:
+    filled_array, _, _ = PriorityFloodPitFill().flood_from_border(dem_array, is_active=is_active)
+    return filled_array
+
+
+def priority_flood_loop(dem_array: np.ndarray, is_active: np.ndarray) -> np.ndarray:
+    """flood_from_border without labels as one loop (kernel "priority_flood"), the cells are flattened in the queue"""
+    y_size, x_size = dem_array.shape
+    filled_array = dem_array.copy()
+    if filled_array.size == 0:
+        return filled_array
+    is_closed = ~is_active
+    # seeded to type the queue for numba, then emptied
+    queue = [(filled_array[0, 0], 0)]
+    queue.pop()
+    for y in range(y_size):
+        for x in range(x_size):
+            if not is_active[y, x]:
+                continue
+            is_outlet = y == 0 or y == y_size - 1 or x == 0 or x == x_size - 1
+            for ny in range(max(y - 1, 0), min(y + 2, y_size)):
+                for nx in range(max(x - 1, 0), min(x + 2, x_size)):
+                    if not is_active[ny, nx]:
+                        is_outlet = True
+            if is_outlet:
+                is_closed[y, x] = True
+                queue.append((filled_array[y, x], y * x_size + x))
+    heapq.heapify(queue)
+    while len(queue) > 0:
+        level, index = heapq.heappop(queue)
+        y, x = index // x_size, index % x_size
+        for ny in range(max(y - 1, 0), min(y + 2, y_size)):
+            for nx in range(max(x - 1, 0), min(x + 2, x_size)):
+                if is_closed[ny, nx]:
+                    continue
+                is_closed[ny, nx] = True
+                if filled_array[ny, nx] < level:
+                    filled_array[ny, nx] = level
+                heapq.heappush(queue, (filled_array[ny, nx], ny * x_size + nx))
+    return filled_array
+
+
+kernel_registry.register("priority_flood", priority_flood_reference, priority_flood_loop)
+
+
+class PitFillAlgorithm(NormalPitFill, Planchon2001PitFill, Yamazaki2012PitFill, PriorityFloodPitFill):
     def select_algorithm(self, algorithm: str) -> callable:
         if algorithm == "normal":
             return self.normal
@@ -235,8 +361,10 @@ class PitFillAlgorithm(NormalPitFill, Planchon2001PitFill, Yamazaki2012PitFill):
             return self.planchon_2001
         elif algorithm == "yamazaki_2012":
             return self.yamazaki_2012
+        elif algorithm == "priority_flood":
+            return self.priority_flood
         else:
-            raise ValueError("algorithm must be normal, planchon_2001 or yamazaki_2012")
+            raise ValueError("algorithm must be normal, planchon_2001, yamazaki_2012 or priority_flood")
 
     def normal(self, dem_array: np.ndarray) -> np.ndarray:
         return NormalPitFill.pit_fill(self, dem_array)
@@ -246,3 +374,6 @@ class PitFillAlgorithm(NormalPitFill, Planchon2001PitFill, Yamazaki2012PitFill):
 
     def yamazaki_2012(self, dem_array: np.ndarray) -> np.ndarray:
         return Yamazaki2012PitFill.pit_fill(self, dem_array)
+
+    def priority_flood(self, dem_array: np.ndarray, is_active: np.ndarray = None) -> np.ndarray:
+        return PriorityFloodPitFill.pit_fill(self, dem_array, is_active)
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from common.active_cell import ActiveCellIndex
+from common.figure_setting import TiffTag
+from common.flow_graph import get_topological_wave_list
+from common.layer_dtype import LayerDtypePolicy
+from common.logging_decorator import logging_decorator
+from make_catchment_area import CatchmentAreaArrangement
+from make_catchment_area import RiverMouth
+
+
+FLOW_DIRECTION_PATH = "base_data/FlowDir_30m_drone_mean.tif"
+SAVE_DIR = "output/stream-network"
+
+
+def main():
+    catchment_area = CatchmentAreaArrangement()
+    catchment_area.set_save_dir(SAVE_DIR)
+    catchment_area.set_flow_direction_rule("D8")
+    catchment_area.set_flow_direction(FLOW_DIRECTION_PATH)
+    catchment_area.derive_flow_accumulation()
+    stream_network = StreamNetwork(catchment_area)
+    stream_network.derive(np.asarray(catchment_area.flow_direction), np.asarray(catchment_area.flow_accumulation))
+    stream_network.save()
+
+
+class StreamNetwork:
+    """
+    cells draining more than threshold_km2 as a stream network with Strahler and Shreve orders.
+    a link runs from a head or a confluence to the cell above the next confluence or outlet.
+    orders and links are derived in one topological pass over the receivers of the stream cells,
+    so the cost is linear in the number of cells.
+    """
+
+    def __init__(self, catchment_area: RiverMouth, threshold_km2: float = None):
+        self.catchment_area = catchment_area
+        self.threshold_km2 = catchment_area.river_mouth_threshold_km2 if threshold_km2 is None else threshold_km2
+        self.stream_cell_index: ActiveCellIndex = None
+        self.receiver_array: np.ndarray = None
+        self.strahler_array: np.ndarray = None
+        self.shreve_array: np.ndarray = None
+        self.link_array: np.ndarray = None
+        self.step_array: np.ndarray = None
+        self.flow_accumulation_array: np.ndarray = None
+
+    @logging_decorator
+    def derive(self, flow_direction_array: np.ndarray, flow_accumulation_array: np.ndarray):
+        """orders, link (from 1) and position in the link of every stream cell"""
+        threshold_cell = self.threshold_km2 / self.catchment_area.get_cell_area_km2()
+        self.flow_accumulation_array = flow_accumulation_array
+        array_shape = flow_accumulation_array.shape
+        index_dtype = LayerDtypePolicy().get_index_dtype(flow_accumulation_array.size)
+        stream_index = np.flatnonzero(flow_accumulation_array.ravel() >= threshold_cell).astype(index_dtype)
+        self.stream_cell_index = ActiveCellIndex(array_shape, stream_index)
+        receiver_index = self.catchment_area.get_receiver_index_of_cells(flow_direction_array, stream_index)
+        # receivers of stream cells in stream cell positions, -1 at outlets
+        self.receiver_array = self.stream_cell_index.get_position(receiver_index)
+        self.set_order_and_link(get_topological_wave_list(self.receiver_array))
+        logging.info(f"{stream_index.size} stream cells, {self.get_link_cnt()} links")
+
+    def set_order_and_link(self, wave_list: list[np.ndarray]):
+        receiver_array = self.receiver_array
+        stream_cnt = receiver_array.size
+        donor_cnt = np.bincount(receiver_array[receiver_array >= 0], minlength=stream_cnt)
+        is_link_start = donor_cnt != 1
+        count_dtype = LayerDtypePolicy().get_count_dtype(stream_cnt)
+        self.strahler_array = np.zeros(stream_cnt, dtype=np.uint8)
+        max_donor_order = np.zeros(stream_cnt, dtype=np.uint8)
+        max_donor_cnt = np.zeros(stream_cnt, dtype=np.uint8)
+        self.shreve_array = (donor_cnt == 0).astype(count_dtype)
+        self.link_array = np.zeros(stream_cnt, dtype=receiver_array.dtype)
+        self.link_array[is_link_start] = np.arange(1, np.count_nonzero(is_link_start) + 1)
+        self.step_array = np.zeros(stream_cnt, dtype=receiver_array.dtype)
+        for wave in wave_list:
+            # every donor of the wave is in an earlier wave, so the orders of the wave are final
+            order = np.where(
+                max_donor_cnt[wave] >= 2, max_donor_order[wave] + 1, np.maximum(max_donor_order[wave], 1)
+            ).astype(np.uint8)
+            self.strahler_array[wave] = order
+            receiver = receiver_array[wave]
+            has_receiver = receiver >= 0
+            donor, receiver, order = wave[has_receiver], receiver[has_receiver], order[has_receiver]
+            previous_max_order = max_donor_order[receiver]
+            np.maximum.at(max_donor_order, receiver, order)
+            max_donor_cnt[receiver[max_donor_order[receiver] > previous_max_order]] = 0
+            np.add.at(max_donor_cnt, receiver[order == max_donor_order[receiver]], 1)
+            np.add.at(self.shreve_array, receiver, self.shreve_array[donor])
+            # a cell with one donor continues the link of the donor
+            is_continued = ~is_link_start[receiver]
+            self.link_array[receiver[is_continued]] = self.link_array[donor[is_continued]]
+            self.step_array[receiver[is_continued]] = self.step_array[donor[is_continued]] + 1
+
+    def get_link_cnt(self) -> int:
+        return int(self.link_array.max(initial=0))
+
+    def get_strahler_order_array(self) -> np.ndarray:
+        """Strahler order raster, 0 off the stream"""
+        return self.stream_cell_index.scatter(self.strahler_array, 0)
+
+    def get_link_id_array(self) -> np.ndarray:
+        """link id raster, 0 off the stream"""
+        return self.stream_cell_index.scatter(self.link_array, 0)
+
+    def get_link_table(self) -> dict[str, np.ndarray]:
+        """
+        per link (id - 1 as index): orders, length, upstream area at the end, downstream link (0 at outlets)
+        and the vertices as flattened cell index, from the start to the end and the confluence below it.
+        """
+        link_cnt = self.get_link_cnt()
+        order = np.lexsort((self.step_array, self.link_array))
+        # cells on flow cycles are never reached by the topological pass and have no link
+        order = order[self.link_array[order] > 0]
+        sorted_link = self.link_array[order]
+        vertex_cnt = np.bincount(sorted_link - 1, minlength=link_cnt)
+        end_position = np.cumsum(vertex_cnt) - 1
+        start = order[end_position - vertex_cnt + 1]
+        end = order[end_position]
+        downstream = self.receiver_array[end]
+        has_downstream = downstream >= 0
+        downstream_link = np.where(has_downstream, self.link_array[np.maximum(downstream, 0)], 0)
+
+        # vertices of every link followed by the confluence cell below it
+        vertex = self.stream_cell_index.active_index[order].astype(np.int64)
+        confluence = np.where(has_downstream, self.stream_cell_index.active_index[np.maximum(downstream, 0)], -1)
+        insert_position = (end_position + 1)[has_downstream]
+        vertex = np.insert(vertex, insert_position, confluence[has_downstream])
+        vertex_cnt = vertex_cnt + has_downstream
+        vertex_link = np.repeat(np.arange(link_cnt), vertex_cnt)
+
+        x_size = self.stream_cell_index.array_shape[1]
+        y, x = np.divmod(vertex, x_size)
+        x_resolution_km, y_resolution_km, _ = self.catchment_area.change_resolution_to_km(
+            self.catchment_area.image_tag[TiffTag.ModelPixelScaleTag]
+        )
+        is_same_link = vertex_link[1:] == vertex_link[:-1]
+        segment_km = np.hypot(np.diff(x) * x_resolution_km, np.diff(y) * y_resolution_km)
+        length_km = np.bincount(vertex_link[1:][is_same_link], segment_km[is_same_link], minlength=link_cnt)
+        end_cell = self.stream_cell_index.active_index[end]
+        upstream_cell_cnt = self.flow_accumulation_array.ravel()[end_cell].astype(np.float64) + 1
+        return {
+            "link_id": np.arange(1, link_cnt + 1),
+            "strahler": self.strahler_array[start],
+            "shreve": self.shreve_array[start],
+            "length_km": length_km,
+            "upstream_area_km2": upstream_cell_cnt * self.catchment_area.get_cell_area_km2(),
+            "downstream_link_id": downstream_link,
+            "vertex": vertex,
+            "vertex_pointer": np.concatenate([[0], np.cumsum(vertex_cnt)]),
+        }
+
+    def get_cell_center_coordinate(self, flat_index: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        y, x = np.divmod(flat_index, self.stream_cell_index.array_shape[1])
+        return self.catchment_area.get_geo_transform().get_coordinate(x, y, is_center=True)
+
+    def save_geojson(self, file_name: str = "stream_network"):
+        """links as LineString features through the cell centers, written feature by feature"""
+        link_table = self.get_link_table()
+        coordinate_x, coordinate_y = self.get_cell_center_coordinate(link_table["vertex"])
+        vertex_pointer = link_table["vertex_pointer"]
+        property_name_list = ["link_id", "strahler", "shreve", "length_km", "upstream_area_km2", "downstream_link_id"]
+        os.makedirs(self.catchment_area.save_dir, exist_ok=True)
+        path = os.path.join(self.catchment_area.save_dir, file_name + ".geojson")
+        crs = self.catchment_area.get_crs_from_tag(self.catchment_area.image_tag) or "urn:ogc:def:crs:OGC:1.3:CRS84"
+        with open(path, "w", encoding="utf-8") as file:
+            file.write('{"type": "FeatureCollection", ')
+            file.write(f'"crs": {json.dumps({"type": "name", "properties": {"name": crs}})}, "features": [\n')
+            for link in range(link_table["link_id"].size):
+                start, end = vertex_pointer[link], vertex_pointer[link + 1]
+                feature = {
+                    "type": "Feature",
+                    "properties": {name: link_table[name][link].item() for name in property_name_list},
+                    "geometry": {
+                        "type": "LineString",
+                        "coordinates": np.stack([coordinate_x[start:end], coordinate_y[start:end]], axis=1).tolist(),
+                    },
+                }
+                file.write(("" if link == 0 else ",\n") + json.dumps(feature, ensure_ascii=False))
+            file.write("\n]}\n")
+        logging.info(f"{link_table['link_id'].size} links saved to {path}")
+
+    def save(self):
+        self.catchment_area.save_tiff(self.get_strahler_order_array(), "strahler_order")
+        self.catchment_area.save_tiff(self.get_link_id_array(), "stream_link")
+        self.save_geojson()
+
+
+if __name__ == "__main__":
+    main()
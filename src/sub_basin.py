@@ -0,0 +1,230 @@
+import csv
+import logging
+import os
+
+import numpy as np
+
+from common.flow_graph import get_topological_wave_list
+from common.logging_decorator import logging_decorator
+from common.polygonizer import LabelPolygonizer
+from common.util import load_json
+from make_catchment_area import CatchmentAreaArrangement
+from make_catchment_area import DAM_GEOJSON_PATH
+from stream_network import StreamNetwork
+
+
+FLOW_DIRECTION_PATH = "base_data/FlowDir_30m_drone_mean.tif"
+SAVE_DIR = "output/sub-basin"
+SUB_BASIN_COLUMNS = [
+    "label",
+    "kind",
+    "name",
+    "x",
+    "y",
+    "parent_label",
+    "child_label",
+    "pfafstetter",
+    "area_km2",
+    "upstream_area_km2",
+]
+
+
+def main():
+    catchment_area = CatchmentAreaArrangement()
+    catchment_area.set_save_dir(SAVE_DIR)
+    catchment_area.set_flow_direction_rule("D8")
+    catchment_area.set_flow_direction(FLOW_DIRECTION_PATH)
+    catchment_area.derive_flow_accumulation()
+    flow_direction_array = np.asarray(catchment_area.flow_direction)
+    flow_accumulation_array = np.asarray(catchment_area.flow_accumulation)
+    stream_network = StreamNetwork(catchment_area)
+    stream_network.derive(flow_direction_array, flow_accumulation_array)
+    sub_basin = SubBasinSegmentation(catchment_area)
+    sub_basin.add_stream_network_seed(stream_network)
+    sub_basin.add_dam_seed(load_json(DAM_GEOJSON_PATH))
+    sub_basin.derive(flow_direction_array, flow_accumulation_array)
+    sub_basin.save()
+
+
+class SubBasinSegmentation:
+    """
+    incremental catchments of seed cells (the end of every stream link above its confluence and/or dams):
+    every cell gets the label of the first seed downstream of it, in one reverse topological pass.
+    the seeds form a tree by the first seed downstream of each seed, coded by Pfafstetter on the upstream area.
+    """
+
+    def __init__(self, catchment_area: CatchmentAreaArrangement):
+        self.catchment_area = catchment_area
+        self.seed_dict: dict[int, tuple[str, str]] = {}
+        self.seed_index: np.ndarray = None
+        self.label_array: np.ndarray = None
+        self.parent_label: np.ndarray = None
+        self.pfafstetter_list: list[str] = []
+        self.cell_cnt: np.ndarray = None
+        self.upstream_cell_cnt: np.ndarray = None
+
+    def add_seed_point(self, x: int, y: int, kind: str, name: str = ""):
+        """a seed at a cell replaces an earlier seed at the same cell"""
+        array_shape = self.catchment_area.get_array_shape_from_image(self.catchment_area.flow_direction)
+        if self.catchment_area.is_out_of_array(array_shape, x, y):
+            logging.warning(f"seed {name} ({x}, {y}) is out of the scene")
+            return
+        self.seed_dict[y * array_shape[1] + x] = (kind, name)
+
+    def add_stream_network_seed(self, stream_network: StreamNetwork):
+        """the last cell of every link, so every link gets its own incremental catchment"""
+        link_table = stream_network.get_link_table()
+        end_position = link_table["vertex_pointer"][1:] - 1 - (link_table["downstream_link_id"] > 0)
+        for link_id, end_cell in zip(link_table["link_id"], link_table["vertex"][end_position]):
+            y, x = divmod(int(end_cell), stream_network.stream_cell_index.array_shape[1])
+            self.add_seed_point(x, y, "link", str(link_id))
+
+    def add_dam_seed(self, geojson: dict[str, any]):
+        feature_list = geojson["features"]
+        if len(feature_list) == 0:
+            return
+        coordinate_array = np.array([feature["geometry"]["coordinates"][:2] for feature in feature_list])
+        x_array, y_array = self.catchment_area.get_geo_transform().get_pixel_xy(
+            coordinate_array[:, 0], coordinate_array[:, 1]
+        )
+        for feature, x, y in zip(feature_list, x_array.tolist(), y_array.tolist()):
+            properties = feature["properties"]
+            self.add_seed_point(x, y, "dam", f"{properties['W01_001']}_{properties['W01_003']}")
+
+    @logging_decorator
+    def derive(self, flow_direction_array: np.ndarray, flow_accumulation_array: np.ndarray):
+        """label (from 1 in the order of the seed cells, 0 where no seed is downstream) and the seed tree"""
+        self.seed_index = np.array(sorted(self.seed_dict), dtype=np.int64)
+        receiver_index_array = self.catchment_area.get_receiver_index_array(flow_direction_array)
+        label_array = np.zeros(flow_direction_array.size, dtype=np.int32)
+        label_array[self.seed_index] = np.arange(1, self.seed_index.size + 1)
+        is_seed = label_array > 0
+        for wave in reversed(get_topological_wave_list(receiver_index_array)):
+            receiver = receiver_index_array[wave]
+            is_inherited = (receiver >= 0) & ~is_seed[wave]
+            label_array[wave[is_inherited]] = label_array[receiver[is_inherited]]
+        self.label_array = label_array.reshape(flow_direction_array.shape)
+
+        seed_receiver = receiver_index_array[self.seed_index]
+        self.parent_label = np.where(seed_receiver >= 0, label_array[np.maximum(seed_receiver, 0)], 0)
+        self.cell_cnt = np.bincount(label_array, minlength=self.seed_index.size + 1)[1:]
+        self.upstream_cell_cnt = flow_accumulation_array.ravel()[self.seed_index].astype(np.float64) + 1
+        self.pfafstetter_list = self.get_pfafstetter_list()
+        logging.info(f"{self.seed_index.size} sub-basins, {np.count_nonzero(self.cell_cnt)} not empty")
+
+    def get_child_list(self) -> list[list[int]]:
+        """child seeds (0-based) of every seed"""
+        child_list = [[] for _ in range(self.seed_index.size)]
+        for seed, parent_label in enumerate(self.parent_label):
+            if parent_label > 0:
+                child_list[parent_label - 1].append(seed)
+        return child_list
+
+    def get_pfafstetter_list(self) -> list[str]:
+        """
+        Pfafstetter code of every seed.
+        in a basin, the main stem follows the child with the largest upstream area,
+        the four largest tributaries are 2, 4, 6, 8 from downstream and the interbasins between them 1, 3, 5, 7, 9.
+        every sub-basin is divided again until it is one seed.
+        """
+        child_list = self.get_child_list()
+        code_list = [""] * self.seed_index.size
+        root_list = [seed for seed in range(self.seed_index.size) if self.parent_label[seed] == 0]
+        root_list.sort(key=lambda seed: -self.upstream_cell_cnt[seed])
+        # (main stem from downstream, children of its top seed belonging to other basins, code), basins from 1
+        stack = [(self.get_main_stem(root, child_list), set(), str(number)) for number, root in enumerate(root_list, 1)]
+        while stack:
+            stem, excluded_set, code = stack.pop()
+            tributary_list = [
+                (position, child)
+                for position, seed in enumerate(stem)
+                for child in child_list[seed]
+                if child not in (excluded_set if position == len(stem) - 1 else {stem[position + 1]})
+            ]
+            if len(tributary_list) == 0 and len(stem) == 1:
+                code_list[stem[0]] = code
+                continue
+            if len(tributary_list) == 0:
+                # a chain without tributaries (dams on a link) is divided along the stem
+                part_list = [part.tolist() for part in np.array_split(np.array(stem), min(5, len(stem)))]
+                part_excluded_list = [{part[0]} for part in part_list[1:]] + [excluded_set]
+                for digit, part, part_excluded_set in zip([1, 3, 5, 7, 9], part_list, part_excluded_list):
+                    stack.append((part, part_excluded_set, code + str(digit)))
+                continue
+            tributary_list = sorted(tributary_list, key=lambda item: -self.upstream_cell_cnt[item[1]])[:4]
+            tributary_list.sort()
+            stem_start = 0
+            for digit, (position, tributary) in zip([2, 4, 6, 8], tributary_list):
+                if stem_start <= position:
+                    interbasin_excluded_set = {stem[position + 1]} if position + 1 < len(stem) else set(excluded_set)
+                    interbasin_excluded_set |= {
+                        child for child_position, child in tributary_list if child_position == position
+                    }
+                    stack.append((stem[stem_start : position + 1], interbasin_excluded_set, code + str(digit - 1)))
+                stack.append((self.get_main_stem(tributary, child_list), set(), code + str(digit)))
+                stem_start = position + 1
+            if stem_start < len(stem):
+                stack.append((stem[stem_start:], excluded_set, code + str(len(tributary_list) * 2 + 1)))
+        return code_list
+
+    def get_main_stem(self, seed: int, child_list: list[list[int]]) -> list[int]:
+        stem = [seed]
+        while child_list[stem[-1]]:
+            stem.append(max(child_list[stem[-1]], key=lambda child: self.upstream_cell_cnt[child]))
+        return stem
+
+    def get_table(self) -> list[dict]:
+        """one row per seed with its parent and children, code and areas"""
+        cell_area_km2 = self.catchment_area.get_cell_area_km2()
+        x_size = self.label_array.shape[1]
+        child_list = self.get_child_list()
+        row_list = []
+        for seed, seed_index in enumerate(self.seed_index):
+            y, x = divmod(int(seed_index), x_size)
+            kind, name = self.seed_dict[int(seed_index)]
+            row_list.append(
+                {
+                    "label": seed + 1,
+                    "kind": kind,
+                    "name": name,
+                    "x": x,
+                    "y": y,
+                    "parent_label": int(self.parent_label[seed]),
+                    "child_label": " ".join(str(child + 1) for child in child_list[seed]),
+                    "pfafstetter": self.pfafstetter_list[seed],
+                    "area_km2": self.cell_cnt[seed] * cell_area_km2,
+                    "upstream_area_km2": self.upstream_cell_cnt[seed] * cell_area_km2,
+                }
+            )
+        return row_list
+
+    def save(self, file_name: str = "sub_basin", is_line_delimited: bool = False):
+        """int32 label raster, the table of the seed tree and the sub-basin polygons"""
+        self.catchment_area.save_tiff(self.label_array, file_name)
+        row_list = self.get_table()
+        path = os.path.join(self.catchment_area.save_dir, file_name + ".csv")
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=SUB_BASIN_COLUMNS)
+            writer.writeheader()
+            writer.writerows(row_list)
+        logging.info(f"sub-basin table saved to {path}")
+        self.save_geojson(row_list, file_name, is_line_delimited)
+
+    def save_geojson(self, row_list: list[dict], file_name: str = "sub_basin", is_line_delimited: bool = False):
+        """polygons of the sub-basins with the table row and the outlet (seed cell center) as properties"""
+        catchment_area = self.catchment_area
+        outlet_x, outlet_y = catchment_area.get_geo_transform().get_coordinate(
+            np.array([row["x"] for row in row_list]), np.array([row["y"] for row in row_list]), is_center=True
+        )
+        property_dict = {
+            row["label"]: {**row, "outlet_coordinate": [coordinate_x, coordinate_y]}
+            for row, coordinate_x, coordinate_y in zip(row_list, outlet_x.tolist(), outlet_y.tolist())
+        }
+        polygonizer = LabelPolygonizer()
+        polygonizer.set_tag(catchment_area.image_tag)
+        polygonizer.set_save_dir(catchment_area.save_dir)
+        polygonizer.save_geojson(self.label_array, file_name, property_dict, is_line_delimited)
+
+
+if __name__ == "__main__":
+    main()
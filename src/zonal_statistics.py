@@ -0,0 +1,162 @@
+import argparse
+import csv
+import logging
+import os
+
+import numpy as np
+
+from common.figure_setting import TiffTag
+from common.logging_decorator import logging_decorator
+from common.util import save_json
+from make_catchment_area import CatchmentAreaArrangement
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    """
+    e.g., python3 src/zonal_statistics.py output/sub-basin/sub_basin.tif
+    --layer elevation=base_data/dem.tif --layer fill=output/catchment-area/altitude_correction.tif --volume fill
+    """
+    parser = argparse.ArgumentParser(description="statistics of layers per label of a label raster")
+    parser.add_argument("label_path")
+    parser.add_argument("--layer", action="append", default=[], help="name=path, repeatable")
+    parser.add_argument("--percentile", type=float, action="append", help="repeatable, 50 by default")
+    parser.add_argument("--volume", action="append", default=[], help="layers also summed as volume (sum * cell area)")
+    parser.add_argument("--save-dir", default="output/zonal-statistics")
+    parser.add_argument("--file-name", default="zonal_statistics")
+    parser.add_argument("--format", default="csv", choices=["csv", "json"])
+    args = parser.parse_args()
+
+    catchment_area = CatchmentAreaArrangement()
+    catchment_area.set_save_dir(args.save_dir)
+    zonal_statistics = ZonalStatistics(catchment_area, percentile_list=args.percentile)
+    for layer in args.layer:
+        name, path = layer.split("=", 1)
+        array = np.asarray(catchment_area.open_layer(path))
+        # only a GDAL_NODATA tag marks nodata, 0 is a valid value of most layers
+        nodata = catchment_area.get_nodata() if TiffTag.GDAL_NODATA in catchment_area.image_tag else None
+        zonal_statistics.add_layer(name, array, nodata, is_volume=name in args.volume)
+    zonal_statistics.derive(np.asarray(catchment_area.open_layer(args.label_path)))
+    zonal_statistics.save(args.file_name, args.format)
+
+
+class ZonalStatistics:
+    """
+    statistics of layers per label (> 0) of a label raster, for all labels at once.
+    the cells are grouped by label once, every layer is read once and reduced with bincount and reduceat,
+    so the cost does not grow with the number of labels. percentiles sort the values within the labels.
+    nan and nodata cells of a layer are left out of its statistics.
+    """
+
+    def __init__(self, catchment_area: CatchmentAreaArrangement, percentile_list: list[float] = None):
+        self.catchment_area = catchment_area
+        self.percentile_list = [50.0] if percentile_list is None else percentile_list
+        self.layer_dict: dict[str, tuple[np.ndarray, float, bool]] = {}
+        self.label_list: np.ndarray = None
+        self.statistic_dict: dict[str, np.ndarray] = {}
+
+    def add_layer(self, name: str, array: np.ndarray, nodata: float = None, is_volume: bool = False):
+        """is_volume: also sum * cell area in m3 (e.g., fill volume of altitude_correction in m)"""
+        self.layer_dict[name] = (array, nodata, is_volume)
+
+    @logging_decorator
+    def derive(self, label_array: np.ndarray):
+        label_flat = np.asarray(label_array).ravel()
+        # cells of every label together, in the order of the labels
+        label_order = np.argsort(label_flat)
+        sorted_label = label_flat[label_order]
+        first_labeled = np.searchsorted(sorted_label, 0, side="right")
+        label_order, sorted_label = label_order[first_labeled:], sorted_label[first_labeled:]
+        is_label_start = np.ones(sorted_label.size, dtype=np.bool_)
+        is_label_start[1:] = sorted_label[1:] != sorted_label[:-1]
+        self.label_list = sorted_label[is_label_start]
+        label_position = np.cumsum(is_label_start) - 1
+        cell_cnt = np.bincount(label_position, minlength=self.label_list.size)
+        self.statistic_dict = {
+            "label": self.label_list,
+            "cell_count": cell_cnt,
+            "area_km2": cell_cnt * self.catchment_area.get_cell_area_km2(),
+        }
+        for name, (array, nodata, is_volume) in self.layer_dict.items():
+            value = np.asarray(array).ravel()[label_order]
+            layer_statistic_dict = self.get_layer_statistic_dict(value, label_position, nodata)
+            if is_volume:
+                layer_statistic_dict["volume_m3"] = (
+                    layer_statistic_dict["sum"] * self.catchment_area.get_cell_area_km2() * 1e6
+                )
+            for statistic_name, statistic in layer_statistic_dict.items():
+                self.statistic_dict[f"{name}_{statistic_name}"] = statistic
+        logging.info(f"statistics of {len(self.layer_dict)} layers for {self.label_list.size} labels")
+
+    def get_layer_statistic_dict(
+        self, value: np.ndarray, label_position: np.ndarray, nodata: float
+    ) -> dict[str, np.ndarray]:
+        """value and label_position grouped by label, nan where a label has no valid cell"""
+        label_cnt = self.label_list.size
+        is_valid = ~np.isnan(value) if value.dtype.kind == "f" else np.ones(value.size, dtype=np.bool_)
+        if nodata is not None:
+            is_valid &= value != nodata
+        if not is_valid.all():
+            value, label_position = value[is_valid], label_position[is_valid]
+        count = np.bincount(label_position, minlength=label_cnt)
+        value_sum = np.bincount(label_position, weights=value, minlength=label_cnt)
+        has_value = count > 0
+        start = np.cumsum(count) - count
+        statistic_dict = {
+            "count": count,
+            "sum": value_sum,
+            "mean": np.divide(value_sum, count, out=np.full(label_cnt, np.nan), where=has_value),
+            "min": np.full(label_cnt, np.nan),
+            "max": np.full(label_cnt, np.nan),
+        }
+        if value.size == 0:
+            for percentile in self.percentile_list:
+                statistic_dict[f"p{percentile:g}"] = np.full(label_cnt, np.nan)
+            return statistic_dict
+        statistic_dict["min"][has_value] = np.minimum.reduceat(value, start[has_value])
+        statistic_dict["max"][has_value] = np.maximum.reduceat(value, start[has_value])
+        if self.percentile_list:
+            # values sorted within every label by one sort of (label, rank of the value),
+            # linear interpolation as numpy.percentile
+            value_rank = np.empty(value.size, dtype=np.int64)
+            value_rank[np.argsort(value)] = np.arange(value.size)
+            value = value[np.argsort(label_position * value.size + value_rank)].astype(np.float64)
+            for percentile in self.percentile_list:
+                position = start + (count - 1).clip(min=0) * percentile / 100
+                lower = np.floor(position).astype(np.int64).clip(max=value.size - 1)
+                upper = np.ceil(position).astype(np.int64).clip(max=value.size - 1)
+                interpolated = value[lower] + (value[upper] - value[lower]) * (position - lower)
+                statistic_dict[f"p{percentile:g}"] = np.where(has_value, interpolated, np.nan)
+        return statistic_dict
+
+    def get_table(self) -> list[dict]:
+        """one row per label, None for the statistics of a label without valid cells"""
+        column_list = list(self.statistic_dict)
+        column_value_list = [self.get_column_value(statistic) for statistic in self.statistic_dict.values()]
+        return [dict(zip(column_list, row)) for row in zip(*column_value_list)]
+
+    def get_column_value(self, statistic: np.ndarray) -> list:
+        if statistic.dtype.kind != "f":
+            return statistic.tolist()
+        return [None if np.isnan(value) else value for value in statistic.tolist()]
+
+    def save(self, file_name: str = "zonal_statistics", file_format: str = "csv") -> str:
+        os.makedirs(self.catchment_area.save_dir, exist_ok=True)
+        path = os.path.join(self.catchment_area.save_dir, f"{file_name}.{file_format}")
+        row_list = self.get_table()
+        if file_format == "json":
+            save_json(row_list, path)
+        elif file_format == "csv":
+            with open(path, "w", encoding="utf-8", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=list(self.statistic_dict))
+                writer.writeheader()
+                writer.writerows(row_list)
+        else:
+            raise ValueError("file_format must be 'csv' or 'json'.")
+        logging.info(f"zonal statistics saved to {path}")
+        return path
+
+
+if __name__ == "__main__":
+    main()
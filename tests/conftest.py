@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules import each other from src, as when run as python3 src/<script>.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from flow_direction_rule import FlowDirectionRuleMatrix
+from make_catchment_area import FlowAccumulation
+
+
+def make_tilted_dem(seed: int, array_shape: tuple[int, int]) -> np.ndarray:
+    """plane falling to the east with small noise, so every cell has a downslope neighbor"""
+    rng = np.random.default_rng(seed)
+    x = np.arange(array_shape[1], dtype=np.float64)
+    return (100 - 2 * x)[np.newaxis] + rng.random(array_shape) * 0.5
+
+
+@pytest.mark.parametrize("rule", ["D8", "D16"])
+@pytest.mark.parametrize("algorithm", ["d_infinity", "mfd"])
+def test_dominant_flow_direction_in_rule_matrix(rule, algorithm):
+    flow_accumulation = FlowAccumulation()
+    flow_accumulation.set_flow_direction_rule(rule)
+    flow_accumulation.set_flow_direction_rule_matrix()
+    flow_accumulation.set_flow_direction_algorithm(algorithm)
+    dem_array = make_tilted_dem(0, (12, 16))
+    flow_direction_array = flow_accumulation.get_flow_direction_array(dem_array)
+
+    dominant = np.argmax(flow_accumulation.flow_proportion_array, axis=0)
+    has_flow = flow_accumulation.flow_proportion_array.max(axis=0) > 0
+    for code, k in zip(flow_direction_array[has_flow], dominant[has_flow]):
+        assert flow_accumulation.get_downstream_delta_xy(int(code)) == FlowDirectionRuleMatrix.NEIGHBOR_DELTA_XY[k]
+    assert np.all(flow_direction_array[~has_flow] == 0)
+
+    # the single receiver accumulation follows the dominant directions down the plane
+    flow_acc_array = flow_accumulation.calculate_flow_accumulation(flow_direction_array)
+    assert flow_acc_array.max() >= dem_array.shape[1] - 1
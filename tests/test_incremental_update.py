@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from incremental_update import IncrementalFlowUpdate
+from make_catchment_area import FlowAccumulation
+
+
+def make_flow_accumulation(rule: str) -> FlowAccumulation:
+    flow_accumulation = FlowAccumulation()
+    flow_accumulation.set_flow_direction_rule(rule)
+    flow_accumulation.set_flow_direction_rule_matrix()
+    flow_accumulation.set_pit_fill_rule("priority_flood")
+    return flow_accumulation
+
+
+def make_dem(seed: int, array_shape: tuple[int, int]) -> np.ndarray:
+    """noisy slope with pits, a strip of sea and scattered voids as nodata (0)"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0 : array_shape[0], 0 : array_shape[1]]
+    dem_array = rng.random(array_shape) * 30 + y * 0.05 + x * 0.03 + 5
+    dem_array[:, : array_shape[1] // 5] = 0
+    dem_array[rng.integers(0, array_shape[0], 20), rng.integers(0, array_shape[1], 20)] = 0
+    return dem_array.astype(np.float32)
+
+
+def get_full_layer_list(dem_array: np.ndarray, rule: str) -> list[np.ndarray]:
+    """pit filled DEM, flow direction and flow accumulation recomputed from scratch"""
+    flow_accumulation = make_flow_accumulation(rule)
+    flow_accumulation.dem = dem_array.copy()
+    flow_accumulation.fill_pit()
+    flow_accumulation.derive_flow_direction()
+    flow_accumulation.derive_flow_accumulation()
+    return get_layer_list(flow_accumulation)
+
+
+def get_layer_list(flow_accumulation: FlowAccumulation) -> list[np.ndarray]:
+    layer_list = [
+        flow_accumulation.pit_filled_dem,
+        flow_accumulation.flow_direction,
+        flow_accumulation.flow_accumulation,
+    ]
+    return [np.asarray(layer) for layer in layer_list]
+
+
+def assert_same_layer_list(layer_list: list[np.ndarray], expected_list: list[np.ndarray]):
+    for layer_array, expected_array in zip(layer_list, expected_list):
+        np.testing.assert_array_equal(layer_array, expected_array)
+
+
+@pytest.mark.parametrize("rule", ["D8", "D16"])
+def test_incremental_update_matches_full_recompute(rule):
+    rng = np.random.default_rng(1)
+    dem_array = make_dem(0, (48, 64))
+    flow_accumulation = make_flow_accumulation(rule)
+    incremental_update = IncrementalFlowUpdate(flow_accumulation, tile_size=16)
+    incremental_update.initialize(dem_array)
+    assert_same_layer_list(get_layer_list(flow_accumulation), get_full_layer_list(dem_array, rule))
+
+    # a dug window across tile edges
+    x_start, y_start, x_end, y_end = 20, 10, 45, 30
+    dem_window = dem_array[y_start:y_end, x_start:x_end].copy()
+    is_active = dem_window != 0
+    dem_window[is_active] = np.maximum(dem_window[is_active] - 20, 1)
+    dem_array[y_start:y_end, x_start:x_end] = dem_window
+    incremental_update.update_bound_box((x_start, y_start, x_end, y_end), dem_window)
+    assert_same_layer_list(get_layer_list(flow_accumulation), get_full_layer_list(dem_array, rule))
+
+    # scattered cells raised and lowered
+    active_y, active_x = np.nonzero(dem_array != 0)
+    position = rng.choice(active_y.size, 50, replace=False)
+    y, x = active_y[position], active_x[position]
+    value = np.maximum(dem_array[y, x] + rng.choice([-15, 15], 50), 1).astype(np.float32)
+    dem_array[y, x] = value
+    incremental_update.update_cells(x, y, value)
+    assert_same_layer_list(get_layer_list(flow_accumulation), get_full_layer_list(dem_array, rule))
+
+
+def test_incremental_update_rejects_nodata_change():
+    dem_array = make_dem(0, (48, 64))
+    incremental_update = IncrementalFlowUpdate(make_flow_accumulation("D8"), tile_size=16)
+    incremental_update.initialize(dem_array)
+    with pytest.raises(ValueError):
+        incremental_update.update_cells([63], [47], [0.0])
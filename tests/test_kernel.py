@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import pit_fill  # noqa: F401, registers priority_flood
+from common import image_processing  # noqa: F401, registers trace_contour
+from common.flow_graph import make_donor_csr
+from common.kernel import kernel_registry
+
+
+def make_dem(seed: int, array_shape: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """DEM with pits, flats and nodata cells (False in is_active)"""
+    rng = np.random.default_rng(seed)
+    dem_array = rng.integers(0, 5, array_shape).astype(np.float32)
+    is_active = rng.random(array_shape) > 0.15
+    dem_array[~is_active] = 0
+    return dem_array, is_active
+
+
+def make_receiver_forest(seed: int, cell_cnt: int) -> np.ndarray:
+    """receivers of lower index only, so there is no cycle, -1 at outlets and nodata cells"""
+    rng = np.random.default_rng(seed)
+    receiver_index_array = (np.arange(cell_cnt) * rng.random(cell_cnt)).astype(np.int64)
+    receiver_index_array[rng.random(cell_cnt) < 0.05] = -1
+    receiver_index_array[0] = -1
+    return receiver_index_array
+
+
+def make_contour_mask() -> np.ndarray:
+    """a ring of valid cells around a nodata hole, with a notch"""
+    y, x = np.mgrid[0:24, 0:30]
+    distance = np.hypot(y - 11.5, x - 14.5)
+    is_valid = (distance < 10) & (distance > 4)
+    is_valid[11:13, 20:] = False
+    return is_valid
+
+
+@pytest.mark.parametrize("seed, array_shape", [(0, (1, 1)), (1, (7, 13)), (2, (30, 25)), (3, (64, 64))])
+def test_priority_flood_kernels_match(seed, array_shape):
+    dem_array, is_active = make_dem(seed, array_shape)
+    kernel_registry.compare("priority_flood", dem_array, is_active)
+
+
+def test_priority_flood_kernels_match_without_nodata():
+    dem_array, _ = make_dem(4, (40, 40))
+    kernel_registry.compare("priority_flood", dem_array, np.ones(dem_array.shape, dtype=np.bool_))
+
+
+@pytest.mark.parametrize("outlet_index", [0, 17, 999])
+def test_trace_upstream_kernels_match(outlet_index):
+    donor_index_pointer, donor_index_array = make_donor_csr(make_receiver_forest(5, 1000))
+    kernel_registry.compare("trace_upstream", donor_index_pointer, donor_index_array, outlet_index)
+
+
+def test_trace_upstream_kernels_match_on_cycle():
+    donor_index_pointer, donor_index_array = make_donor_csr(np.array([1, 2, 0, 0]))
+    kernel_registry.compare("trace_upstream", donor_index_pointer, donor_index_array, 0)
+
+
+@pytest.mark.parametrize("start_position", [0, 50, -1])
+def test_trace_contour_kernels_match(start_position):
+    is_valid = make_contour_mask()
+    valid_y, valid_x = np.nonzero(is_valid)
+    sx, sy = int(valid_x[start_position]), int(valid_y[start_position])
+    kernel_registry.compare("trace_contour", is_valid, sx, sy)
+
+
+@pytest.mark.parametrize("name", ["priority_flood", "trace_upstream", "trace_contour"])
+def test_jit_kernels_are_compiled(name):
+    """without numba compare checks the loop versions run as plain Python, with numba the compiled ones"""
+    pytest.importorskip("numba")
+    assert hasattr(kernel_registry.get(name, "jit"), "py_func")
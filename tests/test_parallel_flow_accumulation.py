@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from make_catchment_area import FlowAccumulation
+
+
+def make_flow_direction(seed: int, array_shape: tuple[int, int]) -> np.ndarray:
+    """steepest descent on a noisy slope, with pits (no flow direction) left in"""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 3, array_shape[1])
+    dem_array = (rng.random(array_shape) + x[np.newaxis]).astype(np.float32)
+    return FlowAccumulation().get_steepest_descent_flow_direction_array(dem_array)
+
+
+@pytest.mark.parametrize("seed, array_shape, tile_size", [(0, (37, 53), 16), (1, (64, 64), 16), (2, (90, 70), 32)])
+def test_parallel_flow_accumulation_matches_serial(seed, array_shape, tile_size):
+    flow_direction_array = make_flow_direction(seed, array_shape)
+    flow_accumulation = FlowAccumulation()
+    flow_accumulation.set_flow_accumulation_mode("serial")
+    serial_array = flow_accumulation.calculate_flow_accumulation(flow_direction_array)
+    flow_accumulation.set_flow_accumulation_mode("parallel", worker_count=2, tile_size=tile_size)
+    parallel_array = flow_accumulation.calculate_flow_accumulation(flow_direction_array)
+    assert serial_array.max() > 0
+    np.testing.assert_array_equal(parallel_array, serial_array)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from make_catchment_area import PitFill
+
+
+def make_dem(seed: int, array_shape: tuple[int, int]) -> np.ndarray:
+    """rolling DEM with pits, a strip of sea and scattered voids as nodata (0)"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0 : array_shape[0], 0 : array_shape[1]]
+    dem_array = rng.random(array_shape) * 10 + (np.sin(y / 5) + np.cos(x / 7)) * 20 + 50
+    dem_array[:, : array_shape[1] // 6] = 0
+    dem_array[rng.random(array_shape) < 0.03] = 0
+    return dem_array.astype(np.float32)
+
+
+def fill_pit_array(dem_array: np.ndarray, tile_size: int = None) -> np.ndarray:
+    pit_fill = PitFill()
+    pit_fill.set_pit_fill_rule("priority_flood")
+    if tile_size is not None:
+        pit_fill.set_pit_fill_mode("tiled", worker_count=2, tile_size=tile_size)
+    pit_fill.derive_active_cell_index(dem_array)
+    return pit_fill.fill_pit_array(dem_array)
+
+
+@pytest.mark.parametrize("seed, array_shape, tile_size", [(0, (30, 41), 8), (1, (64, 64), 16), (2, (90, 70), 32)])
+def test_tiled_pit_fill_matches_serial(seed, array_shape, tile_size):
+    dem_array = make_dem(seed, array_shape)
+    serial_array = fill_pit_array(dem_array)
+    tiled_array = fill_pit_array(dem_array, tile_size)
+    assert np.any(serial_array > dem_array)
+    assert tiled_array.dtype == dem_array.dtype
+    np.testing.assert_array_equal(tiled_array, serial_array)
+    np.testing.assert_array_equal(tiled_array[dem_array == 0], 0)